@@ -0,0 +1,342 @@
+# Benchmarks for the hot paths of ICMPHelperLibrary.py: packet build, checksum, reply parse and validation, and
+# whole ping and traceroute loops over a SimulatedNetwork. None of them open a raw socket, so they run without root
+# or a network:
+#
+#   python3 ICMPBenchmark.py
+#   python3 ICMPBenchmark.py --json results.json                           # also write every result as JSON
+#   python3 ICMPBenchmark.py --baseline results.json --tolerance 0.1       # compare against a saved run
+#
+# Every result reports ns per operation and operations per second (for the loops an operation is one probe, so
+# that is probes/s), and the microbenchmarks the bytes one call allocates at its peak, from tracemalloc. With
+# --baseline the run exits with status 1 if any result got slower than the baseline by more than the tolerance.
+
+# #################################################################################################################### #
+# Imports                                                                                                              #
+#                                                                                                                      #
+#                                                                                                                      #
+#                                                                                                                      #
+#                                                                                                                      #
+# #################################################################################################################### #
+import argparse
+import collections
+import json
+import platform
+import random
+import struct
+import sys
+import time
+import timeit
+import tracemalloc
+
+from ICMPHelperLibrary import IcmpHelperLibrary
+
+
+# One measurement. unit is what one operation is ("call", "probe"); allocatedBytesPerOp is None where it was not
+# measured.
+BenchmarkResult = collections.namedtuple("BenchmarkResult",
+                                         ["name", "unit", "nsPerOp", "opsPerSecond", "allocatedBytesPerOp"])
+
+# Divides every iteration count, for a quick smoke run (--quick).
+iterationScale = 1
+
+
+# #################################################################################################################### #
+# Reference Implementations                                                                                            #
+#                                                                                                                      #
+# Copies of code the library has replaced, kept so every run measures the new path against the old one and checks     #
+# that both still agree.                                                                                               #
+#                                                                                                                      #
+# #################################################################################################################### #
+def legacyChecksum(packetAsByteData):
+    # The original IcmpPacket.__recalculateChecksum loop, without its debug output.
+    checksum = 0
+    countTo = (len(packetAsByteData) // 2) * 2
+    count = 0
+    while count < countTo:
+        thisVal = packetAsByteData[count + 1] * 256 + packetAsByteData[count]
+        checksum = checksum + thisVal
+        checksum = checksum & 0xffffffff
+        count = count + 2
+    if countTo < len(packetAsByteData):
+        thisVal = packetAsByteData[len(packetAsByteData) - 1]
+        checksum = checksum + thisVal
+        checksum = checksum & 0xffffffff
+    checksum = (checksum >> 16) + (checksum & 0xffff)
+    checksum = (checksum >> 16) + checksum
+    answer = ~checksum
+    answer = answer & 0xffff
+    answer = answer >> 8 | (answer << 8 & 0xff00)
+    return answer
+
+
+# #################################################################################################################### #
+# Measurement                                                                                                          #
+#                                                                                                                      #
+#                                                                                                                      #
+#                                                                                                                      #
+#                                                                                                                      #
+# #################################################################################################################### #
+def timePerCall(function, number):
+    # Best of 5 repeats, in nanoseconds per call.
+    number = max(1, number // iterationScale)
+    return min(timeit.repeat(function, number=number, repeat=5)) / number * 1e9
+
+
+def allocatedBytesPerCall(function, number=200):
+    # Mean peak of the memory one call allocates, in bytes, as traced by tracemalloc. It counts temporaries freed
+    # before the call returns, which is where the hot paths' garbage comes from.
+    tracemalloc.start()
+    try:
+        function()
+        total = 0
+        for i in range(number):
+            current = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            function()
+            total += tracemalloc.get_traced_memory()[1] - current
+    finally:
+        tracemalloc.stop()
+    return total / number
+
+
+def measureCall(name, function, number):
+    nsPerOp = timePerCall(function, number)
+    return BenchmarkResult(name, "call", nsPerOp, 1e9 / nsPerOp, allocatedBytesPerCall(function))
+
+
+def measureProbes(name, function, repeat=3):
+    # function runs one loop and returns how many probes it sent; the fastest of repeat runs is kept.
+    bestNsPerOp = None
+    for i in range(repeat):
+        startTime = time.perf_counter_ns()
+        probesSent = function()
+        nsPerOp = (time.perf_counter_ns() - startTime) / probesSent
+        bestNsPerOp = nsPerOp if bestNsPerOp is None else min(bestNsPerOp, nsPerOp)
+    return BenchmarkResult(name, "probe", bestNsPerOp, 1e9 / bestNsPerOp, None)
+
+
+def printHeader(title):
+    print("-----------------------------------------------------------------")
+    print(title)
+    print("-----------------------------------------------------------------")
+
+
+def printResult(benchmarkResult, referenceResult=None):
+    # ns/op and allocated bytes, plus the speedup over referenceResult when given.
+    allocated = "" if benchmarkResult.allocatedBytesPerOp is None else \
+        "%8.0f B/op" % benchmarkResult.allocatedBytesPerOp
+    if benchmarkResult.unit == "probe":
+        allocated = "%8.0f probes/s" % benchmarkResult.opsPerSecond
+    if referenceResult is None:
+        print("  %-40s %10.0f ns/op %s" % (benchmarkResult.name, benchmarkResult.nsPerOp, allocated))
+    else:
+        print("  %-40s %10.0f ns/op %s %6.1fx" % (benchmarkResult.name, benchmarkResult.nsPerOp, allocated,
+                                                  referenceResult.nsPerOp / benchmarkResult.nsPerOp))
+
+
+# #################################################################################################################### #
+# Benchmarks                                                                                                           #
+#                                                                                                                      #
+#                                                                                                                      #
+#                                                                                                                      #
+#                                                                                                                      #
+# #################################################################################################################### #
+def benchmarkChecksum():
+    icmpChecksum = IcmpHelperLibrary.IcmpChecksum
+    echoRequest = struct.pack("!BBHHH", 8, 0, 0, 0x1234, 1) + struct.pack("d", 0.0) + \
+        "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz".encode("utf-8")
+
+    for packetAsByteData in [echoRequest, echoRequest[:-1], random.Random(0).randbytes(1500), bytes(64),
+                             b'\xff' * 64]:
+        assert legacyChecksum(packetAsByteData) == icmpChecksum.calculate(packetAsByteData)
+
+    # IcmpPacket.__recalculateChecksum on a built packet: joins header and data, then sums them.
+    icmpPacket = IcmpHelperLibrary.IcmpPacket()
+    icmpPacket.buildPacket_echoRequest(0x1234, 1)
+    recalculateChecksum = icmpPacket._IcmpPacket__recalculateChecksum
+
+    printHeader("Checksum (%d byte echo request)" % len(echoRequest))
+    results = [measureCall("legacy while loop", lambda: legacyChecksum(echoRequest), 20000),
+               measureCall("bulk (int.from_bytes)", lambda: icmpChecksum.calculate(echoRequest), 20000),
+               measureCall("incremental (RFC 1624)", lambda: icmpChecksum.update(0x1b2c, 1, 2), 20000),
+               measureCall("IcmpPacket.__recalculateChecksum", recalculateChecksum, 20000)]
+    printResult(results[0])
+    for benchmarkResult in results[1:]:
+        printResult(benchmarkResult, results[0])
+    return results
+
+
+def benchmarkPacketBuild():
+    def buildIcmpPacket():
+        icmpPacket = IcmpHelperLibrary.IcmpPacket()
+        icmpPacket.buildPacket_echoRequest(0x1234, 1)
+        return icmpPacket.getPacketBytes()
+
+    echoRequestTemplate = IcmpHelperLibrary.IcmpEchoRequestTemplate(0x1234)
+    assert IcmpHelperLibrary.IcmpChecksum.calculate(echoRequestTemplate.stamp(1)) == 0
+    assert IcmpHelperLibrary.IcmpChecksum.calculate(echoRequestTemplate.stampBurstBuffer(3, 1)) == 0
+
+    printHeader("Echo request build")
+    results = [measureCall("IcmpPacket.buildPacket_echoRequest", buildIcmpPacket, 20000),
+               measureCall("IcmpEchoRequestTemplate.stamp", lambda: echoRequestTemplate.stamp(1), 20000),
+               measureCall("IcmpEchoRequestTemplate.stampBurstBuffer",
+                           lambda: echoRequestTemplate.stampBurstBuffer(3, 1), 20000)]
+    printResult(results[0])
+    printResult(results[1], results[0])
+    printResult(results[2], results[0])
+    return results
+
+
+def benchmarkReplyParse():
+    # An Echo Reply as the raw socket delivers it: 20 byte IP header, ICMP header, send time and payload.
+    ipHeader = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 88, 0, 0, 64, 1, 0, bytes([127, 0, 0, 1]), bytes([127, 0, 0, 1]))
+    echoReply = ipHeader + struct.pack("!BBHHH", 0, 0, 0, 0x1234, 1) + struct.pack("d", 0.0) + \
+        "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz".encode("utf-8")
+    recvView = memoryview(bytearray(echoReply))
+
+    def parseEchoReplyPacket():
+        icmpReplyPacket = IcmpHelperLibrary.IcmpPacket_EchoReply(echoReply)
+        return icmpReplyPacket.getIcmpType(), icmpReplyPacket.getIcmpCode(), icmpReplyPacket.getIcmpIdentifier(), \
+            icmpReplyPacket.getIcmpSequenceNumber()
+
+    icmpReply = IcmpHelperLibrary.IcmpReply.parse(recvView, len(echoReply), "127.0.0.1", 0.0)
+    assert parseEchoReplyPacket() == (icmpReply.icmpType, icmpReply.icmpCode, icmpReply.packetIdentifier,
+                                      icmpReply.packetSequenceNumber)
+
+    # With the request's data, parse also checks the reply's payload, as IcmpPacket's reply validation did.
+    echoRequestData = IcmpHelperLibrary.IcmpPacket.ECHO_REQUEST_DATA_ENCODED
+    assert IcmpHelperLibrary.IcmpReply.parse(recvView, len(echoReply), "127.0.0.1", 0.0,
+                                             echoRequestData).isValidResponse
+
+    printHeader("Echo reply parse")
+    results = [measureCall("IcmpPacket_EchoReply getters", parseEchoReplyPacket, 20000),
+               measureCall("IcmpReply.parse",
+                           lambda: IcmpHelperLibrary.IcmpReply.parse(recvView, len(echoReply), "127.0.0.1", 0.0),
+                           20000),
+               measureCall("IcmpReply.parse with data check",
+                           lambda: IcmpHelperLibrary.IcmpReply.parse(recvView, len(echoReply), "127.0.0.1", 0.0,
+                                                                     echoRequestData), 20000)]
+    printResult(results[0])
+    printResult(results[1], results[0])
+    printResult(results[2], results[0])
+    return results
+
+
+def benchmarkLoops():
+    # Whole ping and traceroute loops against a SimulatedNetwork with instant, lossless links, so the numbers are
+    # the engine's own per-probe cost: building, sending, receiving, parsing and matching.
+    simulatedNetwork = IcmpHelperLibrary.SimulatedNetwork(seed=0)
+    routerAddresses = ["198.18.0.%d" % hop for hop in range(2, 12)]
+    for address in routerAddresses + ["198.19.0.1"]:
+        simulatedNetwork.addRouter(address, latency=0)
+    simulatedNetwork.addPath("198.19.0.1", routerAddresses)
+    batchNetwork = IcmpHelperLibrary.SimulatedNetwork(seed=0)
+    batchTargets = batchNetwork.addTree(max(1, 2000 // iterationScale), latency=0, jitter=0, rateLimit=0,
+                                        silentRouterFraction=0, silentTargetFraction=0, unreachableTargetFraction=0)
+
+    icmpHelper = IcmpHelperLibrary(transport=simulatedNetwork)
+    # The same loop with every probe counted and timed, for the cost of instrumentation.
+    metricsHelper = IcmpHelperLibrary(transport=simulatedNetwork, probeMetrics=IcmpHelperLibrary.ProbeMetrics())
+    batchHelper = IcmpHelperLibrary(transport=batchNetwork)
+    pingCount = max(1, 2000 // iterationScale)
+    traceCount = max(1, 50 // iterationScale)
+
+    def ping():
+        pingStatistics = list(icmpHelper.sendPingResults("198.19.0.1", pingCount, 1))[-1]
+        assert pingStatistics.probesAnswered == pingCount
+        return pingCount
+
+    def trace(pipelined, traceHelper=icmpHelper):
+        probesSent = 0
+        for i in range(traceCount):
+            for result in traceHelper.traceRouteResults("198.19.0.1", pipelined, timeout=1):
+                if isinstance(result, IcmpHelperLibrary.HopResult):
+                    probesSent += result.probesSent
+        return probesSent
+
+    def traceBatch():
+        probesReceived = batchNetwork.getProbesReceived()
+        traceCount = sum(1 for targetHost, hops in batchHelper.traceRouteBatch(batchTargets, 8192, 64, timeout=1))
+        assert traceCount == len(batchTargets)
+        return batchNetwork.getProbesReceived() - probesReceived
+
+    printHeader("Probe loops (SimulatedNetwork, 11 hops)")
+    results = [measureProbes("sendPingResults", ping),
+               measureProbes("traceRouteResults", lambda: trace(False)),
+               measureProbes("traceRouteResults (pipelined)", lambda: trace(True)),
+               measureProbes("traceRouteResults (ProbeMetrics)", lambda: trace(False, metricsHelper)),
+               measureProbes("traceRouteBatch (%d targets)" % len(batchTargets), traceBatch, 1)]
+    for benchmarkResult in results:
+        printResult(benchmarkResult)
+    icmpHelper.close()
+    metricsHelper.close()
+    batchHelper.close()
+    simulatedNetwork.close()
+    batchNetwork.close()
+    return results
+
+
+# #################################################################################################################### #
+# Results                                                                                                              #
+#                                                                                                                      #
+#                                                                                                                      #
+#                                                                                                                      #
+#                                                                                                                      #
+# #################################################################################################################### #
+def writeResults(fileName, benchmarkResults):
+    report = {"python": platform.python_version(), "platform": platform.platform(), "time": time.time(),
+              "results": [benchmarkResult._asdict() for benchmarkResult in benchmarkResults]}
+    with open(fileName, "w") as resultFile:
+        json.dump(report, resultFile, indent=2)
+
+
+def compareWithBaseline(fileName, benchmarkResults, tolerance):
+    # Print each result's change from the baseline and return the names of those slower by more than tolerance.
+    with open(fileName) as baselineFile:
+        baseline = {result["name"]: result for result in json.load(baselineFile)["results"]}
+    printHeader("Compared with %s" % fileName)
+    regressions = []
+    for benchmarkResult in benchmarkResults:
+        baselineResult = baseline.get(benchmarkResult.name)
+        if baselineResult is None:
+            print("  %-40s %10s" % (benchmarkResult.name, "new"))
+            continue
+        change = benchmarkResult.nsPerOp / baselineResult["nsPerOp"] - 1
+        isRegression = change > tolerance
+        print("  %-40s %+9.1f%%%s" % (benchmarkResult.name, change * 100, "    REGRESSION" if isRegression else ""))
+        if isRegression:
+            regressions.append(benchmarkResult.name)
+    return regressions
+
+
+# #################################################################################################################### #
+# main()                                                                                                               #
+#                                                                                                                      #
+#                                                                                                                      #
+#                                                                                                                      #
+#                                                                                                                      #
+# #################################################################################################################### #
+def main():
+    global iterationScale
+    parser = argparse.ArgumentParser(description="ICMPHelperLibrary benchmarks")
+    parser.add_argument("--json", metavar="FILE", help="write every result to FILE as JSON")
+    parser.add_argument("--baseline", metavar="FILE", help="compare against results saved with --json")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="with --baseline, the slowdown (0.1 is 10%%) above which a result is a regression")
+    parser.add_argument("--quick", action="store_true", help="run a tenth of the iterations")
+    arguments = parser.parse_args()
+    if arguments.quick:
+        iterationScale = 10
+
+    benchmarkResults = []
+    for benchmark in [benchmarkChecksum, benchmarkPacketBuild, benchmarkReplyParse, benchmarkLoops]:
+        benchmarkResults += benchmark()
+    if arguments.json is not None:
+        writeResults(arguments.json, benchmarkResults)
+    if arguments.baseline is not None and len(compareWithBaseline(arguments.baseline, benchmarkResults,
+                                                                  arguments.tolerance)) > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -23,19 +23,26 @@ import struct
 import time
 import select
 import math
+import asyncio
+import collections
+import argparse
+import sys
+import threading
+import queue
+import ctypes
+import errno
+import concurrent.futures
+import mmap
+import array
+import heapq
+import random
+import json
 
+try:
+    import numpy                    # Optional: ResultReader returns NumPy arrays when it is installed
+except ImportError:
+    numpy = None
 
-# #################################################################################################################### #
-# Public Variables                                                                                                     #
-#                                                                                                                      #
-#                                                                                                                      #
-#                                                                                                                      #
-#                                                                                                                      #
-# #################################################################################################################### #
-rtt_list = []
-packets_sent = 0
-packets_dropped = 0
-ping_complete = False
 
 # #################################################################################################################### #
 # Class IcmpHelperLibrary                                                                                              #
@@ -94,6 +101,10 @@ class IcmpHelperLibrary:
 
         __DEBUG_IcmpPacket = False      # Allows for debug output
 
+        # Every echo request carries the same payload, so it is encoded once for all packets
+        ECHO_REQUEST_DATA_RAW = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+        ECHO_REQUEST_DATA_ENCODED = ECHO_REQUEST_DATA_RAW.encode("utf-8")
+
         # ############################################################################################################ #
         # IcmpPacket Class Getters                                                                                     #
         #                                                                                                              #
@@ -104,6 +115,9 @@ class IcmpHelperLibrary:
         def getIcmpTarget(self):
             return self.__icmpTarget
 
+        def getDestinationIpAddress(self):
+            return self.__destinationIpAddress
+
         def getDataRaw(self):
             return self.__dataRaw
 
@@ -125,6 +139,12 @@ class IcmpHelperLibrary:
         def getTtl(self):
             return self.__ttl
 
+        def getIpTimeout(self):
+            return self.__ipTimeout
+
+        def getPacketBytes(self):
+            return b''.join([self.__header, self.__data])
+
         # ############################################################################################################ #
         # IcmpPacket Class Setters                                                                                     #
         #                                                                                                              #
@@ -132,12 +152,15 @@ class IcmpHelperLibrary:
         #                                                                                                              #
         #                                                                                                              #
         # ############################################################################################################ #
-        def setIcmpTarget(self, icmpTarget):
+        def setIcmpTarget(self, icmpTarget, destinationIpAddress=None):
             self.__icmpTarget = icmpTarget
 
-            # Only attempt to get destination address if it is not whitespace
-            if len(self.__icmpTarget.strip()) > 0:
-                self.__destinationIpAddress = gethostbyname(self.__icmpTarget.strip())
+            # Callers sending many packets to one host resolve it once and pass the address in. Otherwise it is
+            # looked up through the shared resolver cache, if the target is not whitespace.
+            if destinationIpAddress is not None:
+                self.__destinationIpAddress = destinationIpAddress
+            elif len(self.__icmpTarget.strip()) > 0:
+                self.__destinationIpAddress = IcmpHelperLibrary.sharedResolverCache.resolve(self.__icmpTarget.strip())
 
         def setIcmpType(self, icmpType):
             self.__icmpType = icmpType
@@ -157,6 +180,10 @@ class IcmpHelperLibrary:
         def setTtl(self, ttl):
             self.__ttl = ttl
 
+        def setIpTimeout(self, ipTimeout):
+            # Seconds to wait for the reply to this packet
+            self.__ipTimeout = ipTimeout
+
         # ############################################################################################################ #
         # IcmpPacket Class Private Functions                                                                           #
         #                                                                                                              #
@@ -167,36 +194,7 @@ class IcmpHelperLibrary:
         def __recalculateChecksum(self):
             print("calculateChecksum Started...") if self.__DEBUG_IcmpPacket else 0
             packetAsByteData = b''.join([self.__header, self.__data])
-            checksum = 0
-
-            # This checksum function will work with pairs of values with two separate 16 bit segments. Any remaining
-            # 16 bit segment will be handled on the upper end of the 32 bit segment.
-            countTo = (len(packetAsByteData) // 2) * 2
-
-            # Calculate checksum for all paired segments
-            print(f'{"Count":10} {"Value":10} {"Sum":10}') if self.__DEBUG_IcmpPacket else 0
-            count = 0
-            while count < countTo:
-                thisVal = packetAsByteData[count + 1] * 256 + packetAsByteData[count]
-                checksum = checksum + thisVal
-                checksum = checksum & 0xffffffff        # Capture 16 bit checksum as 32 bit value
-                print(f'{count:10} {hex(thisVal):10} {hex(checksum):10}') if self.__DEBUG_IcmpPacket else 0
-                count = count + 2
-
-            # Calculate checksum for remaining segment (if there are any)
-            if countTo < len(packetAsByteData):
-                thisVal = packetAsByteData[len(packetAsByteData) - 1]
-                checksum = checksum + thisVal
-                checksum = checksum & 0xffffffff        # Capture as 32 bit value
-                print(count, "\t", hex(thisVal), "\t", hex(checksum)) if self.__DEBUG_IcmpPacket else 0
-
-            # Add 1's Complement Rotation to original checksum
-            checksum = (checksum >> 16) + (checksum & 0xffff)   # Rotate and add to base 16 bits
-            checksum = (checksum >> 16) + checksum              # Rotate and add
-
-            answer = ~checksum                  # Invert bits
-            answer = answer & 0xffff            # Trim to 16 bit value
-            answer = answer >> 8 | (answer << 8 & 0xff00)
+            answer = IcmpHelperLibrary.IcmpChecksum.calculate(packetAsByteData)
             print("Checksum: ", hex(answer)) if self.__DEBUG_IcmpPacket else 0
 
             self.setPacketChecksum(answer)
@@ -217,47 +215,24 @@ class IcmpHelperLibrary:
                                    )
 
         def __encodeData(self):
-            data_time = struct.pack("d", time.time())               # Used to track overall round trip time
-                                                                    # time.time() creates a 64 bit value of 8 bytes
-            dataRawEncoded = self.getDataRaw().encode("utf-8")
+            data_time = struct.pack("!Q", time.perf_counter_ns())   # Used to track overall round trip time
+                                                                    # Monotonic nanoseconds, 64 bits / 8 bytes
+            if self.getDataRaw() == self.ECHO_REQUEST_DATA_RAW:
+                dataRawEncoded = self.ECHO_REQUEST_DATA_ENCODED
+            else:
+                dataRawEncoded = self.getDataRaw().encode("utf-8")
 
             self.__data = data_time + dataRawEncoded
 
         def __packAndRecalculateChecksum(self):
             # Checksum is calculated with the following sequence to confirm data in up to date
+            self.setPacketChecksum(0)           # The checksum field itself counts as zero while summing
             self.__packHeader()                 # packHeader() and encodeData() transfer data to their respective bit
                                                 # locations, otherwise, the bit sequences are empty or incorrect.
             self.__encodeData()
             self.__recalculateChecksum()        # Result will set new checksum value
             self.__packHeader()                 # Header is rebuilt to include new checksum value
 
-        def __validateIcmpReplyPacketWithOriginalPingData(self, icmpReplyPacket):
-            # Obtain sequence number, packet identifier, and raw data from ICMP reply packet.
-            reply_sequence_number = icmpReplyPacket.getIcmpSequenceNumber()
-            reply_packet_identifier = icmpReplyPacket.getIcmpIdentifier()
-            reply_raw_data = icmpReplyPacket.getIcmpData()
-
-            # Compare ICMP reply packet values to the original ICMP packet, set valid response accordingly,
-            # and print debug messages if necessary.
-            if self.__packetSequenceNumber != reply_sequence_number or self.__packetIdentifier != reply_packet_identifier or self.__dataRaw != reply_raw_data:
-                print("ECHO REPLY IS INVALID")
-            if self.__packetSequenceNumber != reply_sequence_number:
-                icmpReplyPacket.setIsValidResponse(False)
-                icmpReplyPacket.setIcmpIdentifier_isValid(False)
-                print(f"Expected Sequence Number: {self.__packetSequenceNumber}, Actual Sequence Number: {reply_sequence_number}")
-            if self.__packetIdentifier != reply_packet_identifier:
-                icmpReplyPacket.setIsValidResponse(False)
-                icmpReplyPacket.setIcmpIdentifier_isValid(False)
-                print(f"Expected Packet Identifier: {self.__packetIdentifier}, Actual Packet Identifier: {reply_packet_identifier}")
-            if self.__dataRaw != reply_raw_data:
-                icmpReplyPacket.setIsValidResponse(False)
-                icmpReplyPacket.setIcmpIdentifier_isValid(False)
-                print(f"Expected Raw Data: {self.__dataRaw}, Actual Raw Data: {reply_raw_data}")
-            else:
-                icmpReplyPacket.setIsValidResponse(True)
-                icmpReplyPacket.setIcmpIdentifier_isValid(True)
-
-
         # ############################################################################################################ #
         # IcmpPacket Class Public Functions                                                                            #
         #                                                                                                              #
@@ -270,9 +245,25 @@ class IcmpHelperLibrary:
             self.setIcmpCode(0)
             self.setPacketIdentifier(packetIdentifier)
             self.setPacketSequenceNumber(packetSequenceNumber)
-            self.__dataRaw = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+            self.__dataRaw = self.ECHO_REQUEST_DATA_RAW
             self.__packAndRecalculateChecksum()
 
+        def updatePacketSequenceNumber(self, sequenceNumber):
+            # Reuse an already built packet for the next probe. The checksum is adjusted for the changed word only
+            # (RFC 1624), so the payload is not summed again.
+            self.setPacketChecksum(IcmpHelperLibrary.IcmpChecksum.update(self.__packetChecksum,
+                                                                         self.__packetSequenceNumber, sequenceNumber))
+            self.setPacketSequenceNumber(sequenceNumber)
+            self.__packHeader()
+
+        def updateDateTimeSent(self):
+            # Restamp the send time in the first 8 payload bytes and adjust the checksum for just those bytes.
+            data_time = struct.pack("!Q", time.perf_counter_ns())
+            self.setPacketChecksum(IcmpHelperLibrary.IcmpChecksum.updateBytes(self.__packetChecksum,
+                                                                              self.__data[:8], data_time))
+            self.__data = data_time + self.__data[8:]
+            self.__packHeader()
+
         def printPingTarget(self):
             # Signal the ping target by printing the target's name and IP address.
             print("-----------------------------------------------------------------")
@@ -285,187 +276,7 @@ class IcmpHelperLibrary:
             print("Traceroute to (" + self.__icmpTarget + ") " + self.__destinationIpAddress)
             print("-------------------------------------------------------------------------------------------------------------------------")
 
-        def sendPingEchoRequest(self, ttl, packet_num):
-            if len(self.__icmpTarget.strip()) <= 0 | len(self.__destinationIpAddress.strip()) <= 0:
-                self.setIcmpTarget("127.0.0.1")
-
-            global rtt_list
-            mySocket = socket(AF_INET, SOCK_RAW, IPPROTO_ICMP)
-            mySocket.settimeout(self.__ipTimeout)
-            mySocket.bind(("", 0))
-            mySocket.setsockopt(IPPROTO_IP, IP_TTL, struct.pack('I', ttl))  # Unsigned int - 4 bytes
-            try:
-                mySocket.sendto(b''.join([self.__header, self.__data]), (self.__destinationIpAddress, 0))
-                timeLeft = 30
-                pingStartTime = time.time()
-                startedSelect = time.time()
-                whatReady = select.select([mySocket], [], [], timeLeft)
-                endSelect = time.time()
-                howLongInSelect = (endSelect - startedSelect)
-                if whatReady[0] == []:  # Timeout
-                    print("  *        *        *        *        *    Request timed out.")
-                recvPacket, addr = mySocket.recvfrom(1024)  # recvPacket - bytes object representing data received
-                # addr  - address of socket sending data
-                timeReceived = time.time()
-                timeLeft = timeLeft - howLongInSelect
-                if timeLeft <= 0:
-                    print("  *        *        *        *        *    Request timed out (By no remaining time left).")
-
-                else:
-                    # Fetch the ICMP type and code from the received packet
-                    icmpType, icmpCode = recvPacket[20:22]
-
-                    if icmpType == 11:  # Time Exceeded
-                        print("  TTL={:<4} RTT={:<6.0f} ms Type={:<2} Code={:<2} Address={:<15}".format(
-                            ttl,
-                            (timeReceived - pingStartTime) * 1000,
-                            icmpType,
-                            icmpCode,
-                            addr[0]
-                        ))
-                        # Save RTT to rtt_list under "Public Variables".
-                        rtt_list.append((timeReceived - pingStartTime) * 1000)
-
-                        icmpReplyPacket = IcmpHelperLibrary.IcmpPacket_EchoReply(recvPacket)
-                        self.__validateIcmpReplyPacketWithOriginalPingData(icmpReplyPacket)
-                        icmpReplyPacket.printPingResultToConsole(packet_num)
-
-                    elif icmpType == 3:  # Destination Unreachable
-                        print("  TTL={:<4} RTT={:<6.0f} ms Type={:<2} Code={:<2} Address={:<15}".format(
-                            ttl,
-                            (timeReceived - pingStartTime) * 1000,
-                            icmpType,
-                            icmpCode,
-                            addr[0]
-                        ))
-                        # Save RTT to rtt_list under "Public Variables".
-                        rtt_list.append((timeReceived - pingStartTime) * 1000)
-
-                        icmpReplyPacket = IcmpHelperLibrary.IcmpPacket_EchoReply(recvPacket)
-                        self.__validateIcmpReplyPacketWithOriginalPingData(icmpReplyPacket)
-                        icmpReplyPacket.printPingResultToConsole(packet_num)
-
-                    elif icmpType == 0:  # Echo Reply
-                        print("  TTL={:<4} RTT={:<6.0f} ms Type={:<2} Code={:<2} Address={:<15}".format(
-                            ttl,
-                            (timeReceived - pingStartTime) * 1000,
-                            icmpType,
-                            icmpCode,
-                            addr[0]
-                        ))
-                        # Save RTT to rtt_list under "Public Variables".
-                        rtt_list.append((timeReceived - pingStartTime) * 1000)
-
-                        icmpReplyPacket = IcmpHelperLibrary.IcmpPacket_EchoReply(recvPacket)
-                        self.__validateIcmpReplyPacketWithOriginalPingData(icmpReplyPacket)
-                        icmpReplyPacket.printPingResultToConsole(packet_num)
-
-                    else:
-                        print("error")
-            except timeout:
-                print("  *        *        *        *        *    Request timed out (By Exception).")
-            finally:
-                mySocket.close()
-
-        def sendTraceEchoRequest(self, ttl, packet_num):
-            if len(self.__icmpTarget.strip()) <= 0 | len(self.__destinationIpAddress.strip()) <= 0:
-                self.setIcmpTarget("127.0.0.1")
-
-            mySocket = socket(AF_INET, SOCK_RAW, IPPROTO_ICMP)
-            mySocket.settimeout(self.__ipTimeout)
-            mySocket.bind(("", 0))
-            mySocket.setsockopt(IPPROTO_IP, IP_TTL, struct.pack('I', ttl))  # Unsigned int - 4 bytes
-            try:
-                mySocket.sendto(b''.join([self.__header, self.__data]), (self.__destinationIpAddress, 0))
-                timeLeft = 30
-                pingStartTime = time.time()
-                startedSelect = time.time()
-                whatReady = select.select([mySocket], [], [], timeLeft)
-                endSelect = time.time()
-                howLongInSelect = (endSelect - startedSelect)
-                if whatReady[0] == []:  # Timeout
-                    print("  *        *        *        *        *    Request timed out.")
-                recvPacket, addr = mySocket.recvfrom(1024)  # recvPacket - bytes object representing data received
-                # addr  - address of socket sending data
-                timeReceived = time.time()
-                timeLeft = timeLeft - howLongInSelect
-                if timeLeft <= 0:
-                    print("  *        *        *        *        *    Request timed out (By no remaining time left).")
-
-                else:
-                    # Fetch the ICMP type and code from the received packet
-                    icmpType, icmpCode = recvPacket[20:22]
-
-                    # Save RTT to rtt_list under "Public Variables".
-                    global rtt_list
-                    rtt_list.append((timeReceived - pingStartTime) * 1000)
-
-                    if icmpType == 11 and packet_num == 3:  # Time Exceeded
-                        min_rtt = min(rtt_list)
-                        max_rtt = max(rtt_list)
-                        avg_rtt = sum(rtt_list) / len(rtt_list)
-                        print("  TTL=%d        MinRTT=%.0f ms        MaxRTT=%.0f ms        AvgRTT=%.0f ms        Type=%d        Code=%d        %s" %
-                              (
-                                  ttl,
-                                  int(min_rtt),
-                                  math.ceil(max_rtt),
-                                  int(avg_rtt),
-                                  icmpType,
-                                  icmpCode,
-                                  addr[0]
-                              )
-                              )
-                        # Reset rtt_list for next ping.
-                        rtt_list = []
-
-                    elif icmpType == 3 and packet_num == 3:  # Destination Unreachable
-                        min_rtt = min(rtt_list)
-                        max_rtt = max(rtt_list)
-                        avg_rtt = sum(rtt_list) / len(rtt_list)
-                        print(
-                            "  TTL=%d    MinRTT=%.0f ms    MaxRTT=%.0f ms    AvgRTT=%.0f ms    Type=%d    Code=%d    %s" %
-                            (
-                                ttl,
-                                int(min_rtt),
-                                math.ceil(max_rtt),
-                                int(avg_rtt),
-                                icmpType,
-                                icmpCode,
-                                addr[0]
-                            )
-                            )
-                        # Reset rtt_list for next ping.
-                        rtt_list = []
-
-                    elif icmpType == 0 and packet_num == 3:  # Echo Reply
-                        min_rtt = min(rtt_list)
-                        max_rtt = max(rtt_list)
-                        avg_rtt = sum(rtt_list) / len(rtt_list)
-                        print(
-                            "  TTL=%d    MinRTT=%.0f ms    MaxRTT=%.0f ms    AvgRTT=%.0f ms    Type=%d    Code=%d    %s" %
-                            (
-                                ttl,
-                                int(min_rtt),
-                                math.ceil(max_rtt),
-                                int(avg_rtt),
-                                icmpType,
-                                icmpCode,
-                                addr[0]
-                            )
-                        )
-                        # Reset rtt_list for next ping.
-                        rtt_list = []
-
-                        global ping_complete
-                        ping_complete = True  # Set ping_complete to True to cease loop in __sendIcmpTraceRoute
-                        return  # Echo reply is the end and therefore should return
 
-                    else:
-                        return
-            except timeout:
-                print("  *        *        *        *        *    Request timed out (By Exception).")
-            finally:
-                mySocket.close()
 
         def printIcmpPacketHeader_hex(self):
             print("Header Size: ", len(self.__header))
@@ -508,6 +319,8 @@ class IcmpHelperLibrary:
         # ############################################################################################################ #
         __recvPacket = b''
         __isValidResponse = False
+        __ipHeaderLength = 20           # Outer IP header length in bytes, read from the IHL field
+        __structCache = {}              # Format code -> precompiled struct.Struct, shared by every reply
 
         # ############################################################################################################ #
         # IcmpPacket_EchoReply Constructors                                                                            #
@@ -519,6 +332,8 @@ class IcmpHelperLibrary:
         def __init__(self, recvPacket):
             self.__recvPacket = recvPacket
             self.__IcmpIdentifier_isValid = None
+            if len(recvPacket) > 0:
+                self.__ipHeaderLength = (recvPacket[0] & 0x0f) * 4  # IHL counts 32 bit words; options make it > 20
 
         # ############################################################################################################ #
         # IcmpPacket_EchoReply Getters                                                                                 #
@@ -533,7 +348,7 @@ class IcmpHelperLibrary:
             # return struct.unpack("!B", self.__recvPacket[20:20 + bytes])[0]
 
             # Method 2
-            return self.__unpackByFormatAndPosition("B", 20)
+            return self.__unpackByFormatAndPosition("B", self.__ipHeaderLength + 0)
 
         def getIcmpCode(self):
             # Method 1
@@ -541,7 +356,7 @@ class IcmpHelperLibrary:
             # return struct.unpack("!B", self.__recvPacket[21:21 + bytes])[0]
 
             # Method 2
-            return self.__unpackByFormatAndPosition("B", 21)
+            return self.__unpackByFormatAndPosition("B", self.__ipHeaderLength + 1)
 
         def getIcmpHeaderChecksum(self):
             # Method 1
@@ -549,7 +364,7 @@ class IcmpHelperLibrary:
             # return struct.unpack("!H", self.__recvPacket[22:22 + bytes])[0]
 
             # Method 2
-            return self.__unpackByFormatAndPosition("H", 22)
+            return self.__unpackByFormatAndPosition("H", self.__ipHeaderLength + 2)
 
         def getIcmpIdentifier(self):
             # Method 1
@@ -557,7 +372,7 @@ class IcmpHelperLibrary:
             # return struct.unpack("!H", self.__recvPacket[24:24 + bytes])[0]
 
             # Method 2
-            return self.__unpackByFormatAndPosition("H", 24)
+            return self.__unpackByFormatAndPosition("H", self.__ipHeaderLength + 4)
 
         def getIcmpIdentifier_isValid(self):
             # Get a boolean value that indicates whether the reply packet is valid or not.
@@ -569,20 +384,32 @@ class IcmpHelperLibrary:
             # return struct.unpack("!H", self.__recvPacket[26:26 + bytes])[0]
 
             # Method 2
-            return self.__unpackByFormatAndPosition("H", 26)
+            return self.__unpackByFormatAndPosition("H", self.__ipHeaderLength + 6)
 
         def getDateTimeSent(self):
-            # This accounts for bytes 28 through 35 = 64 bits
-            return self.__unpackByFormatAndPosition("d", 28)   # Used to track overall round trip time
-                                                               # time.time() creates a 64 bit value of 8 bytes
+            # This accounts for bytes 28 through 35 = 64 bits (after a 20 byte IP header)
+            return self.__unpackByFormatAndPosition("Q", self.__ipHeaderLength + 8)   # Used to track overall round
+                                                                                     # trip time
+
+        def getQuotedIcmpIdentifier(self):
+            # Time Exceeded and Destination Unreachable messages quote the original IP header followed by the first
+            # 8 bytes of the original ICMP header, so the probe's identifier sits after both.
+            return self.__unpackByFormatAndPosition("H", self.__getQuotedIcmpPosition() + 4)
+
+        def getQuotedIcmpSequenceNumber(self):
+            return self.__unpackByFormatAndPosition("H", self.__getQuotedIcmpPosition() + 6)
+
+        def hasQuotedIcmpHeader(self):
+            # Routers may truncate the quote; the identifier and sequence number need the full 8 byte ICMP header.
+            quotedIpPosition = self.__ipHeaderLength + 8
+            return len(self.__recvPacket) > quotedIpPosition and \
+                len(self.__recvPacket) >= self.__getQuotedIcmpPosition() + 8
+
 
         def getIcmpData(self):
-            # Return raw data, which may include ignored invalid bytes.
-            try:
-                self.__recvPacket[36:].decode('utf-8')
-            except UnicodeDecodeError:
-                return self.__recvPacket[36:].decode('utf-8', errors='ignore')
-            return self.__recvPacket[36:].decode('utf-8')
+            # Return raw data, which may include ignored invalid bytes. Valid UTF-8 decodes the same either way,
+            # so one decode with errors ignored covers both cases.
+            return bytes(self.__recvPacket[self.__ipHeaderLength + 16:]).decode('utf-8', errors='ignore')
 
         def isValidResponse(self):
             return self.__isValidResponse
@@ -609,158 +436,4591 @@ class IcmpHelperLibrary:
         #                                                                                                              #
         # ############################################################################################################ #
         def __unpackByFormatAndPosition(self, formatCode, basePosition):
-            numberOfbytes = struct.calcsize(formatCode)
-            return struct.unpack("!" + formatCode, self.__recvPacket[basePosition:basePosition + numberOfbytes])[0]
+            # Each format is compiled once and read in place, without slicing the packet.
+            unpacker = self.__structCache.get(formatCode)
+            if unpacker is None:
+                unpacker = struct.Struct("!" + formatCode)
+                self.__structCache[formatCode] = unpacker
+            return unpacker.unpack_from(self.__recvPacket, basePosition)[0]
+
+        def __getQuotedIcmpPosition(self):
+            # The quoted IP header starts after the outer IP header and the 8 byte ICMP error header. Its own length
+            # comes from its IHL field (low 4 bits, counted in 32 bit words).
+            quotedIpPosition = self.__ipHeaderLength + 8
+            return quotedIpPosition + (self.__recvPacket[quotedIpPosition] & 0x0f) * 4
 
+    # ################################################################################################################ #
+    # Class IcmpReply                                                                                                  #
+    #                                                                                                                  #
+    # Compact record of a received answer to one of our echo requests: an Echo Reply, or a Time Exceeded or           #
+    # Destination Unreachable that quotes the request. parse() reads every field straight out of the receive buffer    #
+    # with precompiled structs, honouring the IHL of both the outer and the quoted IP header, and keeps no reference   #
+    # to the buffer so it can be reused for the next packet.                                                           #
+    #                                                                                                                  #
+    # timeSent is the send time IcmpEchoRequestTemplate stamped into the probe, read back from the echoed data or from #
+    # the quoted request when the router quoted at least 8 bytes of payload (RFC 1812 routers usually quote more than  #
+    # RFC 792's minimum). Together with probeDestination it makes a reply self-describing, so receivers can compute    #
+    # the RTT without any record of the probe having been kept.                                                        #
+    #                                                                                                                  #
+    # ################################################################################################################ #
+    class IcmpReply:
         # ############################################################################################################ #
-        # IcmpPacket_EchoReply Public Functions                                                                        #
+        # IcmpReply Class Scope Variables                                                                              #
         #                                                                                                              #
         #                                                                                                              #
         #                                                                                                              #
         #                                                                                                              #
         # ############################################################################################################ #
-        def printPingResultToConsole(self, packet_num):
-            # Increment packets_sent or packets_dropped under "Public Variables" depending on the echo reply status.
-            global packets_sent, packets_dropped
-            if self.getIcmpIdentifier_isValid() is True:
-                packets_sent += 1
-            else:
-                packets_dropped += 1
-
-            # After the final echo reply, print cumulative ping data and packet loss data.
-            if packet_num == 3:
-                global rtt_list
-                min_rtt = min(rtt_list)
-                max_rtt = max(rtt_list)
-                avg_rtt = sum(rtt_list) / len(rtt_list)
-                packet_loss = (packets_dropped/(packets_sent+packets_dropped)) * 100
-                print("-----------------------------------------------------------------")
-                print("Ping Statistics")
-                print("-----------------------------------------------------------------")
-                print("  MinRTT=%d ms    MaxRTT=%d ms    AvgRTT=%d ms    PacketLoss=%d" %
-                        (
-                            int(min_rtt),
-                            math.ceil(max_rtt),
-                            int(avg_rtt),
-                            packet_loss
-                        )
-                      )
-                print("-----------------------------------------------------------------")
+        __slots__ = ("address",                 # Address of the host that sent the reply
+                     "icmpType",
+                     "icmpCode",
+                     "packetIdentifier",        # Identifier of the echo request being answered
+                     "packetSequenceNumber",    # Sequence number of the echo request being answered
+                     "timeReceived",            # time.perf_counter_ns() clock, from the kernel timestamp if any
+                     "isValidResponse",         # False when an Echo Reply did not echo the expected data
+                     "isKernelTimestamp",       # False when timeReceived was taken in Python after the read
+                     "timeSent",                # time.perf_counter_ns() stamped into the probe, None if not returned
+                     "probeDestination")        # Address the answered probe was sent to
+
+        __icmpHeaderStruct = struct.Struct("!BBHHH")    # Type, code, checksum, identifier, sequence number
+        __quotedIcmpStruct = struct.Struct("!BxxxHH")   # Quoted type, identifier, sequence number
+        __timeSentStruct = struct.Struct("!Q")          # Send time at the start of the echo request data
+
+        # Echoed send times further than this from timeReceived (an hour, in ns) are not ours: another program's
+        # payload, or a wall clock time.
+        __maxPayloadRtt = 3600 * 1000000000
+
+        # ############################################################################################################ #
+        # IcmpReply Constructors                                                                                       #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def __init__(self, address, icmpType, icmpCode, packetIdentifier, packetSequenceNumber, timeReceived,
+                     isValidResponse=True, isKernelTimestamp=False, timeSent=None, probeDestination=None):
+            self.address = address
+            self.icmpType = icmpType
+            self.icmpCode = icmpCode
+            self.packetIdentifier = packetIdentifier
+            self.packetSequenceNumber = packetSequenceNumber
+            self.timeReceived = timeReceived
+            self.isValidResponse = isValidResponse
+            self.isKernelTimestamp = isKernelTimestamp
+            self.timeSent = timeSent
+            self.probeDestination = probeDestination
+
+        def __repr__(self):
+            return "IcmpReply(address=%r, icmpType=%d, icmpCode=%d, packetIdentifier=%d, packetSequenceNumber=%d)" % \
+                   (self.address, self.icmpType, self.icmpCode, self.packetIdentifier, self.packetSequenceNumber)
+
+        # ############################################################################################################ #
+        # IcmpReply Public Functions                                                                                   #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def matchesSendTime(self, sendTime):
+            # False when the reply answers an earlier probe that used the same identifier and sequence number: it
+            # arrived before sendTime, or it echoes or quotes another send time. A quote too short to carry the send
+            # time is judged by its arrival alone.
+            return self.timeReceived >= sendTime and (self.timeSent is None or self.timeSent == sendTime)
+
+        def getPayloadRtt(self):
+            # RTT in milliseconds from the send time carried in the packet itself, or None when the reply did not
+            # bring one back. Both ends use time.perf_counter_ns(), which on Linux is CLOCK_MONOTONIC and shared by
+            # every process on the host, so the sender and the receiver need not be the same program.
+            if self.timeSent is None:
+                return None
+            rtt = self.timeReceived - self.timeSent
+            if rtt < 0 or rtt > IcmpHelperLibrary.IcmpReply.__maxPayloadRtt:
+                return None
+            return rtt / 1e6
+
+        @staticmethod
+        def parse(recvBuffer, numberOfBytes, address, timeReceived, expectedData=None, isKernelTimestamp=False):
+            # Returns an IcmpReply, or None when the packet does not answer an echo request (our own outgoing
+            # requests, other ICMP traffic, or a quote too short to identify the probe). With expectedData, an Echo
+            # Reply is only valid if its data after the 8 byte send time matches it.
+            if numberOfBytes < 28:
+                return None
+            ipHeaderLength = (recvBuffer[0] & 0x0f) * 4
+            if numberOfBytes < ipHeaderLength + 8:
+                return None
+            icmpType, icmpCode, checksum, packetIdentifier, packetSequenceNumber = \
+                IcmpHelperLibrary.IcmpReply.__icmpHeaderStruct.unpack_from(recvBuffer, ipHeaderLength)
+
+            if icmpType == 0:  # Echo Reply
+                isValidResponse = expectedData is None or \
+                    recvBuffer[ipHeaderLength + 16:numberOfBytes] == expectedData
+                timeSent = None
+                if numberOfBytes >= ipHeaderLength + 16:
+                    timeSent, = IcmpHelperLibrary.IcmpReply.__timeSentStruct.unpack_from(recvBuffer, ipHeaderLength + 8)
+                return IcmpHelperLibrary.IcmpReply(address, icmpType, icmpCode, packetIdentifier, packetSequenceNumber,
+                                                   timeReceived, isValidResponse, isKernelTimestamp, timeSent, address)
 
-                # Reset variables for next ping.
-                rtt_list = []
-                packets_sent = 0
-                packets_dropped = 0
+            if icmpType == 11 or icmpType == 3:  # Time Exceeded, Destination Unreachable
+                quotedIpPosition = ipHeaderLength + 8
+                if numberOfBytes < quotedIpPosition + 20 or recvBuffer[quotedIpPosition + 9] != IPPROTO_ICMP:
+                    return None
+                quotedIcmpPosition = quotedIpPosition + (recvBuffer[quotedIpPosition] & 0x0f) * 4
+                if numberOfBytes < quotedIcmpPosition + 8:
+                    return None
+                quotedType, packetIdentifier, packetSequenceNumber = \
+                    IcmpHelperLibrary.IcmpReply.__quotedIcmpStruct.unpack_from(recvBuffer, quotedIcmpPosition)
+                if quotedType != 8:  # Only quotes of echo requests answer a probe
+                    return None
+                timeSent = None
+                if numberOfBytes >= quotedIcmpPosition + 16:
+                    timeSent, = IcmpHelperLibrary.IcmpReply.__timeSentStruct.unpack_from(recvBuffer,
+                                                                                          quotedIcmpPosition + 8)
+                return IcmpHelperLibrary.IcmpReply(address, icmpType, icmpCode, packetIdentifier, packetSequenceNumber,
+                                                   timeReceived, True, isKernelTimestamp, timeSent,
+                                                   inet_ntoa(recvBuffer[quotedIpPosition + 16:quotedIpPosition + 20]))
+
+            return None
 
     # ################################################################################################################ #
-    # Class IcmpHelperLibrary                                                                                          #
-    #                                                                                                                  #
+    # Class IcmpChecksum                                                                                               #
     #                                                                                                                  #
+    # References:                                                                                                      #
+    # https://www.rfc-editor.org/rfc/rfc1071 (Computing the Internet Checksum)                                         #
+    # https://www.rfc-editor.org/rfc/rfc1624 (Computation of the Internet Checksum via Incremental Update)              #
     #                                                                                                                  #
+    # Checksums are returned in network byte order, ready to pack with format code H after "!".                        #
     #                                                                                                                  #
     # ################################################################################################################ #
+    class IcmpChecksum:
+        # ############################################################################################################ #
+        # IcmpChecksum Private Functions                                                                               #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        @staticmethod
+        def __onesComplementSum(byteData):
+            # The one's complement sum of 16 bit words equals the data read as one big-endian integer modulo
+            # 0xffff, which Python computes in C instead of one loop iteration per word. An odd trailing byte is
+            # padded with a zero byte on the right, as RFC 1071 requires.
+            if len(byteData) % 2 == 1:
+                byteData = bytes(byteData) + b'\x00'
+            value = int.from_bytes(byteData, "big")
+            wordSum = value % 0xffff
+            if wordSum == 0 and value != 0:
+                wordSum = 0xffff                # One's complement sums of non-zero data are never +0
+            return wordSum
+
+        # ############################################################################################################ #
+        # IcmpChecksum Public Functions                                                                                #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        @staticmethod
+        def partialSum(byteData):
+            # One's complement sum of the words in byteData, for callers that precompute the constant part of a
+            # packet and only add the changing words per send.
+            return IcmpHelperLibrary.IcmpChecksum.__onesComplementSum(byteData)
+
+        @staticmethod
+        def calculate(packetAsByteData):
+            # Full checksum of a packet whose checksum field is zero.
+            return ~IcmpHelperLibrary.IcmpChecksum.__onesComplementSum(packetAsByteData) & 0xffff
+
+        @staticmethod
+        def update(checksum, oldWord, newWord):
+            # RFC 1624 equation 3: HC' = ~(~HC + ~m + m'), for one changed 16 bit word.
+            total = (~checksum & 0xffff) + (~oldWord & 0xffff) + newWord
+            total = (total >> 16) + (total & 0xffff)
+            total = (total >> 16) + total
+            return ~total & 0xffff
+
+        @staticmethod
+        def updateBytes(checksum, oldBytes, newBytes):
+            # Equation 3 for a changed run of whole 16 bit words, such as the 8 byte timestamp. oldBytes and
+            # newBytes must have the same even length and start on a word boundary in the packet.
+            return IcmpHelperLibrary.IcmpChecksum.update(checksum,
+                                                         IcmpHelperLibrary.IcmpChecksum.__onesComplementSum(oldBytes),
+                                                         IcmpHelperLibrary.IcmpChecksum.__onesComplementSum(newBytes))
 
     # ################################################################################################################ #
-    # IcmpHelperLibrary Class Scope Variables                                                                          #
+    # Class IcmpEchoRequestTemplate                                                                                    #
     #                                                                                                                  #
+    # A reusable echo request for high-rate probing. The packet lives in one preallocated bytearray; stamp() patches   #
+    # the sequence number, send time and checksum in place and the buffer is handed straight to sendto, so nothing is  #
+    # encoded, packed into new bytes or joined per probe. The payload layout matches IcmpPacket.buildPacket_echoRequest:#
+    # the 8 byte send time is time.perf_counter_ns() as an unsigned network order integer, so RTTs computed from it    #
+    # are monotonic. stampBurstBuffer() stamps a pool of copies instead, one per probe of the largest burst so far, so #
+    # a whole burst can be stamped before it is sent.                                                                  #
     #                                                                                                                  #
+    # ################################################################################################################ #
+    class IcmpEchoRequestTemplate:
+        # ############################################################################################################ #
+        # IcmpEchoRequestTemplate Class Scope Variables                                                                #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        __buffer = None                 # bytearray holding the ICMP header followed by the data
+        __burstBuffers = None           # Copies of __buffer for stampBurstBuffer, grown to the largest burst
+        __constantSum = 0               # One's complement sum of every word that never changes (type/code, id, data)
+        __packetIdentifier = 0
+        __packetSequenceNumber = 0
+
+        # ############################################################################################################ #
+        # IcmpEchoRequestTemplate Constructors                                                                         #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def __init__(self, packetIdentifier, dataEncoded=None):
+            if dataEncoded is None:
+                dataEncoded = IcmpHelperLibrary.IcmpPacket.ECHO_REQUEST_DATA_ENCODED
+            self.__packetIdentifier = packetIdentifier
+            self.__packetSequenceNumber = 0
+
+            # Header (8 bytes), send time (8 bytes), then the payload. Checksum, sequence number and send time
+            # start out zero and are the only fields stamp() touches.
+            self.__buffer = bytearray(16 + len(dataEncoded))
+            struct.pack_into("!BBHHH", self.__buffer, 0, 8, 0, 0, packetIdentifier, 0)
+            self.__buffer[16:] = dataEncoded
+            self.__burstBuffers = []
+            self.__constantSum = IcmpHelperLibrary.IcmpChecksum.partialSum(self.__buffer)
+
+        # ############################################################################################################ #
+        # IcmpEchoRequestTemplate Getters                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def getBuffer(self):
+            return self.__buffer
+
+        def getPacketIdentifier(self):
+            return self.__packetIdentifier
+
+        def getPacketSequenceNumber(self):
+            return self.__packetSequenceNumber
+
+        # ############################################################################################################ #
+        # IcmpEchoRequestTemplate Public Functions                                                                     #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def stamp(self, packetSequenceNumber, sendTime=None):
+            # Patch the sequence number and send time for the next probe and return the buffer, ready to send.
+            # sendTime (time.perf_counter_ns()) defaults to now; callers that record a probe's send time pass that
+            # one, so the time echoed back identifies the probe.
+            self.__stampInto(self.__buffer, packetSequenceNumber, sendTime)
+            return self.__buffer
+
+        def stampBurstBuffer(self, burstIndex, packetSequenceNumber, sendTime=None):
+            # Stamp and return the burstIndex-th pooled buffer. Unlike stamp(), every probe of a burst gets its own
+            # buffer, so a whole burst can be stamped before it is sent; the buffers are reused by the next burst.
+            burstBuffers = self.__burstBuffers
+            while len(burstBuffers) <= burstIndex:
+                burstBuffers.append(bytearray(self.__buffer))
+            self.__stampInto(burstBuffers[burstIndex], packetSequenceNumber, sendTime)
+            return burstBuffers[burstIndex]
+
+        # ############################################################################################################ #
+        # IcmpEchoRequestTemplate Private Functions                                                                    #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def __stampInto(self, buffer, packetSequenceNumber, sendTime):
+            # The checksum is the precomputed constant sum plus the changed words (RFC 1624), so the payload is
+            # never summed again.
+            self.__packetSequenceNumber = packetSequenceNumber
+            # The send time is time.perf_counter_ns() in network byte order, read back by IcmpReply.parse as timeSent.
+            # Its four 16 bit words sum to sendTime % 0xffff in one's complement arithmetic, so the checksum needs
+            # no read-back either.
+            if sendTime is None:
+                sendTime = time.perf_counter_ns()
+            struct.pack_into("!HQ", buffer, 6, packetSequenceNumber, sendTime)
+
+            total = self.__constantSum + packetSequenceNumber + sendTime % 0xffff
+            total = (total >> 16) + (total & 0xffff)
+            total = (total >> 16) + total
+            struct.pack_into("!H", buffer, 2, ~total & 0xffff)
+
+    # ################################################################################################################ #
+    # Class ResolverCache                                                                                              #
     #                                                                                                                  #
+    # Thread-safe cache of host name -> IPv4 address lookups. Entries expire after expirySeconds (gethostbyname does   #
+    # not report the DNS record's TTL, so the expiry is configured) and the least recently used entry is evicted once  #
+    # maxEntries is reached. IP address literals are returned as-is and never cached. Lookups that miss run on the     #
+    # cache's own thread pool for resolveMany and resolveAsync, so a slow resolver never blocks probing.               #
     #                                                                                                                  #
     # ################################################################################################################ #
-    __DEBUG_IcmpHelperLibrary = False                 # Allows for debug output
+    class ResolverCache:
+        # ############################################################################################################ #
+        # ResolverCache Class Scope Variables                                                                          #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        __maxEntries = 4096
+        __expirySeconds = 300
+        __maxWorkers = 16               # Threads resolving concurrently for resolveMany and resolveAsync
+        __entries = None                # OrderedDict host -> (address, expiry time), least recently used first
+        __lock = None
+        __executor = None               # ThreadPoolExecutor, created on first concurrent lookup
+        __hits = 0
+        __misses = 0
+
+        # ############################################################################################################ #
+        # ResolverCache Constructors                                                                                   #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def __init__(self, maxEntries=4096, expirySeconds=300, maxWorkers=16):
+            self.__maxEntries = maxEntries
+            self.__expirySeconds = expirySeconds
+            self.__maxWorkers = maxWorkers
+            self.__entries = collections.OrderedDict()
+            self.__lock = threading.Lock()
+            self.__executor = None
+            self.__hits = 0
+            self.__misses = 0
+
+        # ############################################################################################################ #
+        # ResolverCache Getters                                                                                        #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def getHits(self):
+            return self.__hits
+
+        def getMisses(self):
+            return self.__misses
+
+        def getSize(self):
+            return len(self.__entries)
+
+        # ############################################################################################################ #
+        # ResolverCache Private Functions                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def __lookupCached(self, host):
+            # Returns the cached address, or None on a miss or an expired entry.
+            try:
+                inet_aton(host)
+                if host.count(".") == 3:
+                    return host                 # Already a dotted quad, nothing to resolve
+            except OSError:
+                pass
+            with self.__lock:
+                entry = self.__entries.get(host)
+                if entry is not None and entry[1] > time.monotonic():
+                    self.__entries.move_to_end(host)
+                    self.__hits += 1
+                    return entry[0]
+            return None
+
+        def __getExecutor(self):
+            with self.__lock:
+                if self.__executor is None:
+                    self.__executor = concurrent.futures.ThreadPoolExecutor(self.__maxWorkers)
+                return self.__executor
+
+        # ############################################################################################################ #
+        # ResolverCache Public Functions                                                                               #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def resolve(self, host):
+            # Blocking lookup through the cache. Raises socket.gaierror like gethostbyname when the host is unknown;
+            # failures are not cached.
+            destinationIpAddress = self.__lookupCached(host)
+            if destinationIpAddress is not None:
+                return destinationIpAddress
+
+            destinationIpAddress = gethostbyname(host)      # Outside the lock, so other lookups are not held up
+            with self.__lock:
+                self.__misses += 1
+                self.__entries[host] = (destinationIpAddress, time.monotonic() + self.__expirySeconds)
+                self.__entries.move_to_end(host)
+                while len(self.__entries) > self.__maxEntries:
+                    self.__entries.popitem(last=False)
+            return destinationIpAddress
+
+        def resolveMany(self, hosts):
+            # Resolve every host concurrently on the cache's thread pool. Returns a dict host -> address, with None
+            # for hosts that could not be resolved.
+            def resolveOrNone(host):
+                try:
+                    return self.resolve(host)
+                except OSError:
+                    return None
+            hosts = list(hosts)
+            return dict(zip(hosts, self.__getExecutor().map(resolveOrNone, hosts)))
+
+        async def resolveAsync(self, host):
+            # Cache hits return without leaving the event loop; misses are resolved on the thread pool.
+            destinationIpAddress = self.__lookupCached(host)
+            if destinationIpAddress is not None:
+                return destinationIpAddress
+            return await asyncio.get_running_loop().run_in_executor(self.__getExecutor(), self.resolve, host)
+
+        def clear(self):
+            with self.__lock:
+                self.__entries.clear()
 
     # ################################################################################################################ #
-    # IcmpHelperLibrary Private Functions                                                                              #
-    #                                                                                                                  #
+    # Class RttEstimator                                                                                               #
     #                                                                                                                  #
+    # References:                                                                                                      #
+    # https://www.rfc-editor.org/rfc/rfc6298 (Computing TCP's Retransmission Timer)                                    #
     #                                                                                                                  #
+    # Adaptive probe timeouts. A smoothed RTT and RTT variance are kept per (destination, TTL), per destination (from  #
+    # replies sent by the destination itself) and across all samples, and a probe waits SRTT + 4 * RTTVAR of the most #
+    # specific estimate available, clamped to [minimumTimeout, maximumTimeout]. Times are in seconds. The least        #
+    # recently used destinations are forgotten beyond maxDestinations, so memory stays bounded in batch runs.          #
     #                                                                                                                  #
     # ################################################################################################################ #
-    def __sendIcmpEchoRequest(self, host):
-        print("sendIcmpEchoRequest Started...") if self.__DEBUG_IcmpHelperLibrary else 0
-
-        print_ping_target = 0
-        for i in range(4):
-            # Build packet
-            icmpPacket = IcmpHelperLibrary.IcmpPacket()
+    class RttEstimator:
+        # ############################################################################################################ #
+        # RttEstimator Class Scope Variables                                                                           #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        __minimumTimeout = 0.2
+        __maximumTimeout = 30
+        __initialTimeout = 1.0          # Used before any RTT has been measured
+        __maxDestinations = 65536
+        __destinations = None           # OrderedDict destination -> {TTL: [srtt, rttvar]}, TTL 0 is the destination
+        __overall = None                # [srtt, rttvar] over every sample, None until the first one
+        __lock = None
 
-            randomIdentifier = (os.getpid() & 0xffff)  # Get as 16 bit number - Limit based on ICMP header standards
-            # Some PIDs are larger than 16 bit
+        # ############################################################################################################ #
+        # RttEstimator Constructors                                                                                    #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def __init__(self, minimumTimeout=0.2, maximumTimeout=30, initialTimeout=1.0, maxDestinations=65536):
+            self.__minimumTimeout = minimumTimeout
+            self.__maximumTimeout = maximumTimeout
+            self.__initialTimeout = initialTimeout
+            self.__maxDestinations = maxDestinations
+            self.__destinations = collections.OrderedDict()
+            self.__overall = None
+            self.__lock = threading.Lock()
 
-            packetIdentifier = randomIdentifier
-            packetSequenceNumber = i
+        # ############################################################################################################ #
+        # RttEstimator Getters                                                                                         #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def getTimeout(self, destinationIpAddress, ttl):
+            # Seconds to wait for a probe to destinationIpAddress with this TTL. An unmeasured hop falls back to
+            # the destination's estimate (hops before it are rarely slower), then to the overall one.
+            with self.__lock:
+                estimates = self.__destinations.get(destinationIpAddress)
+                estimate = None
+                if estimates is not None:
+                    estimate = estimates.get(ttl)
+                    if estimate is None:
+                        estimate = estimates.get(0)
+                if estimate is None:
+                    estimate = self.__overall
+                if estimate is None:
+                    timeout = self.__initialTimeout
+                else:
+                    timeout = estimate[0] + 4 * estimate[1]
+            return min(max(timeout, self.__minimumTimeout), self.__maximumTimeout)
 
-            icmpPacket.buildPacket_echoRequest(packetIdentifier, packetSequenceNumber)  # Build ICMP for IP payload
-            icmpPacket.setIcmpTarget(host)
-            if print_ping_target == 0:
-                icmpPacket.printPingTarget()  # Call printPingTarget() to print target details.
-                print_ping_target += 1
-            icmpPacket.sendPingEchoRequest(30, i)  # Build IP
+        def getSmoothedRtt(self, destinationIpAddress, ttl=0):
+            # Smoothed RTT in seconds for one hop (or the destination with TTL 0), None if never measured.
+            with self.__lock:
+                estimate = self.__destinations.get(destinationIpAddress, {}).get(ttl)
+                return None if estimate is None else estimate[0]
 
-            icmpPacket.printIcmpPacketHeader_hex() if self.__DEBUG_IcmpHelperLibrary else 0
-            icmpPacket.printIcmpPacket_hex() if self.__DEBUG_IcmpHelperLibrary else 0
-            # we should be confirming values are correct, such as identifier and sequence number and data
+        # ############################################################################################################ #
+        # RttEstimator Private Functions                                                                               #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def __updateEstimate(self, estimate, rtt):
+            # RFC 6298 section 2: the first sample sets SRTT = R and RTTVAR = R / 2, later samples are smoothed with
+            # alpha = 1/8 and beta = 1/4.
+            if estimate is None:
+                return [rtt, rtt / 2]
+            estimate[1] = 0.75 * estimate[1] + 0.25 * abs(estimate[0] - rtt)
+            estimate[0] = 0.875 * estimate[0] + 0.125 * rtt
+            return estimate
 
-    def __sendIcmpTraceRoute(self, host):
-        print("sendIcmpTraceRoute Started...") if self.__DEBUG_IcmpHelperLibrary else 0
-        print_ping_target = 0
-        for ttl in range(1, 256):
-            # Check ping_complete under "Public Variables" to determine if another increase in TTL is required.
-            global ping_complete
-            if ping_complete is False:
-                for i in range(4):
-                    # Build packet
-                    icmpPacket = IcmpHelperLibrary.IcmpPacket()
-
-                    randomIdentifier = (
-                                os.getpid() & 0xffff)  # Get as 16 bit number - Limit based on ICMP header standards
-                    # Some PIDs are larger than 16 bit
-
-                    packetIdentifier = randomIdentifier
-                    packetSequenceNumber = i
-
-                    icmpPacket.buildPacket_echoRequest(packetIdentifier,
-                                                       packetSequenceNumber)  # Build ICMP for IP payload
-                    icmpPacket.setIcmpTarget(host)
-                    if print_ping_target == 0:
-                        icmpPacket.printTracerouteTarget()  # Call printTracerouteTarget() to print target details.
-                        print_ping_target += 1
-                    icmpPacket.sendTraceEchoRequest(ttl, i)  # Build IP
-
-                    icmpPacket.printIcmpPacketHeader_hex() if self.__DEBUG_IcmpHelperLibrary else 0
-                    icmpPacket.printIcmpPacket_hex() if self.__DEBUG_IcmpHelperLibrary else 0
-                    # we should be confirming values are correct, such as identifier and sequence number and data
-
-        # Signal the traceroute target by printing the target's name and IP address.
-        print("-------------------------------------------------------------------------------------------------------------------------")
-        print("Traceroute complete.")
-        print("-------------------------------------------------------------------------------------------------------------------------")
+        # ############################################################################################################ #
+        # RttEstimator Public Functions                                                                                #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def addSample(self, destinationIpAddress, ttl, rtt, isDestination=False):
+            # Record a measured RTT in seconds. isDestination marks replies sent by the destination itself (Echo
+            # Reply), which also update the per destination estimate.
+            with self.__lock:
+                estimates = self.__destinations.get(destinationIpAddress)
+                if estimates is None:
+                    estimates = {}
+                    self.__destinations[destinationIpAddress] = estimates
+                    while len(self.__destinations) > self.__maxDestinations:
+                        self.__destinations.popitem(last=False)
+                else:
+                    self.__destinations.move_to_end(destinationIpAddress)
+                estimates[ttl] = self.__updateEstimate(estimates.get(ttl), rtt)
+                if isDestination:
+                    estimates[0] = self.__updateEstimate(estimates.get(0), rtt)
+                self.__overall = self.__updateEstimate(self.__overall, rtt)
 
     # ################################################################################################################ #
-    # IcmpHelperLibrary Public Functions                                                                               #
-    #                                                                                                                  #
+    # Class ProbePacer                                                                                                 #
     #                                                                                                                  #
+    # References:                                                                                                      #
+    # https://www.rfc-editor.org/rfc/rfc1812#section-4.3.2.8 (Requirements for IP Version 4 Routers: Rate Limiting)    #
     #                                                                                                                  #
+    # Token bucket probe pacing. Routers rate-limit the ICMP errors they generate, often to about one per second, and  #
+    # a probe they do not answer costs a full timeout. Every probe takes a token from three buckets: a global one, one #
+    # for its destination and one for the hop it is expected to reach - the router that last answered that             #
+    # (destination, TTL), or the TTL itself until one has. Rates are probes per second, 0 for no limit, and each       #
+    # bucket holds up to its burst of tokens. A probe that finds a bucket empty is scheduled for when the bucket       #
+    # refills rather than refused, and the time probes spend waiting is counted so it can be weighed against what the  #
+    # pacing saves. The least recently used buckets are forgotten beyond maxBuckets.                                   #
     #                                                                                                                  #
     # ################################################################################################################ #
-    def sendPing(self, targetHost):
-        print("ping Started...") if self.__DEBUG_IcmpHelperLibrary else 0
-        self.__sendIcmpEchoRequest(targetHost)
+    class ProbePacer:
+        # ############################################################################################################ #
+        # ProbePacer Class Scope Variables                                                                             #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        __limits = None                 # Bucket kind -> (rate, burst)
+        __maxBuckets = 65536
+        __buckets = None                # OrderedDict (kind, key) -> [tokens, time refilled]; tokens < 0 is debt
+        __hopAddresses = None           # OrderedDict (destination, TTL) -> address that last answered it
+        __probesPaced = 0
+        __probesDelayed = 0
+        __totalWait = 0.0
+        __maxWait = 0.0
+        __waitByKind = None             # Bucket kind -> seconds of waiting it caused
+        __lock = None
 
-    def traceRoute(self, targetHost):
-        print("traceRoute Started...") if self.__DEBUG_IcmpHelperLibrary else 0
-        self.__sendIcmpTraceRoute(targetHost)
+        # ############################################################################################################ #
+        # ProbePacer Constructors                                                                                      #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def __init__(self, globalRate=0, destinationRate=0, hopRate=0, globalBurst=64, destinationBurst=8,
+                     hopBurst=4, maxBuckets=65536):
+            for rate, burst in [(globalRate, globalBurst), (destinationRate, destinationBurst), (hopRate, hopBurst)]:
+                if rate < 0 or burst < 1:
+                    raise ValueError("rates must not be negative and bursts must be at least 1")
+            self.__limits = {"global": (globalRate, globalBurst), "destination": (destinationRate, destinationBurst),
+                             "hop": (hopRate, hopBurst)}
+            self.__maxBuckets = maxBuckets
+            self.__buckets = collections.OrderedDict()
+            self.__hopAddresses = collections.OrderedDict()
+            self.__probesPaced = 0
+            self.__probesDelayed = 0
+            self.__totalWait = 0.0
+            self.__maxWait = 0.0
+            self.__waitByKind = {"global": 0.0, "destination": 0.0, "hop": 0.0}
+            self.__lock = threading.Lock()
 
+        # ############################################################################################################ #
+        # ProbePacer Getters                                                                                           #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def getGlobalRate(self):
+            return self.__limits["global"][0]
 
-# #################################################################################################################### #
-# main()                                                                                                               #
-#                                                                                                                      #
-#                                                                                                                      #
-#                                                                                                                      #
-#                                                                                                                      #
-# #################################################################################################################### #
-def main():
-    icmpHelperPing = IcmpHelperLibrary()
+        def getDestinationRate(self):
+            return self.__limits["destination"][0]
+
+        def getHopRate(self):
+            return self.__limits["hop"][0]
+
+        def getExpectedHop(self, destinationIpAddress, ttl):
+            # The router that last answered a probe to destinationIpAddress with this TTL, None if none has.
+            with self.__lock:
+                return self.__hopAddresses.get((destinationIpAddress, ttl))
+
+        def getStatistics(self):
+            with self.__lock:
+                return IcmpHelperLibrary.PacerStatistics(self.__probesPaced, self.__probesDelayed, self.__totalWait,
+                                                         self.__maxWait, self.__waitByKind["global"],
+                                                         self.__waitByKind["destination"], self.__waitByKind["hop"])
+
+        # ############################################################################################################ #
+        # ProbePacer Private Functions                                                                                 #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def __takeToken(self, kind, key, timeNow):
+            # Charge one probe to a bucket and return the seconds until the bucket is out of debt again, which is
+            # when the probe may be sent. Called with the lock held.
+            rate, burst = self.__limits[kind]
+            if rate <= 0:
+                return 0.0
+            bucket = self.__buckets.get((kind, key))
+            if bucket is None:
+                bucket = [burst, timeNow]
+                self.__buckets[(kind, key)] = bucket
+                while len(self.__buckets) > self.__maxBuckets:
+                    self.__buckets.popitem(last=False)
+            else:
+                self.__buckets.move_to_end((kind, key))
+            bucket[0] = min(burst, bucket[0] + (timeNow - bucket[1]) * rate) - 1
+            bucket[1] = timeNow
+            return max(0.0, -bucket[0] / rate)
+
+        # ############################################################################################################ #
+        # ProbePacer Public Functions                                                                                  #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def reserve(self, destinationIpAddress, ttl):
+            # Take tokens for one probe and return the seconds the caller must wait before sending it. Tokens are
+            # taken at once, so probes reserved back to back are spread out at the rate of the tightest bucket.
+            timeNow = time.perf_counter()
+            with self.__lock:
+                expectedHop = self.__hopAddresses.get((destinationIpAddress, ttl))
+                waits = {"global": self.__takeToken("global", None, timeNow),
+                         "destination": self.__takeToken("destination", destinationIpAddress, timeNow),
+                         "hop": self.__takeToken("hop", ttl if expectedHop is None else expectedHop, timeNow)}
+                kind = max(waits, key=waits.get)
+                wait = waits[kind]
+                self.__probesPaced += 1
+                if wait > 0:
+                    self.__probesDelayed += 1
+                    self.__totalWait += wait
+                    self.__maxWait = max(self.__maxWait, wait)
+                    self.__waitByKind[kind] += wait
+            return wait
+
+        def acquire(self, destinationIpAddress, ttl):
+            # Blocking form of reserve: sleeps until the probe may be sent and returns the seconds waited.
+            wait = self.reserve(destinationIpAddress, ttl)
+            if wait > 0:
+                time.sleep(wait)
+            return wait
+
+        def addHopAddress(self, destinationIpAddress, ttl, address):
+            # Record the router that answered a probe, so later probes to the same (destination, TTL) are paced
+            # against that router's bucket, shared with every other path through it.
+            with self.__lock:
+                self.__hopAddresses[(destinationIpAddress, ttl)] = address
+                self.__hopAddresses.move_to_end((destinationIpAddress, ttl))
+                while len(self.__hopAddresses) > self.__maxBuckets:
+                    self.__hopAddresses.popitem(last=False)
+
+    # ################################################################################################################ #
+    # Class ProbeMetrics                                                                                               #
+    #                                                                                                                  #
+    # References:                                                                                                      #
+    # https://prometheus.io/docs/instrumenting/exposition_formats/ (Prometheus text exposition format)                 #
+    #                                                                                                                  #
+    # Counters and timing histograms for the probe hot path, cheap enough to leave on under load. Sessions count every #
+    # probe they send and every reply they read, by ICMP type and code, and time their send system calls, their        #
+    # select waits and the reading and parsing of each reply. Helpers add the time spent building probes, the probes   #
+    # that timed out, and the replies read that answered none of their probes. Nothing is measured unless a session    #
+    # or helper is given a ProbeMetrics; without one each hot path pays a single None check. Timings fall into fixed   #
+    # power of two buckets from 1 microsecond to 16.8 seconds, so one observation is one integer increment. Hooks are  #
+    # called with a ProbeEvent for every probe sent, reply read, probe timed out and reply mismatched, for tracing;    #
+    # they run on the thread that caused the event and should return quickly. One ProbeMetrics can be shared by every  #
+    # session, helper and thread in the process, and exported as Prometheus text or JSON.                              #
+    #                                                                                                                  #
+    # ################################################################################################################ #
+    class ProbeMetrics:
+        # ############################################################################################################ #
+        # ProbeMetrics Class Scope Variables                                                                           #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        # Timing name -> (Prometheus metric name, help text)
+        __timingMetrics = {"build": ("probe_build_seconds", "Time spent building echo requests."),
+                           "send": ("send_seconds", "Time spent in send system calls, per probe."),
+                           "select": ("select_wait_seconds", "Time spent waiting in select for replies."),
+                           "receive": ("reply_receive_seconds", "Time spent reading and parsing each reply.")}
+        __bucketCount = 25              # Upper bounds of 1 us * 2**i for i below this, then +Inf
+        __probesSent = 0
+        __replies = None                # (ICMP type, code) -> replies read
+        __timeouts = 0
+        __mismatchedReplies = 0
+        __timings = None                # Timing name -> [bucket counts, observations, total ns, max ns]
+        __hooks = None                  # Callables taking a ProbeEvent
+        __lock = None
+
+        # ############################################################################################################ #
+        # ProbeMetrics Constructors                                                                                    #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def __init__(self):
+            self.__hooks = []
+            self.__lock = threading.Lock()
+            self.reset()
+
+        # ############################################################################################################ #
+        # ProbeMetrics Getters                                                                                         #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def getProbesSent(self):
+            return self.__probesSent
+
+        def getReplyCounts(self):
+            # (ICMP type, code) -> number of replies read.
+            with self.__lock:
+                return dict(self.__replies)
+
+        def getTimeouts(self):
+            return self.__timeouts
+
+        def getMismatchedReplies(self):
+            return self.__mismatchedReplies
+
+        def getTimingNames(self):
+            return list(IcmpHelperLibrary.ProbeMetrics.__timingMetrics)
+
+        def getTimingSummary(self, name):
+            # TimingSummary of one timing; raises KeyError for a name not in getTimingNames().
+            with self.__lock:
+                bucketCounts, count, totalTime, maxTime = self.__timings[name]
+            if count == 0:
+                return IcmpHelperLibrary.TimingSummary(0, 0.0, None, None)
+            return IcmpHelperLibrary.TimingSummary(count, totalTime / 1e9, totalTime / count / 1e9, maxTime / 1e9)
+
+        def getSnapshot(self):
+            # Every counter and histogram as plain dicts and lists, as exportJson writes them. Histogram buckets are
+            # [upper bound in seconds, cumulative count] pairs, the last bound None for +Inf.
+            with self.__lock:
+                timings = {}
+                for name, (bucketCounts, count, totalTime, maxTime) in self.__timings.items():
+                    buckets = []
+                    cumulativeCount = 0
+                    for index, bucketCount in enumerate(bucketCounts):
+                        cumulativeCount += bucketCount
+                        buckets.append([self.__bucketBound(index), cumulativeCount])
+                    timings[name] = {"count": count, "sum": totalTime / 1e9, "max": maxTime / 1e9,
+                                     "buckets": buckets}
+                return {"probesSent": self.__probesSent,
+                        "replies": [{"icmpType": icmpType, "icmpCode": icmpCode, "count": count}
+                                    for (icmpType, icmpCode), count in sorted(self.__replies.items())],
+                        "timeouts": self.__timeouts, "mismatchedReplies": self.__mismatchedReplies,
+                        "timings": timings}
+
+        # ############################################################################################################ #
+        # ProbeMetrics Private Functions                                                                               #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def __bucketBound(self, index):
+            # Upper bound of a histogram bucket in seconds, None for the last (+Inf).
+            return 1e-6 * (1 << index) if index < self.__bucketCount else None
+
+        def __callHooks(self, kind, destinationIpAddress, ttl, packetSequenceNumber, icmpReply):
+            probeEvent = IcmpHelperLibrary.ProbeEvent(
+                kind, destinationIpAddress, ttl, packetSequenceNumber, None if icmpReply is None else icmpReply.address,
+                None if icmpReply is None else icmpReply.icmpType, None if icmpReply is None else icmpReply.icmpCode,
+                time.perf_counter_ns())
+            for hook in self.__hooks:
+                hook(probeEvent)
+
+        # ############################################################################################################ #
+        # ProbeMetrics Public Functions                                                                                #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def addHook(self, hook):
+            # Call hook(probeEvent) for every event from now on.
+            with self.__lock:
+                self.__hooks = self.__hooks + [hook]    # Copied, so events in flight iterate the old list unlocked
+
+        def removeHook(self, hook):
+            with self.__lock:
+                self.__hooks = [registeredHook for registeredHook in self.__hooks if registeredHook is not hook]
+
+        def addProbesSent(self, probes):
+            # probes are the (packetBytes, destinationIpAddress, ttl) entries actually sent.
+            with self.__lock:
+                self.__probesSent += len(probes)
+            if len(self.__hooks) > 0:
+                for packetBytes, destinationIpAddress, ttl in probes:
+                    self.__callHooks("sent", destinationIpAddress, ttl, (packetBytes[6] << 8) | packetBytes[7], None)
+
+        def addReplies(self, icmpReplies):
+            with self.__lock:
+                for icmpReply in icmpReplies:
+                    replyKey = (icmpReply.icmpType, icmpReply.icmpCode)
+                    self.__replies[replyKey] = self.__replies.get(replyKey, 0) + 1
+            if len(self.__hooks) > 0:
+                for icmpReply in icmpReplies:
+                    self.__callHooks("reply", icmpReply.probeDestination, None, icmpReply.packetSequenceNumber,
+                                     icmpReply)
+
+        def addTimeout(self, destinationIpAddress, ttl, packetSequenceNumber):
+            with self.__lock:
+                self.__timeouts += 1
+            if len(self.__hooks) > 0:
+                self.__callHooks("timeout", destinationIpAddress, ttl, packetSequenceNumber, None)
+
+        def addMismatchedReply(self, icmpReply):
+            # A reply read while waiting for probes that answered none of them: a late or duplicate reply, or
+            # another program's traffic.
+            with self.__lock:
+                self.__mismatchedReplies += 1
+            if len(self.__hooks) > 0:
+                self.__callHooks("mismatch", icmpReply.probeDestination, None, icmpReply.packetSequenceNumber,
+                                 icmpReply)
+
+        def addTiming(self, name, nanoseconds, count=1):
+            # Record count operations that took nanoseconds in total, each as taking an equal share of it.
+            share = nanoseconds // count if count > 1 else nanoseconds
+            # The smallest i with share <= 1 us * 2**i, clamped to the +Inf bucket.
+            index = ((share + 999) // 1000 - 1).bit_length() if share > 1000 else 0
+            if index > self.__bucketCount:
+                index = self.__bucketCount
+            with self.__lock:
+                timing = self.__timings[name]
+                timing[0][index] += count
+                timing[1] += count
+                timing[2] += nanoseconds
+                if share > timing[3]:
+                    timing[3] = share
+
+        def reset(self):
+            with self.__lock:
+                self.__probesSent = 0
+                self.__replies = {}
+                self.__timeouts = 0
+                self.__mismatchedReplies = 0
+                self.__timings = {name: [[0] * (self.__bucketCount + 1), 0, 0, 0]
+                                  for name in IcmpHelperLibrary.ProbeMetrics.__timingMetrics}
+
+        def exportJson(self):
+            return json.dumps(self.getSnapshot(), indent=2)
+
+        def exportPrometheus(self, prefix="icmp"):
+            # The metrics in the Prometheus text exposition format, every name starting with prefix and "_".
+            snapshot = self.getSnapshot()
+            lines = []
+
+            def addMetric(name, metricType, helpText):
+                lines.append("# HELP %s_%s %s" % (prefix, name, helpText))
+                lines.append("# TYPE %s_%s %s" % (prefix, name, metricType))
+
+            addMetric("probes_sent_total", "counter", "Echo requests sent.")
+            lines.append("%s_probes_sent_total %d" % (prefix, snapshot["probesSent"]))
+            addMetric("replies_total", "counter", "Replies read, by ICMP type and code.")
+            for reply in snapshot["replies"]:
+                lines.append('%s_replies_total{type="%d",code="%d"} %d' % (prefix, reply["icmpType"],
+                                                                           reply["icmpCode"], reply["count"]))
+            addMetric("probe_timeouts_total", "counter", "Probes that timed out unanswered.")
+            lines.append("%s_probe_timeouts_total %d" % (prefix, snapshot["timeouts"]))
+            addMetric("mismatched_replies_total", "counter", "Replies read that answered none of the probes waited on.")
+            lines.append("%s_mismatched_replies_total %d" % (prefix, snapshot["mismatchedReplies"]))
+            for name, (metricName, helpText) in IcmpHelperLibrary.ProbeMetrics.__timingMetrics.items():
+                timing = snapshot["timings"][name]
+                addMetric(metricName, "histogram", helpText)
+                for bound, cumulativeCount in timing["buckets"]:
+                    lines.append('%s_%s_bucket{le="%s"} %d' % (prefix, metricName,
+                                                               "+Inf" if bound is None else "%.9g" % bound,
+                                                               cumulativeCount))
+                lines.append("%s_%s_sum %.9g" % (prefix, metricName, timing["sum"]))
+                lines.append("%s_%s_count %d" % (prefix, metricName, timing["count"]))
+            return "\n".join(lines) + "\n"
+
+    # ################################################################################################################ #
+    # Class LatencyHistogram                                                                                           #
+    #                                                                                                                  #
+    # References:                                                                                                      #
+    # https://hdrhistogram.github.io/HdrHistogram/ (HdrHistogram bucket layout)                                        #
+    #                                                                                                                  #
+    # Streaming RTT histogram in the HdrHistogram log-linear layout. RTTs are recorded in whole microseconds; values   #
+    # below 2^subBucketBits microseconds get a bucket each and every power of two above that is split into             #
+    # 2^(subBucketBits - 1) equal buckets, so any percentile is within 2^-(subBucketBits - 1) (0.8% by default) of the #
+    # true value. Counts live in a dict keyed by bucket index, which holds at most one entry per bucket up to          #
+    # highestRtt (3328 by default) and usually far fewer. Adding an RTT is O(1), and histograms with the same layout   #
+    # merge exactly, so workers can each keep one and combine them at the end. RTTs are in milliseconds.               #
+    #                                                                                                                  #
+    # ################################################################################################################ #
+    class LatencyHistogram:
+        # ############################################################################################################ #
+        # LatencyHistogram Class Scope Variables                                                                       #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        __subBucketBits = 8
+        __subBucketHalfBits = 7
+        __highestValue = 0              # Largest recordable value in microseconds, larger RTTs are clamped to it
+        __counts = None                 # Bucket index -> number of RTTs recorded in it
+        __count = 0
+        __sum = 0.0
+        __minRtt = None                 # Exact, not bucketed
+        __maxRtt = None
+
+        # ############################################################################################################ #
+        # LatencyHistogram Constructors                                                                                #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def __init__(self, subBucketBits=8, highestRtt=3600000):
+            self.__subBucketBits = subBucketBits
+            self.__subBucketHalfBits = subBucketBits - 1
+            self.__highestValue = int(highestRtt * 1000)
+            self.reset()
+
+        # ############################################################################################################ #
+        # LatencyHistogram Getters                                                                                     #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def getCount(self):
+            return self.__count
+
+        def getMinRtt(self):
+            return self.__minRtt
+
+        def getMaxRtt(self):
+            return self.__maxRtt
+
+        def getAvgRtt(self):
+            return self.__sum / self.__count if self.__count > 0 else None
+
+        def getPercentile(self, percentile):
+            # The highest RTT in the bucket holding the given rank, clamped to the exact min and max. None when
+            # nothing has been recorded.
+            if self.__count == 0:
+                return None
+            rank = max(1, math.ceil(percentile / 100 * self.__count))
+            seen = 0
+            for index in sorted(self.__counts):
+                seen += self.__counts[index]
+                if seen >= rank:
+                    break
+            return min(max(self.__highestEquivalentValue(index) / 1000, self.__minRtt), self.__maxRtt)
+
+        def getSummary(self):
+            return IcmpHelperLibrary.LatencySummary(self.__count, self.__minRtt, self.getAvgRtt(),
+                                                    self.getPercentile(50), self.getPercentile(90),
+                                                    self.getPercentile(99), self.getPercentile(99.9), self.__maxRtt)
+
+        # ############################################################################################################ #
+        # LatencyHistogram Private Functions                                                                           #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def __highestEquivalentValue(self, index):
+            # Inverse of the index computed in addRtt: the largest value in microseconds that lands in index.
+            bucketIndex = (index >> self.__subBucketHalfBits) - 1
+            subBucketIndex = (index & ((1 << self.__subBucketHalfBits) - 1)) + (1 << self.__subBucketHalfBits)
+            if bucketIndex < 0:
+                subBucketIndex -= 1 << self.__subBucketHalfBits
+                bucketIndex = 0
+            return (subBucketIndex << bucketIndex) + (1 << bucketIndex) - 1
+
+        # ############################################################################################################ #
+        # LatencyHistogram Public Functions                                                                            #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def addRtt(self, rtt):
+            value = min(max(int(rtt * 1000), 0), self.__highestValue)
+            bucketIndex = max(value.bit_length() - self.__subBucketBits, 0)
+            index = (bucketIndex << self.__subBucketHalfBits) + (value >> bucketIndex)
+            self.__counts[index] = self.__counts.get(index, 0) + 1
+            self.__count += 1
+            self.__sum += rtt
+            if self.__minRtt is None or rtt < self.__minRtt:
+                self.__minRtt = rtt
+            if self.__maxRtt is None or rtt > self.__maxRtt:
+                self.__maxRtt = rtt
+
+        def merge(self, latencyHistogram):
+            # Add every RTT recorded in latencyHistogram to this one. Both must have the same bucket layout.
+            if latencyHistogram.__subBucketBits != self.__subBucketBits or \
+                    latencyHistogram.__highestValue != self.__highestValue:
+                raise ValueError("Cannot merge latency histograms with different bucket layouts")
+            for index, count in latencyHistogram.__counts.items():
+                self.__counts[index] = self.__counts.get(index, 0) + count
+            self.__count += latencyHistogram.__count
+            self.__sum += latencyHistogram.__sum
+            for rtt in (latencyHistogram.__minRtt, latencyHistogram.__maxRtt):
+                if rtt is not None:
+                    self.__minRtt = rtt if self.__minRtt is None else min(self.__minRtt, rtt)
+                    self.__maxRtt = rtt if self.__maxRtt is None else max(self.__maxRtt, rtt)
+
+        def reset(self):
+            self.__counts = {}
+            self.__count = 0
+            self.__sum = 0.0
+            self.__minRtt = None
+            self.__maxRtt = None
+
+    # ################################################################################################################ #
+    # Class HopStatistics                                                                                              #
+    #                                                                                                                  #
+    # References:                                                                                                      #
+    # https://www.rfc-editor.org/rfc/rfc3550#section-6.4.1 (interarrival jitter estimate)                              #
+    #                                                                                                                  #
+    # Statistics for one hop of a monitored path, in constant memory however long it runs: running counts, min, max,   #
+    # and a Welford mean and variance over every RTT, the RFC 3550 jitter estimate of the change between consecutive   #
+    # RTTs, and a fixed-size ring of the most recent rounds (None for a lost probe). RTTs are in milliseconds.         #
+    #                                                                                                                  #
+    # ################################################################################################################ #
+    class HopStatistics:
+        # ############################################################################################################ #
+        # HopStatistics Class Scope Variables                                                                          #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        __address = None                # Address of the last reply
+        __probesSent = 0
+        __probesReceived = 0
+        __lastRtt = None
+        __minRtt = None
+        __maxRtt = None
+        __meanRtt = 0.0
+        __sumOfSquares = 0.0            # Sum of squared deviations from the mean (Welford's M2)
+        __jitter = 0.0                  # Smoothed |RTT - previous RTT|, gain 1/16 as in RFC 3550
+        __maxJitter = 0.0
+        __history = None                # collections.deque of the last historySize RTTs, None for a loss
+        __latencyHistogram = None       # LatencyHistogram of every RTT, for percentiles
+
+        # ############################################################################################################ #
+        # HopStatistics Constructors                                                                                   #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def __init__(self, historySize=100):
+            self.__history = collections.deque(maxlen=historySize)
+            self.__latencyHistogram = IcmpHelperLibrary.LatencyHistogram()
+
+        # ############################################################################################################ #
+        # HopStatistics Getters                                                                                        #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def getAddress(self):
+            return self.__address
+
+        def getProbesSent(self):
+            return self.__probesSent
+
+        def getProbesReceived(self):
+            return self.__probesReceived
+
+        def getLastRtt(self):
+            return self.__lastRtt
+
+        def getMinRtt(self):
+            return self.__minRtt
+
+        def getMaxRtt(self):
+            return self.__maxRtt
+
+        def getAvgRtt(self):
+            return self.__meanRtt if self.__probesReceived > 0 else None
+
+        def getStandardDeviation(self):
+            if self.__probesReceived == 0:
+                return None
+            return math.sqrt(self.__sumOfSquares / self.__probesReceived)
+
+        def getJitter(self):
+            return self.__jitter
+
+        def getMaxJitter(self):
+            return self.__maxJitter
+
+        def getHistory(self):
+            return tuple(self.__history)
+
+        def getLatencyHistogram(self):
+            return self.__latencyHistogram
+
+        def getPacketLoss(self):
+            if self.__probesSent == 0:
+                return 0.0
+            return (self.__probesSent - self.__probesReceived) / self.__probesSent * 100
+
+        def getRecentPacketLoss(self):
+            # Loss over the rounds still in the history ring, which follows changes faster than getPacketLoss.
+            if len(self.__history) == 0:
+                return 0.0
+            return sum(1 for rtt in self.__history if rtt is None) / len(self.__history) * 100
+
+        # ############################################################################################################ #
+        # HopStatistics Public Functions                                                                               #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def addRtt(self, rtt, address):
+            self.__address = address
+            self.__probesSent += 1
+            self.__probesReceived += 1
+            if self.__lastRtt is not None:
+                difference = abs(rtt - self.__lastRtt)
+                self.__jitter += (difference - self.__jitter) / 16
+                self.__maxJitter = max(self.__maxJitter, difference)
+            self.__lastRtt = rtt
+            self.__minRtt = rtt if self.__minRtt is None else min(self.__minRtt, rtt)
+            self.__maxRtt = rtt if self.__maxRtt is None else max(self.__maxRtt, rtt)
+            delta = rtt - self.__meanRtt
+            self.__meanRtt += delta / self.__probesReceived
+            self.__sumOfSquares += delta * (rtt - self.__meanRtt)
+            self.__history.append(rtt)
+            self.__latencyHistogram.addRtt(rtt)
+
+        def addLoss(self):
+            self.__probesSent += 1
+            self.__history.append(None)
+
+        def getSnapshot(self, ttl):
+            return IcmpHelperLibrary.HopSnapshot(ttl, self.__address, self.__probesSent, self.__probesReceived,
+                                                 self.getPacketLoss(), self.getRecentPacketLoss(), self.__lastRtt,
+                                                 self.__minRtt, self.__maxRtt, self.getAvgRtt(),
+                                                 self.getStandardDeviation(), self.__jitter, self.__maxJitter,
+                                                 self.__latencyHistogram.getSummary())
+
+    # ################################################################################################################ #
+    # Class PathMonitor                                                                                                #
+    #                                                                                                                  #
+    # The state of one continuously monitored path: a HopStatistics per TTL up to maxTtl, created on first use and     #
+    # never more than maxTtl of them, and the number of hops to probe each round. Like mtr, a round that reaches the   #
+    # destination shortens the path to that hop and a round that does not probes up to maxTtl again, so the monitor    #
+    # follows route changes.                                                                                           #
+    #                                                                                                                  #
+    # ################################################################################################################ #
+    class PathMonitor:
+        # ############################################################################################################ #
+        # PathMonitor Class Scope Variables                                                                            #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        __targetHost = ""
+        __destinationIpAddress = None   # None when the target host could not be resolved
+        __maxTtl = 30
+        __hopCount = 30                 # TTLs probed next round
+        __historySize = 100
+        __hops = None                   # HopStatistics for TTL 1 at index 0, and so on
+        __rounds = 0
+
+        # ############################################################################################################ #
+        # PathMonitor Constructors                                                                                     #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def __init__(self, targetHost, destinationIpAddress, maxTtl=30, historySize=100):
+            self.__targetHost = targetHost
+            self.__destinationIpAddress = destinationIpAddress
+            self.__maxTtl = maxTtl
+            self.__hopCount = maxTtl
+            self.__historySize = historySize
+            self.__hops = []
+
+        # ############################################################################################################ #
+        # PathMonitor Getters                                                                                          #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def getTargetHost(self):
+            return self.__targetHost
+
+        def getDestinationIpAddress(self):
+            return self.__destinationIpAddress
+
+        def getHopCount(self):
+            return self.__hopCount
+
+        def getRounds(self):
+            return self.__rounds
+
+        def getHopStatistics(self, ttl):
+            while len(self.__hops) < ttl:
+                self.__hops.append(IcmpHelperLibrary.HopStatistics(self.__historySize))
+            return self.__hops[ttl - 1]
+
+        # ############################################################################################################ #
+        # PathMonitor Public Functions                                                                                 #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def finishRound(self, destinationTtl):
+            # destinationTtl is the lowest TTL whose probe reached the destination this round, or None.
+            self.__rounds += 1
+            self.__hopCount = self.__maxTtl if destinationTtl is None else destinationTtl
+
+        def getSnapshot(self):
+            # Hops beyond the current path length are left out; their statistics are kept in case it grows again.
+            hops = tuple(self.__hops[ttl - 1].getSnapshot(ttl)
+                         for ttl in range(1, min(self.__hopCount, len(self.__hops)) + 1))
+            return IcmpHelperLibrary.PathSnapshot(self.__targetHost, self.__destinationIpAddress, self.__rounds, hops)
+
+    # ################################################################################################################ #
+    # Class StopSet                                                                                                    #
+    #                                                                                                                  #
+    # References:                                                                                                      #
+    # Donnet et al., "Efficient Algorithms for Large-Scale Topology Discovery", SIGMETRICS 2005 (Doubletree)           #
+    #                                                                                                                  #
+    # Topology cache shared by the traces of a Doubletree campaign. Every responding hop is stored under its           #
+    # (address, TTL) together with the key of the responding hop before it and the silent hops in between, so the      #
+    # path from the source to any known hop can be rebuilt without probing it again. A trace probing backward stops    #
+    # at the first hop getPrefix() knows and reuses the HopResults below it. The least recently used hops are dropped  #
+    # beyond maxEntries; a prefix whose chain lost a hop that way is treated as unknown. Safe to share between threads.#
+    #                                                                                                                  #
+    # ################################################################################################################ #
+    class StopSet:
+        # ############################################################################################################ #
+        # StopSet Class Scope Variables                                                                                #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        __maxEntries = 1000000
+        __hops = None                   # OrderedDict (address, TTL) -> (HopResult, parent key or None, silent hops)
+        __reusedHopCount = 0            # Hops handed out by getPrefix instead of being probed
+        __lock = None
+
+        # ############################################################################################################ #
+        # StopSet Constructors                                                                                         #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def __init__(self, maxEntries=1000000):
+            self.__maxEntries = maxEntries
+            self.__hops = collections.OrderedDict()
+            self.__reusedHopCount = 0
+            self.__lock = threading.Lock()
+
+        # ############################################################################################################ #
+        # StopSet Getters                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def getHopCount(self):
+            return len(self.__hops)
+
+        def getReusedHopCount(self):
+            return self.__reusedHopCount
+
+        def getPrefix(self, address, ttl, belowTtl=None):
+            # HopResults for TTLs 1 to ttl - 1 on the way to the hop address answered from at ttl, or None when that
+            # hop, or any responding hop before it, is not in the stop set. With belowTtl only the hops below it are
+            # returned (and counted as reused), for a trace that probed the TTLs from belowTtl up itself.
+            if belowTtl is None:
+                belowTtl = ttl
+            with self.__lock:
+                key = (address, ttl)
+                if key not in self.__hops:
+                    return None
+                prefix = []
+                parentKey = self.__hops[key][1]
+                silentHops = self.__hops[key][2]
+                while True:
+                    prefix.extend(reversed(silentHops))
+                    if parentKey is None:
+                        break
+                    if parentKey not in self.__hops:
+                        return None
+                    self.__hops.move_to_end(parentKey)
+                    hopResult, parentKey, silentHops = self.__hops[parentKey]
+                    prefix.append(hopResult)
+                self.__hops.move_to_end(key)
+                prefix = [hopResult for hopResult in reversed(prefix) if hopResult.ttl < belowTtl]
+                self.__reusedHopCount += len(prefix)
+            return prefix
+
+        # ############################################################################################################ #
+        # StopSet Public Functions                                                                                     #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def addTrace(self, hops):
+            # Learn the HopResults of one trace, which must start at TTL 1 and be in TTL order. Hops from the
+            # destination itself are not stored: they end this path but sit in the middle of no other.
+            with self.__lock:
+                parentKey = None
+                silentHops = []
+                for hopResult in hops:
+                    if hopResult.isDestination:
+                        break
+                    if hopResult.address is None:
+                        silentHops.append(hopResult)
+                        continue
+                    key = (hopResult.address, hopResult.ttl)
+                    self.__hops[key] = (hopResult, parentKey, tuple(silentHops))
+                    self.__hops.move_to_end(key)
+                    parentKey = key
+                    silentHops = []
+                while len(self.__hops) > self.__maxEntries:
+                    self.__hops.popitem(last=False)
+
+    # ################################################################################################################ #
+    # Class ResultWriter                                                                                               #
+    #                                                                                                                  #
+    # Append-only columnar store for probe and hop results. A store is a directory with one file per column of each    #
+    # table (probes.rtt, hops.minRtt, ...): a 16 byte header, the magic and the column's array typecode, followed by   #
+    # the values packed back to back in little-endian order. Rows are buffered in array.arrays and appended bufferSize #
+    # at a time. Reopening a store continues it, first cutting every column of a table back to its shortest one so a   #
+    # write torn by a crash never misaligns the rows. Addresses are IPv4 addresses packed into integers (0 for none),  #
+    # missing RTTs are NaN and missing ICMP types and codes are 255. Read a store back with ResultReader.              #
+    #                                                                                                                  #
+    # ################################################################################################################ #
+    class ResultWriter:
+        # ############################################################################################################ #
+        # ResultWriter Class Scope Variables                                                                           #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        FORMAT_MAGIC = b"ICMPCOL1"
+        HEADER_SIZE = 16
+
+        # (column name, array typecode); time is seconds since the epoch, RTTs are milliseconds.
+        PROBE_COLUMNS = (("time", "d"), ("destination", "I"), ("ttl", "B"), ("sequenceNumber", "H"),
+                         ("address", "I"), ("icmpType", "B"), ("icmpCode", "B"), ("rtt", "f"), ("isValid", "B"))
+        HOP_COLUMNS = (("time", "d"), ("destination", "I"), ("ttl", "B"), ("address", "I"), ("icmpType", "B"),
+                       ("icmpCode", "B"), ("minRtt", "f"), ("maxRtt", "f"), ("avgRtt", "f"), ("probesSent", "H"),
+                       ("probesAnswered", "H"), ("isDestination", "B"))
+
+        __directory = None
+        __bufferSize = 8192
+        __tables = None                 # Table name -> list of (column file, array.array of unwritten values)
+
+        # ############################################################################################################ #
+        # ResultWriter Constructors                                                                                    #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def __init__(self, directory, bufferSize=8192):
+            self.__directory = directory
+            self.__bufferSize = bufferSize
+            os.makedirs(directory, exist_ok=True)
+            self.__tables = {"probes": self.__openTable("probes", IcmpHelperLibrary.ResultWriter.PROBE_COLUMNS),
+                             "hops": self.__openTable("hops", IcmpHelperLibrary.ResultWriter.HOP_COLUMNS)}
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, excType, excValue, traceback):
+            self.close()
+
+        @staticmethod
+        def packAddress(ipAddress):
+            return 0 if ipAddress is None else int.from_bytes(inet_aton(ipAddress), "big")
+
+        @staticmethod
+        def unpackAddress(packedAddress):
+            return None if packedAddress == 0 else inet_ntoa(packedAddress.to_bytes(4, "big"))
+
+        # ############################################################################################################ #
+        # ResultWriter Private Functions                                                                               #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def __openTable(self, tableName, columns):
+            # Open every column file for appending, writing the header of new ones and trimming the table to the
+            # rows that made it into every column.
+            columnFiles = []
+            rowCount = None
+            for columnName, typecode in columns:
+                columnFile = open(os.path.join(self.__directory, tableName + "." + columnName), "a+b")
+                columnFile.seek(0)
+                header = columnFile.read(IcmpHelperLibrary.ResultWriter.HEADER_SIZE)
+                if len(header) == 0:
+                    columnFile.write(IcmpHelperLibrary.ResultWriter.FORMAT_MAGIC + typecode.encode("ascii") +
+                                     bytes(IcmpHelperLibrary.ResultWriter.HEADER_SIZE - 9))
+                    columnFile.flush()
+                    header = IcmpHelperLibrary.ResultWriter.FORMAT_MAGIC + typecode.encode("ascii")
+                if header[:9] != IcmpHelperLibrary.ResultWriter.FORMAT_MAGIC + typecode.encode("ascii"):
+                    columnFile.close()
+                    raise ValueError("%s.%s is not a result column of type %s" % (tableName, columnName, typecode))
+                values = array.array(typecode)
+                columnRows = (os.fstat(columnFile.fileno()).st_size - IcmpHelperLibrary.ResultWriter.HEADER_SIZE) // \
+                    values.itemsize
+                rowCount = columnRows if rowCount is None else min(rowCount, columnRows)
+                columnFiles.append((columnFile, values))
+            for columnFile, values in columnFiles:
+                columnFile.truncate(IcmpHelperLibrary.ResultWriter.HEADER_SIZE + rowCount * values.itemsize)
+            return columnFiles
+
+        def __appendRow(self, tableName, row):
+            columnFiles = self.__tables[tableName]
+            for (columnFile, values), value in zip(columnFiles, row):
+                values.append(value)
+            if len(columnFiles[0][1]) >= self.__bufferSize:
+                self.__flushTable(columnFiles)
+
+        def __flushTable(self, columnFiles):
+            for columnFile, values in columnFiles:
+                if sys.byteorder == "big":
+                    values.byteswap()
+                columnFile.write(values.tobytes())
+                del values[:]
+            for columnFile, values in columnFiles:
+                columnFile.flush()
+
+        # ############################################################################################################ #
+        # ResultWriter Public Functions                                                                                #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def writeProbe(self, destinationIpAddress, probeResult, timestamp=None):
+            # Append a ProbeResult. timestamp defaults to now, in seconds since the epoch.
+            self.__appendRow("probes", (
+                time.time() if timestamp is None else timestamp,
+                IcmpHelperLibrary.ResultWriter.packAddress(destinationIpAddress),
+                probeResult.ttl,
+                probeResult.sequenceNumber,
+                IcmpHelperLibrary.ResultWriter.packAddress(probeResult.address),
+                255 if probeResult.icmpType is None else probeResult.icmpType,
+                255 if probeResult.icmpCode is None else probeResult.icmpCode,
+                math.nan if probeResult.rtt is None else probeResult.rtt,
+                1 if probeResult.isValid else 0
+            ))
+
+        def writeHop(self, destinationIpAddress, hopResult, timestamp=None):
+            # Append a HopResult, without its probes.
+            self.__appendRow("hops", (
+                time.time() if timestamp is None else timestamp,
+                IcmpHelperLibrary.ResultWriter.packAddress(destinationIpAddress),
+                hopResult.ttl,
+                IcmpHelperLibrary.ResultWriter.packAddress(hopResult.address),
+                255 if hopResult.icmpType is None else hopResult.icmpType,
+                255 if hopResult.icmpCode is None else hopResult.icmpCode,
+                math.nan if hopResult.minRtt is None else hopResult.minRtt,
+                math.nan if hopResult.maxRtt is None else hopResult.maxRtt,
+                math.nan if hopResult.avgRtt is None else hopResult.avgRtt,
+                hopResult.probesSent,
+                hopResult.probesAnswered,
+                1 if hopResult.isDestination else 0
+            ))
+
+        def writeTrace(self, destinationIpAddress, hops, timestamp=None):
+            # Append every HopResult of a trace and every probe it holds, all with the same timestamp.
+            if timestamp is None:
+                timestamp = time.time()
+            for hopResult in hops:
+                self.writeHop(destinationIpAddress, hopResult, timestamp)
+                for probeResult in hopResult.probes:
+                    self.writeProbe(destinationIpAddress, probeResult, timestamp)
+
+        def flush(self):
+            for columnFiles in self.__tables.values():
+                self.__flushTable(columnFiles)
+
+        def close(self):
+            if self.__tables is None:
+                return
+            self.flush()
+            for columnFiles in self.__tables.values():
+                for columnFile, values in columnFiles:
+                    columnFile.close()
+            self.__tables = None
+
+    # ################################################################################################################ #
+    # Class ResultReader                                                                                               #
+    #                                                                                                                  #
+    # Reads a ResultWriter store by memory-mapping its column files, so opening one costs the same whatever its size   #
+    # and only the pages a query touches are read from disk. getProbeColumns() and getHopColumns() return each column  #
+    # as a zero-copy NumPy array when NumPy is installed, or otherwise as a memoryview cast to the column's type that  #
+    # numpy.frombuffer accepts later (an array.array copy on big-endian hosts). iterProbes() and iterHops() decode     #
+    # rows into ProbeRecords and HopRecords. Arrays handed out keep their mapping alive after close().                 #
+    #                                                                                                                  #
+    # ################################################################################################################ #
+    class ResultReader:
+        # ############################################################################################################ #
+        # ResultReader Class Scope Variables                                                                           #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        __directory = None
+        __mappings = None               # mmap objects of every column file
+        __tables = None                 # Table name -> (row count, {column name: column array})
+
+        # ############################################################################################################ #
+        # ResultReader Constructors                                                                                    #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def __init__(self, directory):
+            self.__directory = directory
+            self.__mappings = []
+            self.__tables = {"probes": self.__mapTable("probes", IcmpHelperLibrary.ResultWriter.PROBE_COLUMNS),
+                             "hops": self.__mapTable("hops", IcmpHelperLibrary.ResultWriter.HOP_COLUMNS)}
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, excType, excValue, traceback):
+            self.close()
+
+        # ############################################################################################################ #
+        # ResultReader Getters                                                                                         #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def getProbeCount(self):
+            return self.__tables["probes"][0]
+
+        def getHopCount(self):
+            return self.__tables["hops"][0]
+
+        def getProbeColumns(self):
+            return dict(self.__tables["probes"][1])
+
+        def getHopColumns(self):
+            return dict(self.__tables["hops"][1])
+
+        # ############################################################################################################ #
+        # ResultReader Private Functions                                                                               #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def __mapTable(self, tableName, columns):
+            # Map each column file and cut every column to the rows present in all of them; a store still being
+            # written can have a partly appended last buffer.
+            mappedColumns = []
+            for columnName, typecode in columns:
+                with open(os.path.join(self.__directory, tableName + "." + columnName), "rb") as columnFile:
+                    mapping = mmap.mmap(columnFile.fileno(), 0, access=mmap.ACCESS_READ)
+                self.__mappings.append(mapping)
+                if mapping[:9] != IcmpHelperLibrary.ResultWriter.FORMAT_MAGIC + typecode.encode("ascii"):
+                    raise ValueError("%s.%s is not a result column of type %s" % (tableName, columnName, typecode))
+                itemSize = array.array(typecode).itemsize
+                mappedColumns.append((columnName, typecode, mapping,
+                                      (len(mapping) - IcmpHelperLibrary.ResultWriter.HEADER_SIZE) // itemSize))
+            rowCount = min(columnRows for columnName, typecode, mapping, columnRows in mappedColumns)
+
+            columnArrays = {}
+            for columnName, typecode, mapping, columnRows in mappedColumns:
+                if numpy is not None:
+                    columnArrays[columnName] = numpy.frombuffer(mapping, numpy.dtype("<" + typecode), rowCount,
+                                                                IcmpHelperLibrary.ResultWriter.HEADER_SIZE)
+                    continue
+                itemSize = array.array(typecode).itemsize
+                columnView = memoryview(mapping)[IcmpHelperLibrary.ResultWriter.HEADER_SIZE:
+                                                 IcmpHelperLibrary.ResultWriter.HEADER_SIZE + rowCount * itemSize]
+                if sys.byteorder == "big":
+                    values = array.array(typecode, columnView.tobytes())
+                    values.byteswap()
+                    columnView.release()
+                    columnArrays[columnName] = values
+                else:
+                    columnArrays[columnName] = columnView.cast(typecode)
+            return rowCount, columnArrays
+
+        # ############################################################################################################ #
+        # ResultReader Public Functions                                                                                #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def iterProbes(self):
+            unpackAddress = IcmpHelperLibrary.ResultWriter.unpackAddress
+            columnArrays = self.__tables["probes"][1]
+            for timestamp, destination, ttl, sequenceNumber, address, icmpType, icmpCode, rtt, isValid in zip(
+                    *[columnArrays[columnName] for columnName, typecode in IcmpHelperLibrary.ResultWriter.PROBE_COLUMNS]):
+                yield IcmpHelperLibrary.ProbeRecord(float(timestamp), unpackAddress(int(destination)), int(ttl),
+                                                    int(sequenceNumber), unpackAddress(int(address)),
+                                                    None if icmpType == 255 else int(icmpType),
+                                                    None if icmpCode == 255 else int(icmpCode),
+                                                    None if math.isnan(rtt) else float(rtt), bool(isValid))
+
+        def iterHops(self):
+            unpackAddress = IcmpHelperLibrary.ResultWriter.unpackAddress
+            columnArrays = self.__tables["hops"][1]
+            for timestamp, destination, ttl, address, icmpType, icmpCode, minRtt, maxRtt, avgRtt, probesSent, \
+                    probesAnswered, isDestination in zip(*[columnArrays[columnName] for columnName, typecode
+                                                           in IcmpHelperLibrary.ResultWriter.HOP_COLUMNS]):
+                yield IcmpHelperLibrary.HopRecord(float(timestamp), unpackAddress(int(destination)), int(ttl),
+                                                  unpackAddress(int(address)),
+                                                  None if icmpType == 255 else int(icmpType),
+                                                  None if icmpCode == 255 else int(icmpCode),
+                                                  None if math.isnan(minRtt) else float(minRtt),
+                                                  None if math.isnan(maxRtt) else float(maxRtt),
+                                                  None if math.isnan(avgRtt) else float(avgRtt),
+                                                  int(probesSent), int(probesAnswered), bool(isDestination))
+
+        def close(self):
+            # Unmap every column nobody else holds an array of; the rest are unmapped when their arrays go.
+            if self.__tables is None:
+                return
+            for rowCount, columnArrays in self.__tables.values():
+                for columnArray in columnArrays.values():
+                    if isinstance(columnArray, memoryview):
+                        columnArray.release()
+            self.__tables = None
+            for mapping in self.__mappings:
+                try:
+                    mapping.close()
+                except BufferError:
+                    pass
+            self.__mappings = []
+
+    # ################################################################################################################ #
+    # Class IcmpBatchIo                                                                                                #
+    #                                                                                                                  #
+    # sendmmsg/recvmmsg through ctypes: a whole burst of probes leaves in one system call, each with its own TTL as an #
+    # IP_TTL control message, and every queued reply is read by one more. isAvailable() is False where libc lacks the  #
+    # calls (non-Linux systems); IcmpSession then falls back to one send and one non-blocking receive per packet.      #
+    #                                                                                                                  #
+    # ################################################################################################################ #
+    class IcmpBatchIo:
+        # ############################################################################################################ #
+        # IcmpBatchIo Class Scope Variables                                                                            #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        class IoVector(ctypes.Structure):               # struct iovec
+            _fields_ = [("base", ctypes.c_void_p), ("length", ctypes.c_size_t)]
+
+        class SocketAddress(ctypes.Structure):          # struct sockaddr_in
+            _fields_ = [("family", ctypes.c_ushort), ("port", ctypes.c_ushort), ("address", ctypes.c_ubyte * 4),
+                        ("zero", ctypes.c_ubyte * 8)]
+
+        class MessageHeader(ctypes.Structure):          # struct msghdr
+            _fields_ = [("name", ctypes.c_void_p), ("nameLength", ctypes.c_uint32), ("iov", ctypes.c_void_p),
+                        ("iovLength", ctypes.c_size_t), ("control", ctypes.c_void_p),
+                        ("controlLength", ctypes.c_size_t), ("flags", ctypes.c_int)]
+
+        class MultiMessageHeader(ctypes.Structure):     # struct mmsghdr
+            pass
+        MultiMessageHeader._fields_ = [("header", MessageHeader), ("length", ctypes.c_uint)]
+
+        __libc = None                   # libc with sendmmsg and recvmmsg, False when they are unavailable
+        __libcLock = threading.Lock()
+        __MSG_DONTWAIT = 0x40
+        __SCM_TIMESTAMPNS = 35          # From <asm-generic/socket.h>, the control message type of SO_TIMESTAMPNS
+        __maxReceiveBatch = 64          # Replies read per recvmmsg call
+        __receiveBufferSize = 2048      # Per reply, as for IcmpSession.receiveReply
+        __receiveMessages = None        # Preallocated recvmmsg arguments, reused for every call
+        __receiveMessageBuffer = None   # bytearrays backing the mmsghdr and sockaddr_in arrays
+        __receiveAddressBuffer = None
+        __receiveControlBuffer = None   # One SO_TIMESTAMPNS control message per reply
+        __receiveControlSpace = 0
+        __receiveVectors = None
+        __receiveBuffer = None          # bytearray holding every reply buffer back to back
+        __receiveView = None
+        __ttlControlLength = 0          # CMSG_LEN(sizeof(int)) and CMSG_SPACE(sizeof(int))
+        __ttlControlSpace = 0
+        __sendCapacity = 0              # Probes the preallocated send arrays hold
+        __sendMessages = None
+        __sendVectors = None            # bytearrays backing the iovec, sockaddr_in and control message arrays
+        __sendAddresses = None
+        __sendBuffer = None             # Packet copies, one receive-sized slot per probe
+        __sendControls = None           # One IP_TTL control message per probe
+        __packedAddresses = None        # Destination -> inet_aton() bytes, reused across bursts
+
+        # ############################################################################################################ #
+        # IcmpBatchIo Constructors                                                                                     #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def __init__(self, maxReceiveBatch=64, sendCapacity=1024):
+            # Everything is allocated up front (sendCapacity covers a full 255 TTL traceroute window), so the
+            # first burst is not slowed, and timed, by ctypes setup.
+            self.__maxReceiveBatch = maxReceiveBatch
+            self.__receiveMessageBuffer = bytearray(maxReceiveBatch *
+                                                    ctypes.sizeof(IcmpHelperLibrary.IcmpBatchIo.MultiMessageHeader))
+            self.__receiveMessages = (IcmpHelperLibrary.IcmpBatchIo.MultiMessageHeader * maxReceiveBatch).from_buffer(
+                self.__receiveMessageBuffer)
+            self.__receiveAddressBuffer = bytearray(maxReceiveBatch *
+                                                    ctypes.sizeof(IcmpHelperLibrary.IcmpBatchIo.SocketAddress))
+            receiveAddresses = (IcmpHelperLibrary.IcmpBatchIo.SocketAddress * maxReceiveBatch).from_buffer(
+                self.__receiveAddressBuffer)
+            self.__receiveBuffer = bytearray(maxReceiveBatch * self.__receiveBufferSize)
+            self.__receiveView = memoryview(self.__receiveBuffer)
+            receiveVectors = (IcmpHelperLibrary.IcmpBatchIo.IoVector * maxReceiveBatch)()
+            bufferAddress = ctypes.addressof((ctypes.c_char * len(self.__receiveBuffer)).from_buffer(
+                self.__receiveBuffer))
+            self.__receiveControlSpace = CMSG_SPACE(struct.calcsize("@ll"))
+            self.__receiveControlBuffer = bytearray(maxReceiveBatch * self.__receiveControlSpace)
+            controlAddress = ctypes.addressof((ctypes.c_char * len(self.__receiveControlBuffer)).from_buffer(
+                self.__receiveControlBuffer))
+            for i in range(maxReceiveBatch):
+                receiveVectors[i].base = bufferAddress + i * self.__receiveBufferSize
+                receiveVectors[i].length = self.__receiveBufferSize
+                header = self.__receiveMessages[i].header
+                header.name = ctypes.addressof(receiveAddresses[i])
+                header.nameLength = ctypes.sizeof(receiveAddresses[i])     # Stays 16 for IPv4 senders
+                header.iov = ctypes.addressof(receiveVectors[i])
+                header.iovLength = 1
+                header.control = controlAddress + i * self.__receiveControlSpace
+            self.__receiveVectors = receiveVectors      # Referenced by address from the message headers
+
+            # Control message sizes as CMSG_LEN and CMSG_SPACE compute them, with size_t alignment.
+            alignment = ctypes.sizeof(ctypes.c_size_t)
+            controlHeaderSize = -(-struct.calcsize("@Nii") // alignment) * alignment
+            self.__ttlControlLength = controlHeaderSize + struct.calcsize("@i")
+            self.__ttlControlSpace = controlHeaderSize + -(-struct.calcsize("@i") // alignment) * alignment
+            self.__sendCapacity = 0
+            self.__packedAddresses = {}
+            self.__allocateSendArrays(sendCapacity)
+
+        @staticmethod
+        def getLibc():
+            with IcmpHelperLibrary.IcmpBatchIo.__libcLock:
+                if IcmpHelperLibrary.IcmpBatchIo.__libc is None:
+                    IcmpHelperLibrary.IcmpBatchIo.__libc = False
+                    if sys.platform.startswith("linux"):
+                        try:
+                            libc = ctypes.CDLL(None, use_errno=True)
+                            if hasattr(libc, "sendmmsg") and hasattr(libc, "recvmmsg"):
+                                IcmpHelperLibrary.IcmpBatchIo.__libc = libc
+                        except OSError:
+                            pass
+                return IcmpHelperLibrary.IcmpBatchIo.__libc
+
+        @staticmethod
+        def isAvailable():
+            return IcmpHelperLibrary.IcmpBatchIo.getLibc() is not False
+
+        # ############################################################################################################ #
+        # IcmpBatchIo Private Functions                                                                                #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def __allocateSendArrays(self, count):
+            # Send side arguments, grown to the largest burst seen and reused. Every pointer is set here once; a
+            # burst only writes each probe's bytes, length, destination address and TTL into the backing buffers.
+            self.__sendCapacity = count
+            self.__sendMessages = (IcmpHelperLibrary.IcmpBatchIo.MultiMessageHeader * count)()
+            self.__sendVectors = bytearray(count * ctypes.sizeof(IcmpHelperLibrary.IcmpBatchIo.IoVector))
+            self.__sendAddresses = bytearray(count * ctypes.sizeof(IcmpHelperLibrary.IcmpBatchIo.SocketAddress))
+            self.__sendBuffer = bytearray(count * self.__receiveBufferSize)
+            self.__sendControls = bytearray(count * self.__ttlControlSpace)
+            sendVectors = (IcmpHelperLibrary.IcmpBatchIo.IoVector * count).from_buffer(self.__sendVectors)
+            sendAddresses = (IcmpHelperLibrary.IcmpBatchIo.SocketAddress * count).from_buffer(self.__sendAddresses)
+            bufferAddress = ctypes.addressof((ctypes.c_char * len(self.__sendBuffer)).from_buffer(self.__sendBuffer))
+            controlsAddress = ctypes.addressof((ctypes.c_char * len(self.__sendControls)).from_buffer(
+                self.__sendControls))
+            for i in range(count):
+                sendVectors[i].base = bufferAddress + i * self.__receiveBufferSize
+                sendAddresses[i].family = AF_INET
+                struct.pack_into("@Nii", self.__sendControls, i * self.__ttlControlSpace, self.__ttlControlLength,
+                                 IPPROTO_IP, IP_TTL)
+                header = self.__sendMessages[i].header
+                header.name = ctypes.addressof(sendAddresses[i])
+                header.nameLength = ctypes.sizeof(sendAddresses[i])
+                header.iov = ctypes.addressof(sendVectors[i])
+                header.iovLength = 1
+                header.control = controlsAddress + i * self.__ttlControlSpace
+                header.controlLength = self.__ttlControlSpace
+
+        # ############################################################################################################ #
+        # IcmpBatchIo Public Functions                                                                                 #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def sendBurst(self, fileDescriptor, probes):
+            # Send every (packetBytes, destinationIpAddress, ttl) in probes with as few sendmmsg calls as the kernel
+            # allows. Returns how many were sent before the first failure (a full send buffer, an unreachable
+            # network); only a failure on the very first probe is raised as OSError.
+            libc = IcmpHelperLibrary.IcmpBatchIo.getLibc()
+            count = len(probes)
+            if count > self.__sendCapacity:
+                self.__allocateSendArrays(count)
+            vectorSize = ctypes.sizeof(IcmpHelperLibrary.IcmpBatchIo.IoVector)
+            lengthPosition = IcmpHelperLibrary.IcmpBatchIo.IoVector.length.offset
+            addressSize = ctypes.sizeof(IcmpHelperLibrary.IcmpBatchIo.SocketAddress)
+            addressPosition = IcmpHelperLibrary.IcmpBatchIo.SocketAddress.address.offset
+            ttlPosition = self.__ttlControlLength - struct.calcsize("@i")     # CMSG_DATA offset
+            packedAddresses = self.__packedAddresses
+            for i, (packetBytes, destinationIpAddress, ttl) in enumerate(probes):
+                if len(packetBytes) > self.__receiveBufferSize:
+                    count = i   # Too large for a slot; the caller sends the rest one at a time
+                    break
+                position = i * self.__receiveBufferSize
+                self.__sendBuffer[position:position + len(packetBytes)] = packetBytes
+                struct.pack_into("@N", self.__sendVectors, i * vectorSize + lengthPosition, len(packetBytes))
+                packedAddress = packedAddresses.get(destinationIpAddress)
+                if packedAddress is None:
+                    if len(packedAddresses) >= 4096:
+                        packedAddresses.clear()
+                    packedAddress = inet_aton(destinationIpAddress)
+                    packedAddresses[destinationIpAddress] = packedAddress
+                position = i * addressSize + addressPosition
+                self.__sendAddresses[position:position + 4] = packedAddress
+                struct.pack_into("@i", self.__sendControls, i * self.__ttlControlSpace + ttlPosition, ttl)
+
+            messages = self.__sendMessages
+            sent = 0
+            while sent < count:
+                result = libc.sendmmsg(fileDescriptor, ctypes.byref(messages, sent * ctypes.sizeof(messages[0])),
+                                       count - sent, 0)
+                if result < 0:
+                    errorNumber = ctypes.get_errno()
+                    if errorNumber == errno.EINTR:
+                        continue
+                    if sent > 0 or errorNumber in (errno.EAGAIN, errno.ENOBUFS):
+                        break
+                    raise OSError(errorNumber, os.strerror(errorNumber))
+                sent += result
+            return sent
+
+        def receiveReplies(self, fileDescriptor, expectedData=None):
+            # Read every reply already queued on the socket, up to maxReceiveBatch per recvmmsg call, without
+            # blocking. Returns the IcmpReplies among them.
+            libc = IcmpHelperLibrary.IcmpBatchIo.getLibc()
+            icmpReplies = []
+            messageSize = ctypes.sizeof(IcmpHelperLibrary.IcmpBatchIo.MultiMessageHeader)
+            lengthPosition = IcmpHelperLibrary.IcmpBatchIo.MultiMessageHeader.length.offset
+            controlLengthPosition = IcmpHelperLibrary.IcmpBatchIo.MessageHeader.controlLength.offset
+            addressSize = ctypes.sizeof(IcmpHelperLibrary.IcmpBatchIo.SocketAddress)
+            addressPosition = IcmpHelperLibrary.IcmpBatchIo.SocketAddress.address.offset
+            controlHeaderSize = CMSG_LEN(0)
+            clockOffset = IcmpHelperLibrary.IcmpSession.getClockOffset()    # Once for the whole drain
+            while True:
+                # The kernel shrinks each msg_controllen to what it wrote, so every call restores the full size.
+                for i in range(self.__maxReceiveBatch):
+                    struct.pack_into("@N", self.__receiveMessageBuffer, i * messageSize + controlLengthPosition,
+                                     self.__receiveControlSpace)
+                result = libc.recvmmsg(fileDescriptor, self.__receiveMessages, self.__maxReceiveBatch,
+                                       self.__MSG_DONTWAIT, None)
+                if result < 0:
+                    errorNumber = ctypes.get_errno()
+                    if errorNumber in (errno.EAGAIN, errno.EINTR):
+                        return icmpReplies
+                    raise OSError(errorNumber, os.strerror(errorNumber))
+                timeRead = time.perf_counter_ns()
+                for i in range(result):
+                    position = i * self.__receiveBufferSize
+                    numberOfBytes = struct.unpack_from("@I", self.__receiveMessageBuffer, i * messageSize +
+                                                       lengthPosition)[0]
+                    addressStart = i * addressSize + addressPosition
+                    # The buffer only has room for one control message; it is used if it is the SCM_TIMESTAMPNS.
+                    timeReceived = timeRead
+                    isKernelTimestamp = False
+                    controlLength = struct.unpack_from("@N", self.__receiveMessageBuffer,
+                                                       i * messageSize + controlLengthPosition)[0]
+                    controlStart = i * self.__receiveControlSpace
+                    messageLength, level, controlType = struct.unpack_from("@Nii", self.__receiveControlBuffer,
+                                                                           controlStart)
+                    if controlLength >= controlHeaderSize + struct.calcsize("@ll") and \
+                            messageLength >= controlHeaderSize + struct.calcsize("@ll") and \
+                            level == SOL_SOCKET and controlType == self.__SCM_TIMESTAMPNS:
+                        seconds, nanoseconds = struct.unpack_from("@ll", self.__receiveControlBuffer,
+                                                                  controlStart + controlHeaderSize)
+                        timeReceived = seconds * 1000000000 + nanoseconds + clockOffset
+                        isKernelTimestamp = True
+                    icmpReply = IcmpHelperLibrary.IcmpReply.parse(
+                        self.__receiveView[position:position + self.__receiveBufferSize], numberOfBytes,
+                        inet_ntoa(self.__receiveAddressBuffer[addressStart:addressStart + 4]), timeReceived,
+                        expectedData, isKernelTimestamp)
+                    if icmpReply is not None:
+                        icmpReplies.append(icmpReply)
+                if result < self.__maxReceiveBatch:
+                    return icmpReplies
+
+    # ################################################################################################################ #
+    # Class IcmpSocketTransport                                                                                        #
+    #                                                                                                                  #
+    # The network an IcmpSession sends through and receives from. A transport hands the session a socket object: this #
+    # one a raw ICMP socket on the host's real network, which needs root; SimulatedNetwork a simulated socket backed   #
+    # by an in-process model of a network. The session only uses the socket calls both provide (bind, settimeout,     #
+    # setsockopt, sendto, recvfrom_into, recvmsg_into, fileno for select and the event loop, close), and batches       #
+    # system calls through IcmpBatchIo only on a real socket.                                                          #
+    #                                                                                                                  #
+    # ################################################################################################################ #
+    class IcmpSocketTransport:
+        # ############################################################################################################ #
+        # IcmpSocketTransport Public Functions                                                                         #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def isRawSocket(self):
+            # True when openSocket returns a kernel raw socket that sendmmsg and recvmmsg can be used on.
+            return True
+
+        def openSocket(self):
+            return socket(AF_INET, SOCK_RAW, IPPROTO_ICMP)
+
+    # ################################################################################################################ #
+    # Class IcmpSession                                                                                                #
+    #                                                                                                                  #
+    # Owns one raw ICMP socket for as many probes, pings and traceroutes as the caller wants, instead of opening,      #
+    # binding and closing a socket for every packet. The TTL socket option is only changed when it differs from the    #
+    # previous send. The socket comes from the session's transport: the real network unless a SimulatedNetwork is     #
+    # given.                                                                                                           #
+    #                                                                                                                  #
+    # ################################################################################################################ #
+    class IcmpSession:
+        # ############################################################################################################ #
+        # IcmpSession Class Scope Variables                                                                            #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        __mySocket = None               # Raw ICMP socket, None while closed
+        __transport = None              # IcmpSocketTransport or SimulatedNetwork the socket is opened from
+        __probeMetrics = None           # ProbeMetrics counting and timing this session's IO, None to measure nothing
+        __ttl = 0                       # TTL currently set on the socket, 0 when unknown
+        __ipTimeout = 30
+        __nextSequenceNumber = 0        # Next unused ICMP sequence number, runs on across pings and traces
+        __receiveBufferSize = 0         # SO_RCVBUF in bytes, 0 keeps the system default
+        __recvBuffer = None             # Preallocated buffer every reply is received into
+        __recvView = None               # memoryview of __recvBuffer, so parsing never copies the packet
+        __packetIdentifier = 0          # ICMP identifier of every probe sent through this session
+        __kernelFilter = True           # Attach a BPF filter for the identifiers sent; False once attaching failed
+        __batchIo = None                # IcmpBatchIo once created, False when batched system calls are unavailable
+        __filterIdentifiers = None      # Identifiers the attached filter lets through, None when none attached
+        __maxFilterIdentifiers = 64     # Beyond this many identifiers the filter only checks the message type
+        __SO_ATTACH_FILTER = 26         # From <asm-generic/socket.h>; Linux only
+        __SO_TIMESTAMPNS = 35           # Same header; SCM_TIMESTAMPNS is the same value
+        __kernelTimestamps = True       # Receive times from SO_TIMESTAMPNS; False when the socket cannot provide them
+        __ancillaryBufferSize = 0       # Room for one struct timespec control message
+        __identifierLock = threading.Lock()
+        __identifiersAllocated = 0      # Sessions created so far in this process
+
+        # ############################################################################################################ #
+        # IcmpSession Constructors                                                                                     #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def __init__(self, ipTimeout=30, receiveBufferSize=0, kernelFilter=True, batchIo=True, kernelTimestamps=True,
+                     transport=None, probeMetrics=None):
+            self.__mySocket = None
+            self.__transport = transport if transport is not None else IcmpHelperLibrary.IcmpSocketTransport()
+            self.__probeMetrics = probeMetrics
+            self.__ttl = 0
+            self.__ipTimeout = ipTimeout
+            self.__nextSequenceNumber = 0
+            self.__receiveBufferSize = receiveBufferSize
+            self.__recvBuffer = bytearray(2048)     # Larger than any ICMP error quoting a 68 byte echo request
+            self.__recvView = memoryview(self.__recvBuffer)
+            self.__packetIdentifier = IcmpHelperLibrary.IcmpSession.allocatePacketIdentifier()
+            self.__kernelFilter = kernelFilter and sys.platform.startswith("linux")
+            self.__filterIdentifiers = None
+            self.__batchIo = None if batchIo and self.__transport.isRawSocket() and \
+                IcmpHelperLibrary.IcmpBatchIo.isAvailable() else False
+            self.__kernelTimestamps = kernelTimestamps and sys.platform.startswith("linux")
+            self.__ancillaryBufferSize = CMSG_SPACE(struct.calcsize("@ll")) if self.__kernelTimestamps else 0
+
+        @staticmethod
+        def allocatePacketIdentifier():
+            # Every raw socket sees every ICMP reply reaching the host, so sessions running in parallel threads must
+            # not share an identifier or they would take each other's replies. The first session gets the process
+            # ID, as the single session case always has; later ones count up from it (16 bits - ICMP header limit).
+            with IcmpHelperLibrary.IcmpSession.__identifierLock:
+                sessionNumber = IcmpHelperLibrary.IcmpSession.__identifiersAllocated
+                IcmpHelperLibrary.IcmpSession.__identifiersAllocated = sessionNumber + 1
+            return (os.getpid() + sessionNumber) & 0xffff
+
+        @staticmethod
+        def getClockOffset():
+            # Nanoseconds to add to a CLOCK_REALTIME kernel timestamp to put it on the time.perf_counter_ns() clock.
+            # Taken once per read or drain, so only a wall clock step between arrival and read could skew it. The
+            # wall clock is read between two perf_counter_ns() reads, again if a thread switch came in between, so
+            # the offset is good to within a microsecond: closer than the time from any send to its reply.
+            for attempt in range(3):
+                timeBefore = time.perf_counter_ns()
+                realTime = time.time_ns()
+                timeAfter = time.perf_counter_ns()
+                if timeAfter - timeBefore < 1000:
+                    break
+            return (timeBefore + timeAfter) // 2 - realTime
+
+        @staticmethod
+        def getKernelTimestamp(ancillaryData, clockOffset):
+            # The SCM_TIMESTAMPNS receive time among recvmsg ancillary data, on the time.perf_counter_ns() clock, or
+            # None when the kernel attached none.
+            for level, controlType, data in ancillaryData:
+                if level == SOL_SOCKET and controlType == IcmpHelperLibrary.IcmpSession.__SO_TIMESTAMPNS and \
+                        len(data) >= struct.calcsize("@ll"):
+                    seconds, nanoseconds = struct.unpack_from("@ll", data)
+                    return seconds * 1000000000 + nanoseconds + clockOffset
+            return None
+
+        @staticmethod
+        def buildKernelFilter(packetIdentifiers):
+            # Classic BPF program for SO_ATTACH_FILTER. It runs on every packet from the IP header on and passes
+            # only Echo Replies carrying one of packetIdentifiers, and Time Exceeded and Destination Unreachable
+            # messages quoting an echo request with one of them. An empty packetIdentifiers passes any identifier.
+            # Loads past the end of a packet make the kernel drop it, so truncated quotes never reach Python.
+            def identifierChecks():
+                if len(packetIdentifiers) == 0:
+                    return [(0x35, "accept", "accept", 0)]                      # jge #0 (always true)
+                checks = [(0x15, "accept", None, packetIdentifier) for packetIdentifier in packetIdentifiers]
+                checks[-1] = (0x15, "accept", "reject", packetIdentifiers[-1])  # jeq #identifier
+                return checks
+
+            instructions = [(0xb1, None, None, 0),          # ldx 4*([0]&0xf)  X = IP header length
+                            (0x50, None, None, 0),          # ldb [x+0]        ICMP type
+                            (0x15, "echoReply", None, 0),   # jeq #0           Echo Reply
+                            (0x15, "quoted", None, 11),     # jeq #11          Time Exceeded
+                            (0x15, "quoted", "reject", 3),  # jeq #3           Destination Unreachable
+                            "echoReply",
+                            (0x48, None, None, 4)]          # ldh [x+4]        identifier
+            instructions += identifierChecks()
+            instructions += ["quoted",
+                             (0x50, None, None, 17),        # ldb [x+17]       quoted IP protocol
+                             (0x15, None, "reject", 1),     # jeq #1           ICMP
+                             (0x50, None, None, 8),         # ldb [x+8]        quoted IP version/IHL
+                             (0x54, None, None, 0x0f),      # and #0xf
+                             (0x64, None, None, 2),         # lsh #2           quoted IP header length
+                             (0x0c, None, None, 0),         # add x
+                             (0x07, None, None, 0),         # tax              X = both IP header lengths
+                             (0x50, None, None, 8),         # ldb [x+8]        quoted ICMP type
+                             (0x15, None, "reject", 8),     # jeq #8           echo request
+                             (0x48, None, None, 12)]        # ldh [x+12]       quoted identifier
+            instructions += identifierChecks()
+            instructions += ["accept",
+                             (0x06, None, None, 0xffff),    # ret #65535       pass the whole packet
+                             "reject",
+                             (0x06, None, None, 0)]         # ret #0           drop
+
+            labels = {}                                     # Label -> index of the instruction following it
+            position = 0
+            for instruction in instructions:
+                if isinstance(instruction, str):
+                    labels[instruction] = position
+                else:
+                    position += 1
+
+            program = []
+            position = 0
+            for instruction in instructions:
+                if isinstance(instruction, str):
+                    continue
+                code, trueLabel, falseLabel, k = instruction
+                position += 1   # Jumps are relative to the next instruction
+                jumpTrue = 0 if trueLabel is None else labels[trueLabel] - position
+                jumpFalse = 0 if falseLabel is None else labels[falseLabel] - position
+                program.append(struct.pack("HBBI", code, jumpTrue, jumpFalse, k))   # struct sock_filter
+            return b''.join(program)
+
+        def __enter__(self):
+            self.open()
+            return self
+
+        def __exit__(self, excType, excValue, traceback):
+            self.close()
+
+        # ############################################################################################################ #
+        # IcmpSession Getters                                                                                          #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def getSocket(self):
+            return self.__mySocket
+
+        def getTransport(self):
+            return self.__transport
+
+        def getProbeMetrics(self):
+            return self.__probeMetrics
+
+        def getTtl(self):
+            return self.__ttl
+
+        def getPacketIdentifier(self):
+            return self.__packetIdentifier
+
+        def hasKernelTimestamps(self):
+            # False when replies are timed in Python after the read (no SO_TIMESTAMPNS), which adds scheduling
+            # delay to every RTT.
+            return self.__kernelTimestamps
+
+        def getFilterIdentifiers(self):
+            # Identifiers the kernel filter passes; an empty set means any identifier, None means no filter.
+            return self.__filterIdentifiers
+
+        def isOpen(self):
+            return self.__mySocket is not None
+
+        # ############################################################################################################ #
+        # IcmpSession Setters                                                                                          #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def setProbeMetrics(self, probeMetrics):
+            self.__probeMetrics = probeMetrics
+
+        def setTtl(self, ttl):
+            # Consecutive probes to the same hop share a TTL, so the setsockopt call is skipped for them.
+            if ttl != self.__ttl:
+                self.__mySocket.setsockopt(IPPROTO_IP, IP_TTL, struct.pack('I', ttl))  # Unsigned int - 4 bytes
+                self.__ttl = ttl
+
+        # ############################################################################################################ #
+        # IcmpSession Private Functions                                                                                #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def __receiveInto(self, buffer, clockOffset=None):
+            # recvmsg with the kernel's receive timestamp where available; otherwise the time of the read.
+            if self.__kernelTimestamps:
+                numberOfBytes, ancillaryData, messageFlags, addr = self.__mySocket.recvmsg_into(
+                    [buffer], self.__ancillaryBufferSize)
+                if clockOffset is None:
+                    clockOffset = IcmpHelperLibrary.IcmpSession.getClockOffset()
+                timeReceived = IcmpHelperLibrary.IcmpSession.getKernelTimestamp(ancillaryData, clockOffset)
+                if timeReceived is not None:
+                    return numberOfBytes, addr, timeReceived, True
+                return numberOfBytes, addr, time.perf_counter_ns(), False
+            numberOfBytes, addr = self.__mySocket.recvfrom_into(buffer)
+            return numberOfBytes, addr, time.perf_counter_ns(), False
+
+        def __filterPacketIdentifier(self, packetBytes):
+            # The filter follows the identifiers actually sent (bytes 4-5 of the echo request), so it also covers
+            # IcmpPackets built with an identifier of the caller's choosing.
+            packetIdentifier = (packetBytes[4] << 8) | packetBytes[5]
+            if self.__filterIdentifiers is None or (len(self.__filterIdentifiers) > 0 and
+                                                    packetIdentifier not in self.__filterIdentifiers):
+                self.__updateKernelFilter(packetIdentifier)
+
+        def __waitReadable(self, timeout):
+            # select on the socket for up to timeout seconds, timed into the ProbeMetrics if there is one.
+            if self.__probeMetrics is None:
+                return select.select([self.__mySocket], [], [], max(timeout, 0))[0] != []
+            startTime = time.perf_counter_ns()
+            isReadable = select.select([self.__mySocket], [], [], max(timeout, 0))[0] != []
+            self.__probeMetrics.addTiming("select", time.perf_counter_ns() - startTime)
+            return isReadable
+
+        def __getBatchIo(self):
+            if self.__batchIo is None:
+                self.__batchIo = IcmpHelperLibrary.IcmpBatchIo()
+            return self.__batchIo
+
+        def __updateKernelFilter(self, packetIdentifier):
+            filterIdentifiers = set(self.__filterIdentifiers or ())
+            filterIdentifiers.add(packetIdentifier)
+            if len(filterIdentifiers) > self.__maxFilterIdentifiers:
+                filterIdentifiers = set()
+            program = IcmpHelperLibrary.IcmpSession.buildKernelFilter(sorted(filterIdentifiers))
+            programBuffer = ctypes.create_string_buffer(program, len(program))
+            # struct sock_fprog: unsigned short instruction count, then a pointer to the instructions.
+            fprog = struct.pack("HP", len(program) // 8, ctypes.addressof(programBuffer))
+            try:
+                self.__mySocket.setsockopt(SOL_SOCKET, self.__SO_ATTACH_FILTER, fprog)
+            except OSError:
+                # No socket filters here; every packet keeps being parsed and matched in Python instead.
+                self.__kernelFilter = False
+                return
+            self.__filterIdentifiers = filterIdentifiers
+
+        # ############################################################################################################ #
+        # IcmpSession Public Functions                                                                                 #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def open(self):
+            # Opening an already open session is a no-op, so callers can always call open() before using the socket.
+            if self.__mySocket is None:
+                self.__mySocket = self.__transport.openSocket()
+                self.__mySocket.settimeout(self.__ipTimeout)
+                self.__mySocket.bind(("", 0))
+                if self.__receiveBufferSize > 0:
+                    # Many probes in flight means bursts of replies; the kernel silently drops whatever does not fit.
+                    self.__mySocket.setsockopt(SOL_SOCKET, SO_RCVBUF, self.__receiveBufferSize)
+                if self.__kernelTimestamps:
+                    try:
+                        self.__mySocket.setsockopt(SOL_SOCKET, self.__SO_TIMESTAMPNS, 1)
+                    except OSError:
+                        self.__kernelTimestamps = False     # Replies are timed in Python after the read instead
+                # The IcmpBatchIo and its buffers are only created by the first burst or drain, through
+                # __getBatchIo(), so sessions that never batch do not pay for them.
+                self.__ttl = 0
+            return self.__mySocket
+
+        def close(self):
+            if self.__mySocket is not None:
+                self.__mySocket.close()
+                self.__mySocket = None
+                self.__filterIdentifiers = None
+
+        def allocateSequenceNumbers(self, count=1):
+            # Returns the first of count consecutive sequence numbers (mod 2^16) that no earlier ping or trace on
+            # this session used. Restarting every trace at 0 would let a late reply to the previous trace match a
+            # probe of the next one.
+            firstSequenceNumber = self.__nextSequenceNumber
+            self.__nextSequenceNumber = (firstSequenceNumber + count) & 0xffff
+            return firstSequenceNumber
+
+        def sendTo(self, packetBytes, destinationIpAddress, ttl):
+            self.open()
+            self.setTtl(ttl)
+            if self.__kernelFilter:
+                self.__filterPacketIdentifier(packetBytes)
+            if self.__probeMetrics is None:
+                self.__mySocket.sendto(packetBytes, (destinationIpAddress, 0))
+                return
+            startTime = time.perf_counter_ns()
+            self.__mySocket.sendto(packetBytes, (destinationIpAddress, 0))
+            self.__probeMetrics.addTiming("send", time.perf_counter_ns() - startTime)
+            self.__probeMetrics.addProbesSent([(packetBytes, destinationIpAddress, ttl)])
+
+        def sendBurst(self, probes):
+            # Send a list of (packetBytes, destinationIpAddress, ttl) probes, in one sendmmsg call where possible;
+            # whatever the batch could not send goes out one sendTo at a time. Each entry needs its own buffer
+            # (template.stampBurstBuffer(i, n)), as stamp() restamps a single one. IcmpBatchIo copies every packet
+            # into its send slot before the call, so the buffers can be restamped as soon as this returns.
+            self.open()
+            if self.__kernelFilter:
+                for packetBytes, destinationIpAddress, ttl in probes:
+                    self.__filterPacketIdentifier(packetBytes)
+            sent = 0
+            if self.__batchIo is not False and len(probes) > 1:
+                startTime = time.perf_counter_ns()
+                try:
+                    sent = self.__getBatchIo().sendBurst(self.__mySocket.fileno(), probes)
+                except OSError as sendError:
+                    if sendError.errno in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                        self.__batchIo = False   # No per-message TTL or no sendmmsg: stay with sendTo
+                if self.__probeMetrics is not None and sent > 0:
+                    self.__probeMetrics.addTiming("send", time.perf_counter_ns() - startTime, sent)
+                    self.__probeMetrics.addProbesSent(probes[:sent])
+            for packetBytes, destinationIpAddress, ttl in probes[sent:]:
+                self.sendTo(packetBytes, destinationIpAddress, ttl)
+
+        def expireProbe(self, packetSequenceNumber):
+            # Called when a probe times out. A session with its own socket keeps no per-probe state, so there is
+            # nothing to release; a DispatchedIcmpSession stops routing the probe's reply.
+            pass
+
+        def receiveReply(self, clockOffset=None):
+            # Read one packet into the session's buffer and parse it in place. Returns an IcmpReply, or None for
+            # packets that do not answer an echo request. Call it once select (or the event loop) reports the socket
+            # readable; on a non-blocking socket with nothing queued it raises BlockingIOError. Loops draining the
+            # socket pass one getClockOffset() for the whole drain.
+            startTime = time.perf_counter_ns() if self.__probeMetrics is not None else 0
+            numberOfBytes, addr, timeReceived, isKernelTimestamp = self.__receiveInto(self.__recvBuffer, clockOffset)
+            icmpReply = IcmpHelperLibrary.IcmpReply.parse(self.__recvView, numberOfBytes, addr[0], timeReceived,
+                                                          IcmpHelperLibrary.IcmpPacket.ECHO_REQUEST_DATA_ENCODED,
+                                                          isKernelTimestamp)
+            if self.__probeMetrics is not None:
+                self.__probeMetrics.addTiming("receive", time.perf_counter_ns() - startTime)
+                if icmpReply is not None:
+                    self.__probeMetrics.addReplies([icmpReply])
+            return icmpReply
+
+        def waitForReply(self, timeout):
+            # Wait up to timeout seconds for the next packet and parse it. Returns None on timeout or for packets
+            # that do not answer an echo request; callers still check the reply is for one of their probes.
+            if not self.__waitReadable(timeout):
+                return None
+            return self.receiveReply()
+
+        def receiveReplies(self):
+            # Read every packet already queued without blocking and return the IcmpReplies among them: through
+            # recvmmsg where available, otherwise one recvfrom_into per packet.
+            if self.__batchIo is not False:
+                startTime = time.perf_counter_ns() if self.__probeMetrics is not None else 0
+                icmpReplies = self.__getBatchIo().receiveReplies(self.__mySocket.fileno(),
+                                                                 IcmpHelperLibrary.IcmpPacket.ECHO_REQUEST_DATA_ENCODED)
+                if self.__probeMetrics is not None and len(icmpReplies) > 0:
+                    self.__probeMetrics.addTiming("receive", time.perf_counter_ns() - startTime, len(icmpReplies))
+                    self.__probeMetrics.addReplies(icmpReplies)
+                return icmpReplies
+            icmpReplies = []
+            clockOffset = IcmpHelperLibrary.IcmpSession.getClockOffset()
+            while True:
+                # A socket with a timeout would wait inside recvfrom_into, so poll it first.
+                if self.__ipTimeout != 0 and select.select([self.__mySocket], [], [], 0)[0] == []:
+                    return icmpReplies
+                try:
+                    icmpReply = self.receiveReply(clockOffset)
+                except (BlockingIOError, InterruptedError):
+                    return icmpReplies
+                if icmpReply is not None:
+                    icmpReplies.append(icmpReply)
+
+        def waitForReplies(self, timeout):
+            # Wait up to timeout seconds for the socket to become readable, then drain it. Returns a possibly empty
+            # list of IcmpReplies.
+            if not self.__waitReadable(timeout):
+                return []
+            return self.receiveReplies()
+
+    # ################################################################################################################ #
+    # Class AsyncIcmpSession                                                                                           #
+    #                                                                                                                  #
+    # Runs an IcmpSession socket in non-blocking mode under an asyncio event loop. One loop reader drains the socket   #
+    # and resolves the waiting probe's future by (identifier, sequence number), so any number of pings and traceroutes #
+    # can have probes in flight on the same loop and socket without a thread per target.                               #
+    #                                                                                                                  #
+    # ################################################################################################################ #
+    class AsyncIcmpSession:
+        # ############################################################################################################ #
+        # AsyncIcmpSession Class Scope Variables                                                                       #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        __session = None                # IcmpSession whose socket is read by the event loop
+        __loop = None                   # Event loop the reader is registered on, None while closed
+        __waiters = None                # (identifier, sequence number) -> future of the probe awaiting that reply
+        __packetIdentifier = 0
+        __echoRequestTemplate = None    # IcmpEchoRequestTemplate restamped for every probe
+        __probeMetrics = None           # ProbeMetrics shared with __session, None to measure nothing
+
+        # ############################################################################################################ #
+        # AsyncIcmpSession Constructors                                                                                #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def __init__(self, transport=None, probeMetrics=None):
+            # A timeout of 0 puts the socket in non-blocking mode. The receive buffer is sized for thousands of
+            # replies arriving between two loop iterations.
+            self.__session = IcmpHelperLibrary.IcmpSession(0, 4 * 1024 * 1024, transport=transport,
+                                                           probeMetrics=probeMetrics)
+            self.__probeMetrics = probeMetrics
+            self.__loop = None
+            self.__waiters = {}
+            self.__packetIdentifier = self.__session.getPacketIdentifier()
+            self.__echoRequestTemplate = IcmpHelperLibrary.IcmpEchoRequestTemplate(self.__packetIdentifier)
+
+        # ############################################################################################################ #
+        # AsyncIcmpSession Getters                                                                                     #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def getLoop(self):
+            return self.__loop
+
+        def getPacketIdentifier(self):
+            return self.__packetIdentifier
+
+        def getOutstandingProbeCount(self):
+            return len(self.__waiters)
+
+        # ############################################################################################################ #
+        # AsyncIcmpSession Private Functions                                                                           #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def __onReadable(self):
+            # Drain everything the kernel has queued before returning to the loop; one wakeup may cover many replies.
+            clockOffset = IcmpHelperLibrary.IcmpSession.getClockOffset()
+            while True:
+                try:
+                    icmpReply = self.__session.receiveReply(clockOffset)
+                except (BlockingIOError, InterruptedError):
+                    return
+                if icmpReply is None:
+                    continue
+                waiter = self.__waiters.pop((icmpReply.packetIdentifier, icmpReply.packetSequenceNumber), None)
+                if waiter is not None and not waiter.done():
+                    waiter.set_result(icmpReply)
+                elif self.__probeMetrics is not None:
+                    self.__probeMetrics.addMismatchedReply(icmpReply)
+
+        def __allocateSequenceNumber(self):
+            # Sequence numbers come from the session's running counter, skipping any that still have a probe in
+            # flight.
+            for attempt in range(65536):
+                packetSequenceNumber = self.__session.allocateSequenceNumbers()
+                if (self.__packetIdentifier, packetSequenceNumber) not in self.__waiters:
+                    return packetSequenceNumber
+            raise RuntimeError("All 65536 ICMP sequence numbers have a probe in flight")
+
+        # ############################################################################################################ #
+        # AsyncIcmpSession Public Functions                                                                            #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def open(self):
+            # Must be called from inside the running event loop the session will be used on.
+            if self.__loop is None:
+                loop = asyncio.get_running_loop()
+                loop.add_reader(self.__session.open().fileno(), self.__onReadable)
+                self.__loop = loop
+
+        def close(self):
+            if self.__loop is not None:
+                if not self.__loop.is_closed():
+                    self.__loop.remove_reader(self.__session.getSocket().fileno())
+                self.__loop = None
+            self.__session.close()
+            for waiter in self.__waiters.values():
+                if not waiter.done():
+                    waiter.cancel()
+            self.__waiters = {}
+
+        async def sendProbe(self, destinationIpAddress, ttl, timeout):
+            # Send one echo request and wait for its reply. Returns a ProbeResult; address, type, code and RTT are
+            # None when the probe timed out.
+            self.open()
+            packetSequenceNumber = self.__allocateSequenceNumber()
+            probeKey = (self.__packetIdentifier, packetSequenceNumber)
+            waiter = self.__loop.create_future()
+            self.__waiters[probeKey] = waiter
+            try:
+                # Stamping the shared template, setting the TTL and sending must happen without yielding, or another
+                # probe could change them in between. A full send buffer is retried on the next loop iteration.
+                # The send time is taken first, as the kernel may timestamp a loopback reply before sendTo returns.
+                while True:
+                    try:
+                        sendTime = time.perf_counter_ns()
+                        packetBytes = self.__echoRequestTemplate.stamp(packetSequenceNumber, sendTime)
+                        if self.__probeMetrics is not None:
+                            self.__probeMetrics.addTiming("build", time.perf_counter_ns() - sendTime)
+                        self.__session.sendTo(packetBytes, destinationIpAddress, ttl)
+                        break
+                    except (BlockingIOError, InterruptedError):
+                        await asyncio.sleep(0)
+                deadline = self.__loop.time() + timeout
+                while True:
+                    try:
+                        icmpReply = await asyncio.wait_for(waiter, deadline - self.__loop.time())
+                    except asyncio.TimeoutError:
+                        if self.__probeMetrics is not None:
+                            self.__probeMetrics.addTimeout(destinationIpAddress, ttl, packetSequenceNumber)
+                        return IcmpHelperLibrary.ProbeResult(ttl, packetSequenceNumber, None, None, None, None, False)
+                    if icmpReply.matchesSendTime(sendTime):
+                        break
+                    # A late reply to an earlier probe with this sequence number; keep waiting for ours.
+                    if self.__probeMetrics is not None:
+                        self.__probeMetrics.addMismatchedReply(icmpReply)
+                    waiter = self.__loop.create_future()
+                    self.__waiters[probeKey] = waiter
+            finally:
+                self.__waiters.pop(probeKey, None)
+
+            return IcmpHelperLibrary.ProbeResult(ttl, packetSequenceNumber, icmpReply.address, icmpReply.icmpType,
+                                                 icmpReply.icmpCode, (icmpReply.timeReceived - sendTime) / 1e6,
+                                                 icmpReply.isValidResponse)
+
+    # ################################################################################################################ #
+    # Class IcmpReceiveDispatcher                                                                                      #
+    #                                                                                                                  #
+    # One raw socket and one receiver thread for any number of sessions in the process. The thread drains the socket, #
+    # takes (identifier, sequence number) from the Echo Reply header or from the request quoted in a Time Exceeded or  #
+    # Destination Unreachable, and hands the reply to whoever registered that key, with a single dict lookup.         #
+    # Replies nobody is waiting for (late answers, the system ping, other processes) are counted and dropped.          #
+    #                                                                                                                  #
+    # ################################################################################################################ #
+    class IcmpReceiveDispatcher:
+        # ############################################################################################################ #
+        # IcmpReceiveDispatcher Class Scope Variables                                                                  #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        __sharedDispatcher = None       # Process-wide dispatcher returned by getShared()
+        __sharedLock = threading.Lock()
+        __session = None                # IcmpSession owning the shared socket
+        __waiters = None                # (identifier, sequence number) -> queue the reply is put on
+        __lock = None                   # Guards __waiters and the counters
+        __sendLock = None               # Setting the TTL and sending must not interleave between threads
+        __receiverThread = None         # Thread draining the socket, None until the first registration
+        __isClosed = False
+        __dispatchedCount = 0           # Replies handed to a waiting probe
+        __unmatchedCount = 0            # Replies to an echo request nobody was waiting for
+
+        # ############################################################################################################ #
+        # IcmpReceiveDispatcher Constructors                                                                           #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def __init__(self, receiveBufferSize=4 * 1024 * 1024, transport=None, probeMetrics=None):
+            # A timeout of 0 puts the socket in non-blocking mode so the receiver can drain it after each select.
+            # probeMetrics, if given, counts and times the shared socket's IO and the replies nobody waited for.
+            self.__session = IcmpHelperLibrary.IcmpSession(0, receiveBufferSize, transport=transport,
+                                                           probeMetrics=probeMetrics)
+            self.__waiters = {}
+            self.__lock = threading.Lock()
+            self.__sendLock = threading.Lock()
+            self.__receiverThread = None
+            self.__isClosed = False
+            self.__dispatchedCount = 0
+            self.__unmatchedCount = 0
+
+        @staticmethod
+        def getShared():
+            with IcmpHelperLibrary.IcmpReceiveDispatcher.__sharedLock:
+                if IcmpHelperLibrary.IcmpReceiveDispatcher.__sharedDispatcher is None:
+                    IcmpHelperLibrary.IcmpReceiveDispatcher.__sharedDispatcher = \
+                        IcmpHelperLibrary.IcmpReceiveDispatcher()
+                return IcmpHelperLibrary.IcmpReceiveDispatcher.__sharedDispatcher
+
+        # ############################################################################################################ #
+        # IcmpReceiveDispatcher Getters                                                                                #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def getDispatchedCount(self):
+            return self.__dispatchedCount
+
+        def getUnmatchedCount(self):
+            return self.__unmatchedCount
+
+        def getWaitingCount(self):
+            return len(self.__waiters)
+
+        # ############################################################################################################ #
+        # IcmpReceiveDispatcher Private Functions                                                                      #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def __checkOpen(self):
+            if self.__isClosed:
+                raise ValueError("IcmpReceiveDispatcher is closed")
+
+        def __startReceiver(self):
+            # Called with __lock held.
+            if self.__receiverThread is None:
+                self.__session.open()
+                self.__receiverThread = threading.Thread(target=self.__receive, name="IcmpReceiveDispatcher",
+                                                         daemon=True)
+                self.__receiverThread.start()
+
+        def __receive(self):
+            # The select timeout only bounds how long close() waits for the thread to notice.
+            mySocket = self.__session.getSocket()
+            while not self.__isClosed:
+                try:
+                    whatReady = select.select([mySocket], [], [], 0.5)
+                except (OSError, ValueError):
+                    return  # Socket closed under us
+                if whatReady[0] == []:  # Timeout
+                    continue
+                try:
+                    icmpReplies = self.__session.receiveReplies()
+                except OSError:
+                    return
+                for icmpReply in icmpReplies:
+                    with self.__lock:
+                        replies = self.__waiters.pop((icmpReply.packetIdentifier, icmpReply.packetSequenceNumber),
+                                                     None)
+                        if replies is None:
+                            self.__unmatchedCount += 1
+                        else:
+                            self.__dispatchedCount += 1
+                    if replies is not None:
+                        replies.put(icmpReply)
+                    elif self.__session.getProbeMetrics() is not None:
+                        self.__session.getProbeMetrics().addMismatchedReply(icmpReply)
+
+        # ############################################################################################################ #
+        # IcmpReceiveDispatcher Public Functions                                                                       #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def register(self, probeKey, replies):
+            # Route the reply for probeKey, an (identifier, sequence number) pair, to replies (anything with a
+            # thread-safe put). Register before sending, so a fast reply cannot arrive first.
+            with self.__lock:
+                self.__checkOpen()
+                self.__waiters[probeKey] = replies
+                self.__startReceiver()
+
+        def unregister(self, probeKey):
+            with self.__lock:
+                self.__waiters.pop(probeKey, None)
+
+        def sendTo(self, packetBytes, destinationIpAddress, ttl):
+            with self.__sendLock:
+                self.__checkOpen()
+                self.__session.sendTo(packetBytes, destinationIpAddress, ttl)
+
+        def sendBurst(self, probes):
+            with self.__sendLock:
+                self.__checkOpen()
+                self.__session.sendBurst(probes)
+
+        def openSession(self):
+            # A session with its own identifier whose probes are sent and received through this dispatcher.
+            self.__checkOpen()
+            return IcmpHelperLibrary.DispatchedIcmpSession(self)
+
+        def close(self):
+            # A closed dispatcher refuses further use. Closing the shared one makes getShared() start a new one.
+            with IcmpHelperLibrary.IcmpReceiveDispatcher.__sharedLock:
+                if IcmpHelperLibrary.IcmpReceiveDispatcher.__sharedDispatcher is self:
+                    IcmpHelperLibrary.IcmpReceiveDispatcher.__sharedDispatcher = None
+            with self.__lock:
+                self.__isClosed = True
+                self.__waiters = {}
+            if self.__receiverThread is not None:
+                self.__receiverThread.join()
+                self.__receiverThread = None
+            with self.__sendLock:
+                self.__session.close()
+
+    # ################################################################################################################ #
+    # Class DispatchedIcmpSession                                                                                      #
+    #                                                                                                                  #
+    # Drop-in replacement for IcmpSession backed by an IcmpReceiveDispatcher: the same sendTo and waitForReply calls,  #
+    # but without a socket of its own. Only replies to this session's identifier ever reach it.                       #
+    #                                                                                                                  #
+    # ################################################################################################################ #
+    class DispatchedIcmpSession:
+        # ############################################################################################################ #
+        # DispatchedIcmpSession Class Scope Variables                                                                  #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        __dispatcher = None             # IcmpReceiveDispatcher that sends and receives for this session
+        __packetIdentifier = 0
+        __nextSequenceNumber = 0
+        __replies = None                # Queue the dispatcher puts this session's replies on
+        __registeredKeys = None         # Probe keys still registered with the dispatcher
+        __isOpen = False
+
+        # ############################################################################################################ #
+        # DispatchedIcmpSession Constructors                                                                           #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def __init__(self, dispatcher):
+            self.__dispatcher = dispatcher
+            self.__packetIdentifier = IcmpHelperLibrary.IcmpSession.allocatePacketIdentifier()
+            self.__nextSequenceNumber = 0
+            self.__replies = queue.SimpleQueue()
+            self.__registeredKeys = set()
+            self.__isOpen = True
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, excType, excValue, traceback):
+            self.close()
+
+        # ############################################################################################################ #
+        # DispatchedIcmpSession Getters                                                                                #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def getDispatcher(self):
+            return self.__dispatcher
+
+        def getPacketIdentifier(self):
+            return self.__packetIdentifier
+
+        def isOpen(self):
+            return self.__isOpen
+
+        # ############################################################################################################ #
+        # DispatchedIcmpSession Public Functions                                                                       #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def open(self):
+            self.__isOpen = True
+
+        def close(self):
+            for probeKey in self.__registeredKeys:
+                self.__dispatcher.unregister(probeKey)
+            self.__registeredKeys = set()
+            self.__isOpen = False
+
+        def allocateSequenceNumbers(self, count=1):
+            # Same running counter as IcmpSession.allocateSequenceNumbers.
+            firstSequenceNumber = self.__nextSequenceNumber
+            self.__nextSequenceNumber = (firstSequenceNumber + count) & 0xffff
+            return firstSequenceNumber
+
+        def sendTo(self, packetBytes, destinationIpAddress, ttl):
+            # The probe key is read back from the echo request header (identifier and sequence number at offset 4).
+            probeKey = struct.unpack_from("!HH", packetBytes, 4)
+            self.__registeredKeys.add(probeKey)
+            self.__dispatcher.register(probeKey, self.__replies)
+            self.__dispatcher.sendTo(packetBytes, destinationIpAddress, ttl)
+
+        def sendBurst(self, probes):
+            for packetBytes, destinationIpAddress, ttl in probes:
+                probeKey = struct.unpack_from("!HH", packetBytes, 4)
+                self.__registeredKeys.add(probeKey)
+                self.__dispatcher.register(probeKey, self.__replies)
+            self.__dispatcher.sendBurst(probes)
+
+        def waitForReply(self, timeout):
+            # Returns the next reply routed to this session, or None when none arrives within timeout seconds.
+            try:
+                icmpReply = self.__replies.get(timeout=max(timeout, 0))
+            except queue.Empty:
+                return None
+            self.__registeredKeys.discard((icmpReply.packetIdentifier, icmpReply.packetSequenceNumber))
+            return icmpReply
+
+        def waitForReplies(self, timeout):
+            # Returns every reply routed to this session so far, waiting up to timeout seconds for the first.
+            icmpReply = self.waitForReply(timeout)
+            if icmpReply is None:
+                return []
+            icmpReplies = [icmpReply]
+            while True:
+                try:
+                    icmpReply = self.__replies.get_nowait()
+                except queue.Empty:
+                    return icmpReplies
+                self.__registeredKeys.discard((icmpReply.packetIdentifier, icmpReply.packetSequenceNumber))
+                icmpReplies.append(icmpReply)
+
+        def expireProbe(self, packetSequenceNumber):
+            # A probe that timed out no longer waits for its reply; a late one is counted as unmatched and dropped
+            # by the dispatcher instead of being queued here.
+            probeKey = (self.__packetIdentifier, packetSequenceNumber)
+            if probeKey in self.__registeredKeys:
+                self.__registeredKeys.discard(probeKey)
+                self.__dispatcher.unregister(probeKey)
+
+    # ################################################################################################################ #
+    # Class SimulatedNetwork                                                                                           #
+    #                                                                                                                  #
+    # References:                                                                                                      #
+    # https://www.rfc-editor.org/rfc/rfc792 (Internet Control Message Protocol)                                        #
+    # https://www.rfc-editor.org/rfc/rfc1812#section-4.3.2.3 (Requirements for IP Version 4 Routers)                   #
+    # https://www.rfc-editor.org/rfc/rfc2544 (Benchmarking Methodology: the 198.18.0.0/15 test addresses)              #
+    #                                                                                                                  #
+    # An in-process network for load tests and benchmarks without root or a real network. Pass it as the transport of  #
+    # an IcmpSession, AsyncIcmpSession, IcmpReceiveDispatcher or IcmpHelperLibrary and every probe is answered by the  #
+    # model instead of the internet. Each path is a list of routers, each a SimulatedRouter with its own link latency, #
+    # jitter, loss, ICMP rate limit, silence and quoting behaviour, ending at a destination that sends Echo Replies,   #
+    # is silent, or has its last router send Destination Unreachable. Replies are full IP packets as a raw socket      #
+    # reads them: Echo Replies echo the probe, and errors quote its IP header and as much of it as the router quotes.  #
+    # A delivery thread hands each reply to its socket once its RTT has passed, and the socket's kernel timestamp is   #
+    # that delivery time, so measured RTTs match the model however late the reader gets to them.                       #
+    #                                                                                                                  #
+    # ################################################################################################################ #
+    class SimulatedNetwork:
+        # ############################################################################################################ #
+        # SimulatedNetwork Class Scope Variables                                                                       #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        __ipHeaderStruct = struct.Struct("!BBHHHBBH4s4s")
+        __errorHeaderStruct = struct.Struct("!BBHI")    # Type, code, checksum, unused
+        __routerBase = 0xc6120000                       # 198.18.0.0/16 for routers built by addTree
+        __targetBase = 0xc6130000                       # 198.19.0.0/16 for targets built by addTree
+        __replyKinds = ("echo", "unreachable", "none")
+
+        __localAddress = None           # Source address of every probe, packed
+        __routers = None                # Address -> SimulatedRouter
+        __paths = None                  # Destination -> (router addresses, reply kind)
+        __rateBuckets = None            # Router address -> [tokens, time refilled in seconds]
+        __random = None                 # random.Random, so a seeded network behaves the same on every run
+        __ipIdentifier = 0
+        __lock = None                   # Guards the topology, rate buckets, random state and counters
+        __condition = None              # Guards __events; the delivery thread waits on it
+        __events = None                 # Heap of (delivery time in ns, order, SimulatedIcmpSocket, reply bytes)
+        __eventOrder = 0
+        __deliveryThread = None
+        __isClosed = False
+        __probesReceived = 0
+        __repliesSent = 0
+        __probesLost = 0                # Lost on a link in either direction
+        __repliesSuppressed = 0         # Not sent by a silent router or a silent destination, or rate limited
+
+        # ############################################################################################################ #
+        # SimulatedNetwork Constructors                                                                                #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def __init__(self, seed=0, localAddress="198.18.0.1"):
+            self.__localAddress = inet_aton(localAddress)
+            self.__routers = {}
+            self.__paths = {}
+            self.__rateBuckets = {}
+            self.__random = random.Random(seed)
+            self.__ipIdentifier = 0
+            self.__lock = threading.Lock()
+            self.__condition = threading.Condition()
+            self.__events = []
+            self.__eventOrder = 0
+            self.__deliveryThread = None
+            self.__isClosed = False
+            self.__probesReceived = 0
+            self.__repliesSent = 0
+            self.__probesLost = 0
+            self.__repliesSuppressed = 0
+
+        # ############################################################################################################ #
+        # SimulatedNetwork Getters                                                                                     #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def getLocalAddress(self):
+            return inet_ntoa(self.__localAddress)
+
+        def getRouter(self, address):
+            # The SimulatedRouter for address; addresses never added get a router with every default.
+            return self.__routers.get(address) or IcmpHelperLibrary.SimulatedRouter(address)
+
+        def getPath(self, destinationIpAddress):
+            # (router addresses, reply kind) of the path to destinationIpAddress, None when it has no route.
+            return self.__paths.get(destinationIpAddress)
+
+        def getDestinations(self):
+            return list(self.__paths)
+
+        def getProbesReceived(self):
+            return self.__probesReceived
+
+        def getRepliesSent(self):
+            return self.__repliesSent
+
+        def getProbesLost(self):
+            return self.__probesLost
+
+        def getRepliesSuppressed(self):
+            return self.__repliesSuppressed
+
+        def isRawSocket(self):
+            return False
+
+        # ############################################################################################################ #
+        # SimulatedNetwork Private Functions                                                                           #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def __buildIpHeader(self, totalLength, ttl, sourceAddress, destinationAddress):
+            # Called with __lock held, for the IP identifier.
+            self.__ipIdentifier = (self.__ipIdentifier + 1) & 0xffff
+            ipHeader = bytearray(IcmpHelperLibrary.SimulatedNetwork.__ipHeaderStruct.pack(
+                0x45, 0, totalLength, self.__ipIdentifier, 0, ttl, IPPROTO_ICMP, 0, sourceAddress, destinationAddress))
+            struct.pack_into("!H", ipHeader, 10, IcmpHelperLibrary.IcmpChecksum.calculate(ipHeader))
+            return ipHeader
+
+        def __buildReply(self, icmpType, icmpCode, responder, destinationIpAddress, probe, arrivingTtl, hopsBack):
+            # The packet a raw socket would read for this reply, IP header included. Called with __lock held.
+            if icmpType == 0:
+                icmpMessage = bytearray(probe)
+                icmpMessage[0] = 0
+                icmpMessage[2:4] = b'\x00\x00'
+            else:
+                # The probe as the responder received it: its IP header with the TTL left on arrival, then the whole
+                # echo request (RFC 1812) or its first 8 bytes (RFC 792).
+                quotedBytes = len(probe) if self.getRouter(responder).quotesWholeProbe else 8
+                quotedIpHeader = self.__buildIpHeader(20 + len(probe), arrivingTtl, self.__localAddress,
+                                                      inet_aton(destinationIpAddress))
+                icmpMessage = bytearray(IcmpHelperLibrary.SimulatedNetwork.__errorHeaderStruct.pack(
+                    icmpType, icmpCode, 0, 0)) + quotedIpHeader + probe[:quotedBytes]
+            struct.pack_into("!H", icmpMessage, 2, IcmpHelperLibrary.IcmpChecksum.calculate(icmpMessage))
+            return bytes(self.__buildIpHeader(20 + len(icmpMessage), 64 - hopsBack, inet_aton(responder),
+                                              self.__localAddress) + icmpMessage)
+
+        def __takeToken(self, simulatedRouter, timeNow):
+            # ICMP error rate limit of one router. Called with __lock held.
+            if simulatedRouter.rateLimit <= 0:
+                return True
+            bucket = self.__rateBuckets.get(simulatedRouter.address)
+            if bucket is None:
+                bucket = [simulatedRouter.rateBurst, timeNow]
+                self.__rateBuckets[simulatedRouter.address] = bucket
+            bucket[0] = min(simulatedRouter.rateBurst, bucket[0] + (timeNow - bucket[1]) * simulatedRouter.rateLimit)
+            bucket[1] = timeNow
+            if bucket[0] < 1:
+                return False
+            bucket[0] -= 1
+            return True
+
+        def __schedule(self, deliveryTime, simulatedSocket, packetBytes):
+            with self.__condition:
+                if self.__deliveryThread is None:
+                    self.__deliveryThread = threading.Thread(target=self.__deliver, name="SimulatedNetwork",
+                                                             daemon=True)
+                    self.__deliveryThread.start()
+                self.__eventOrder += 1
+                heapq.heappush(self.__events, (deliveryTime, self.__eventOrder, simulatedSocket, packetBytes))
+                if self.__events[0][1] == self.__eventOrder:
+                    self.__condition.notify()       # The new reply is due before the one the thread waits for
+
+        def __deliver(self):
+            while True:
+                with self.__condition:
+                    while not self.__isClosed and (len(self.__events) == 0 or
+                                                   self.__events[0][0] > time.perf_counter_ns()):
+                        self.__condition.wait(None if len(self.__events) == 0 else
+                                              (self.__events[0][0] - time.perf_counter_ns()) / 1e9)
+                    if self.__isClosed:
+                        return
+                    timeNow = time.perf_counter_ns()
+                    dueEvents = []
+                    while len(self.__events) > 0 and self.__events[0][0] <= timeNow:
+                        dueEvents.append(heapq.heappop(self.__events))
+                for deliveryTime, order, simulatedSocket, packetBytes in dueEvents:
+                    simulatedSocket.deliver(packetBytes, deliveryTime)
+
+        # ############################################################################################################ #
+        # SimulatedNetwork Public Functions                                                                            #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def addRouter(self, address, latency=1.0, jitter=0.0, loss=0.0, rateLimit=0, rateBurst=10, isSilent=False,
+                      quotesWholeProbe=True):
+            # Add or replace a router; see SimulatedRouter for the parameters. Destinations are routers too: their
+            # latency, jitter and loss apply to the last link of the path.
+            if latency < 0 or jitter < 0 or not 0 <= loss <= 1 or rateLimit < 0 or rateBurst < 1:
+                raise ValueError("invalid router parameters for %s" % address)
+            simulatedRouter = IcmpHelperLibrary.SimulatedRouter(address, latency, jitter, loss, rateLimit, rateBurst,
+                                                                isSilent, quotesWholeProbe)
+            with self.__lock:
+                self.__routers[address] = simulatedRouter
+                self.__rateBuckets.pop(address, None)
+            return simulatedRouter
+
+        def addPath(self, destinationIpAddress, routerAddresses, reply="echo"):
+            # Route destinationIpAddress through routerAddresses, the routers at TTL 1, 2 and so on. reply is what a
+            # probe that gets past the last router draws: "echo" for an Echo Reply from the destination, "none" for
+            # no reply at all, or "unreachable" for a Destination Unreachable (host unreachable) from the last router.
+            if reply not in IcmpHelperLibrary.SimulatedNetwork.__replyKinds:
+                raise ValueError("reply must be one of %s, not %r" % (IcmpHelperLibrary.SimulatedNetwork.__replyKinds,
+                                                                      reply))
+            if reply == "unreachable" and len(routerAddresses) == 0:
+                raise ValueError("an unreachable destination needs a router to send the Destination Unreachable")
+            with self.__lock:
+                self.__paths[destinationIpAddress] = (tuple(routerAddresses), reply)
+
+        def addTree(self, targetCount, fanout=16, coreHops=2, latency=2.0, jitter=0.5, loss=0.0, rateLimit=100,
+                    silentRouterFraction=0.05, silentTargetFraction=0.1, unreachableTargetFraction=0.05):
+            # Build a tree-shaped topology for targetCount targets and return their addresses: coreHops routers
+            # every path shares, then levels of routers fanning out fanout ways down to one edge router per fanout
+            # targets. Router links take between half and one and a half times latency (ms), every router is rate
+            # limited to rateLimit ICMP errors per second, and the given fractions of routers and targets are silent
+            # or unreachable. Routers are numbered from 198.18.0.2 and targets from 198.19.0.1, so a network holds
+            # at most 65534 of each.
+            if targetCount < 1 or targetCount > 65534 or fanout < 2:
+                raise ValueError("addTree needs 1 to 65534 targets and a fanout of at least 2")
+            routerNumbers = iter(range(2, 0xffff))
+
+            def addTreeRouter():
+                address = inet_ntoa(struct.pack("!I", IcmpHelperLibrary.SimulatedNetwork.__routerBase +
+                                                next(routerNumbers)))
+                self.addRouter(address, latency * (0.5 + self.__random.random()), jitter, loss, rateLimit,
+                               max(1, rateLimit), self.__random.random() < silentRouterFraction)
+                return address
+
+            corePath = [addTreeRouter() for i in range(coreHops)]
+            levels = [[addTreeRouter()]]                     # Level 0 is the root below the core
+            edgeRouterCount = (targetCount + fanout - 1) // fanout
+            while len(levels[-1]) < edgeRouterCount:
+                levels.append([addTreeRouter() for i in range(min(len(levels[-1]) * fanout, edgeRouterCount))])
+
+            targets = []
+            for targetNumber in range(targetCount):
+                routerAddresses = list(corePath)
+                index = targetNumber // fanout
+                branch = []
+                for level in reversed(levels):
+                    branch.append(level[index])
+                    index //= fanout
+                routerAddresses += reversed(branch)
+                target = inet_ntoa(struct.pack("!I", IcmpHelperLibrary.SimulatedNetwork.__targetBase +
+                                                targetNumber + 1))
+                self.addRouter(target, latency * (0.5 + self.__random.random()), jitter, loss)
+                draw = self.__random.random()
+                if draw < silentTargetFraction:
+                    self.addPath(target, routerAddresses, "none")
+                elif draw < silentTargetFraction + unreachableTargetFraction:
+                    self.addPath(target, routerAddresses, "unreachable")
+                else:
+                    self.addPath(target, routerAddresses)
+                targets.append(target)
+            return targets
+
+        def openSocket(self):
+            return IcmpHelperLibrary.SimulatedIcmpSocket(self)
+
+        def sendProbe(self, simulatedSocket, probe, destinationIpAddress, ttl):
+            # Called by SimulatedIcmpSocket.sendto for every echo request: works out which reply, if any, the probe
+            # draws and schedules its delivery. Destinations without a path swallow every probe.
+            timeNow = time.perf_counter_ns()
+            with self.__lock:
+                self.__probesReceived += 1
+                path = self.__paths.get(destinationIpAddress)
+                if path is None or ttl < 1 or len(probe) < 8 or probe[0] != 8:
+                    self.__repliesSuppressed += 1
+                    return
+                routerAddresses, reply = path
+                if ttl <= len(routerAddresses):
+                    icmpType, icmpCode = 11, 0                  # Time Exceeded in transit
+                    traversed = routerAddresses[:ttl]
+                elif reply == "echo":
+                    icmpType, icmpCode = 0, 0
+                    traversed = routerAddresses + (destinationIpAddress,)
+                elif reply == "unreachable":
+                    icmpType, icmpCode = 3, 1                   # Host unreachable
+                    traversed = routerAddresses
+                else:
+                    traversed = routerAddresses + (destinationIpAddress,)
+                    icmpType, icmpCode = None, None
+
+                rtt = 0.0
+                for address in traversed:
+                    simulatedRouter = self.getRouter(address)
+                    if simulatedRouter.loss > 0 and (self.__random.random() < simulatedRouter.loss or
+                                                     (icmpType is not None and
+                                                      self.__random.random() < simulatedRouter.loss)):
+                        self.__probesLost += 1
+                        return
+                    rtt += 2 * simulatedRouter.latency + self.__random.random() * simulatedRouter.jitter
+                responder = traversed[-1]
+                if icmpType is None or (icmpType != 0 and (self.getRouter(responder).isSilent or
+                                                           not self.__takeToken(self.getRouter(responder),
+                                                                                timeNow / 1e9))):
+                    self.__repliesSuppressed += 1
+                    return
+                self.__repliesSent += 1
+                packetBytes = self.__buildReply(icmpType, icmpCode, responder, destinationIpAddress, probe,
+                                                ttl - len(traversed) + 1, len(traversed) - 1)
+            self.__schedule(timeNow + int(rtt * 1e6), simulatedSocket, packetBytes)
+
+        def close(self):
+            # Stops the delivery thread; replies not yet delivered are dropped.
+            with self.__condition:
+                self.__isClosed = True
+                self.__events = []
+                self.__condition.notify()
+            if self.__deliveryThread is not None:
+                self.__deliveryThread.join()
+                self.__deliveryThread = None
+
+    # ################################################################################################################ #
+    # Class SimulatedIcmpSocket                                                                                        #
+    #                                                                                                                  #
+    # The socket a SimulatedNetwork hands an IcmpSession: the subset of the raw socket API the session uses. Delivered #
+    # replies wait in a queue bounded by SO_RCVBUF, as in the kernel, and a pipe carries one byte per queued reply so  #
+    # select and the asyncio event loop see the socket readable exactly when a reply is waiting. With SO_TIMESTAMPNS   #
+    # set, recvmsg_into returns each reply's delivery time as its kernel timestamp. Socket filters are not supported,  #
+    # so sessions match replies in Python.                                                                             #
+    #                                                                                                                  #
+    # ################################################################################################################ #
+    class SimulatedIcmpSocket:
+        # ############################################################################################################ #
+        # SimulatedIcmpSocket Class Scope Variables                                                                    #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        __SO_TIMESTAMPNS = 35
+        __network = None                # SimulatedNetwork the probes are sent into
+        __readFd = -1                   # Pipe the fileno is, one byte per queued reply
+        __writeFd = -1
+        __replies = None                # deque of (reply bytes, delivery time in ns)
+        __queuedBytes = 0
+        __receiveBufferSize = 212992    # Linux's default rmem_default
+        __timeout = None                # As socket.settimeout: None blocks, 0 never blocks
+        __ttl = 64
+        __kernelTimestamps = False
+        __lock = None                   # Guards __replies and __queuedBytes against the delivery thread
+        __droppedCount = 0              # Replies dropped because the receive buffer was full
+
+        # ############################################################################################################ #
+        # SimulatedIcmpSocket Constructors                                                                             #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def __init__(self, network):
+            self.__network = network
+            self.__readFd, self.__writeFd = os.pipe()
+            os.set_blocking(self.__readFd, False)
+            os.set_blocking(self.__writeFd, False)
+            self.__replies = collections.deque()
+            self.__queuedBytes = 0
+            self.__receiveBufferSize = 212992
+            self.__timeout = None
+            self.__ttl = 64
+            self.__kernelTimestamps = False
+            self.__lock = threading.Lock()
+            self.__droppedCount = 0
+
+        # ############################################################################################################ #
+        # SimulatedIcmpSocket Getters                                                                                  #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def fileno(self):
+            return self.__readFd
+
+        def getDroppedCount(self):
+            return self.__droppedCount
+
+        # ############################################################################################################ #
+        # SimulatedIcmpSocket Setters                                                                                  #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def settimeout(self, timeout):
+            self.__timeout = timeout
+
+        def setsockopt(self, level, option, value):
+            if level == IPPROTO_IP and option == IP_TTL:
+                self.__ttl, = struct.unpack("I", value)
+            elif level == SOL_SOCKET and option == SO_RCVBUF:
+                self.__receiveBufferSize = 2 * value   # The kernel doubles it for bookkeeping overhead as well
+            elif level == SOL_SOCKET and option == self.__SO_TIMESTAMPNS:
+                self.__kernelTimestamps = bool(value)
+            else:
+                raise OSError(errno.ENOPROTOOPT, "Protocol not available")
+
+        # ############################################################################################################ #
+        # SimulatedIcmpSocket Private Functions                                                                        #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def __readReply(self, buffer):
+            # Take the next queued reply, honouring the socket timeout like a real recv.
+            if self.__timeout != 0 and select.select([self.__readFd], [], [], self.__timeout)[0] == []:
+                raise TimeoutError("timed out")
+            os.read(self.__readFd, 1)                   # BlockingIOError when nothing is queued
+            with self.__lock:
+                packetBytes, deliveryTime = self.__replies.popleft()
+                self.__queuedBytes -= len(packetBytes)
+            numberOfBytes = min(len(packetBytes), len(buffer))
+            buffer[:numberOfBytes] = packetBytes[:numberOfBytes]
+            return numberOfBytes, (inet_ntoa(packetBytes[12:16]), 0), deliveryTime
+
+        # ############################################################################################################ #
+        # SimulatedIcmpSocket Public Functions                                                                         #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        #                                                                                                              #
+        # ############################################################################################################ #
+        def bind(self, address):
+            pass
+
+        def sendto(self, packetBytes, address):
+            self.__network.sendProbe(self, bytes(packetBytes), address[0], self.__ttl)
+            return len(packetBytes)
+
+        def deliver(self, packetBytes, deliveryTime):
+            # Called by the network's delivery thread. A full receive buffer drops the reply, as the kernel does.
+            with self.__lock:
+                if self.__readFd < 0 or self.__queuedBytes + len(packetBytes) > self.__receiveBufferSize:
+                    self.__droppedCount += 1
+                    return
+                try:
+                    os.write(self.__writeFd, b'\x00')
+                except BlockingIOError:
+                    self.__droppedCount += 1            # The pipe itself is full
+                    return
+                self.__replies.append((packetBytes, deliveryTime))
+                self.__queuedBytes += len(packetBytes)
+
+        def recvfrom_into(self, buffer):
+            numberOfBytes, address, deliveryTime = self.__readReply(buffer)
+            return numberOfBytes, address
+
+        def recvmsg_into(self, buffers, ancillaryBufferSize=0):
+            numberOfBytes, address, deliveryTime = self.__readReply(buffers[0])
+            ancillaryData = []
+            if self.__kernelTimestamps and ancillaryBufferSize > 0:
+                # CLOCK_REALTIME, as the kernel reports it; the session maps it back onto time.perf_counter_ns().
+                realTime = deliveryTime - IcmpHelperLibrary.IcmpSession.getClockOffset()
+                ancillaryData.append((SOL_SOCKET, self.__SO_TIMESTAMPNS,
+                                      struct.pack("@ll", realTime // 1000000000, realTime % 1000000000)))
+            return numberOfBytes, ancillaryData, 0, address
+
+        def close(self):
+            with self.__lock:
+                if self.__readFd >= 0:
+                    os.close(self.__readFd)
+                    os.close(self.__writeFd)
+                    self.__readFd = -1
+                    self.__writeFd = -1
+                    self.__replies.clear()
+                    self.__queuedBytes = 0
+
+    # ################################################################################################################ #
+    # Class IcmpHelperLibrary                                                                                          #
+    #                                                                                                                  #
+    #                                                                                                                  #
+    #                                                                                                                  #
+    #                                                                                                                  #
+    # ################################################################################################################ #
+
+    # ################################################################################################################ #
+    # IcmpHelperLibrary Class Scope Variables                                                                          #
+    #                                                                                                                  #
+    #                                                                                                                  #
+    #                                                                                                                  #
+    #                                                                                                                  #
+    # ################################################################################################################ #
+    __DEBUG_IcmpHelperLibrary = False                 # Allows for debug output
+    __session = None                                  # IcmpSession shared by every ping and traceroute of this helper
+    __ownsSession = False                             # True when the helper opened the session and must close it
+    __asyncSession = None                             # AsyncIcmpSession shared by every coroutine on the current loop
+    __resolverCache = None                            # ResolverCache used by this helper
+    __rttEstimator = None                             # RttEstimator for adaptive timeouts, None for fixed timeouts
+    __probePacer = None                               # ProbePacer spreading probes out, None to send unpaced
+    __transport = None                                # Transport for the sessions it opens, None for raw sockets
+    __probeMetrics = None                             # ProbeMetrics for it and the sessions it opens, None for none
+
+    # Process-wide resolver cache, used by IcmpPacket.setIcmpTarget and by helpers not given a cache of their own
+    sharedResolverCache = ResolverCache()
+
+    # Outcome of a single probe. address, icmpType, icmpCode and rtt (milliseconds) are None when it timed out; from
+    # receiveStatelessResults, rtt alone is None when the reply did not carry the probe's send time back.
+    # isValid is True for a reply that matched the probe and, for an Echo Reply, echoed its data unchanged.
+    ProbeResult = collections.namedtuple("ProbeResult",
+                                         ["ttl", "sequenceNumber", "address", "icmpType", "icmpCode", "rtt",
+                                          "isValid"])
+
+    # Summary of one TTL of a traceroute. address, icmpType and icmpCode come from the last reply; they and the RTTs
+    # (milliseconds) are None when no probe was answered. probes holds the hop's ProbeResults. latencyHistogram
+    # holds the answered probes' RTTs (empty when none was), to read percentiles from or merge into a target's.
+    HopResult = collections.namedtuple("HopResult",
+                                       ["ttl", "address", "icmpType", "icmpCode", "minRtt", "maxRtt", "avgRtt",
+                                        "probesSent", "probesAnswered", "isDestination", "probes",
+                                        "latencyHistogram"])
+
+    # Summary of a ping run. RTTs (milliseconds) are None when nothing was answered; packetLoss is a percentage.
+    # latencyHistogram holds the valid replies' RTTs, to read percentiles from or merge with other runs.
+    PingStatistics = collections.namedtuple("PingStatistics",
+                                            ["destinationIpAddress", "probesSent", "probesAnswered", "minRtt",
+                                             "maxRtt", "avgRtt", "packetLoss", "latencyHistogram"])
+
+    # Termination rules for a traceroute. A trace ends at the first hop that reaches the destination, that answers
+    # Destination Unreachable (when stopOnUnreachable is set; the destination's own unreachable always ends it),
+    # that completes gapLimit consecutive silent hops (0 for no limit), or at maxTtl. Each hop gets probesPerHop
+    # probes, so a sequential trace never takes longer than maxTtl * probesPerHop probe timeouts.
+    TraceLimits = collections.namedtuple("TraceLimits", ["maxTtl", "probesPerHop", "gapLimit", "stopOnUnreachable"],
+                                         defaults=[30, 4, 5, True])
+
+    # A probe or hop read back from a ResultWriter store; the fields are as in ProbeResult and HopResult, plus the
+    # time the result was written (seconds since the epoch) and the destination the trace was sent to.
+    ProbeRecord = collections.namedtuple("ProbeRecord",
+                                         ["time", "destinationIpAddress", "ttl", "sequenceNumber", "address",
+                                          "icmpType", "icmpCode", "rtt", "isValid"])
+    HopRecord = collections.namedtuple("HopRecord",
+                                       ["time", "destinationIpAddress", "ttl", "address", "icmpType", "icmpCode",
+                                        "minRtt", "maxRtt", "avgRtt", "probesSent", "probesAnswered",
+                                        "isDestination"])
+
+    # Percentiles of a LatencyHistogram, in milliseconds; every RTT is None when count is 0.
+    LatencySummary = collections.namedtuple("LatencySummary",
+                                            ["count", "minRtt", "avgRtt", "p50Rtt", "p90Rtt", "p99Rtt", "p999Rtt",
+                                             "maxRtt"])
+
+    # Point-in-time view of one hop of a monitored path. Loss values are percentages, recentLoss over the hop's
+    # history ring only; RTTs and jitter are in milliseconds, with the RTTs None until a probe is answered. latency
+    # is the LatencySummary of every RTT seen.
+    HopSnapshot = collections.namedtuple("HopSnapshot",
+                                         ["ttl", "address", "probesSent", "probesReceived", "packetLoss", "recentLoss",
+                                          "lastRtt", "minRtt", "maxRtt", "avgRtt", "stdDevRtt", "jitter",
+                                          "maxJitter", "latency"])
+
+    # Point-in-time view of a monitored path: a HopSnapshot per hop of the current path, in TTL order.
+    # destinationIpAddress is None, and hops empty, when the target host could not be resolved.
+    PathSnapshot = collections.namedtuple("PathSnapshot", ["targetHost", "destinationIpAddress", "rounds", "hops"])
+
+    # Time probes have spent waiting on a ProbePacer, in seconds. probesDelayed counts the probes that waited at all;
+    # the last three fields split totalWait by the bucket that held each probe back.
+    PacerStatistics = collections.namedtuple("PacerStatistics",
+                                             ["probesPaced", "probesDelayed", "totalWait", "maxWait", "globalWait",
+                                              "destinationWait", "hopWait"])
+
+    # What a ProbeMetrics hook is called with. kind is "sent", "reply", "timeout" or "mismatch"; time is on the
+    # time.perf_counter_ns() clock. Fields the event does not know are None: a reply's TTL (sessions do not track
+    # probes), and the address, type and code of a probe sent or timed out.
+    ProbeEvent = collections.namedtuple("ProbeEvent",
+                                        ["kind", "destinationIpAddress", "ttl", "packetSequenceNumber", "address",
+                                         "icmpType", "icmpCode", "time"])
+
+    # One ProbeMetrics timing, in seconds. averageTime and maxTime are None when nothing has been timed.
+    TimingSummary = collections.namedtuple("TimingSummary", ["count", "totalTime", "averageTime", "maxTime"])
+
+    # One router (or destination host) of a SimulatedNetwork. latency is the one-way delay of the link into it in
+    # milliseconds and jitter the most a crossing adds to that, loss the chance a packet is lost on the link in
+    # each direction. It sends at most rateLimit ICMP errors per second with bursts of rateBurst (0 for no limit),
+    # none at all when isSilent, and quotes the whole probe in them unless quotesWholeProbe is False.
+    SimulatedRouter = collections.namedtuple("SimulatedRouter",
+                                             ["address", "latency", "jitter", "loss", "rateLimit", "rateBurst",
+                                              "isSilent", "quotesWholeProbe"],
+                                             defaults=[1.0, 0.0, 0.0, 0, 10, False, True])
+
+    # ################################################################################################################ #
+    # IcmpHelperLibrary Constructors                                                                                   #
+    #                                                                                                                  #
+    #                                                                                                                  #
+    #                                                                                                                  #
+    #                                                                                                                  #
+    # ################################################################################################################ #
+    def __init__(self, session=None, resolverCache=None, rttEstimator=None, probePacer=None, transport=None,
+                 probeMetrics=None):
+        # Callers running many pings and traceroutes can pass in one IcmpSession to share between helpers, or a
+        # DispatchedIcmpSession to share one socket across threads; otherwise the helper opens its own IcmpSession
+        # on first use and keeps it until close(). Host names are resolved through
+        # resolverCache, or the process-wide sharedResolverCache when none is given. With an RttEstimator every
+        # probe's timeout adapts to the measured RTTs; without one the fixed timeouts apply. With a ProbePacer every
+        # probe waits for its tokens before it is sent; without one probes go out as fast as they are built. The
+        # sessions the helper opens itself use transport, the real network unless a SimulatedNetwork is given. With
+        # a ProbeMetrics the helper and the sessions it opens count and time every probe; give a session passed in
+        # its own with IcmpSession.setProbeMetrics.
+        self.__session = session
+        self.__ownsSession = session is None
+        self.__resolverCache = resolverCache if resolverCache is not None else IcmpHelperLibrary.sharedResolverCache
+        self.__rttEstimator = rttEstimator
+        self.__probePacer = probePacer
+        self.__transport = transport
+        self.__probeMetrics = probeMetrics
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    # ################################################################################################################ #
+    # IcmpHelperLibrary Getters                                                                                        #
+    #                                                                                                                  #
+    #                                                                                                                  #
+    #                                                                                                                  #
+    #                                                                                                                  #
+    # ################################################################################################################ #
+    def getSession(self):
+        if self.__session is None:
+            self.__session = IcmpHelperLibrary.IcmpSession(transport=self.__transport,
+                                                           probeMetrics=self.__probeMetrics)
+        self.__session.open()
+        return self.__session
+
+    def getResolverCache(self):
+        return self.__resolverCache
+
+    def getRttEstimator(self):
+        return self.__rttEstimator
+
+    def getProbePacer(self):
+        return self.__probePacer
+
+    def getTransport(self):
+        return self.__transport
+
+    def getProbeMetrics(self):
+        return self.__probeMetrics
+
+    # ################################################################################################################ #
+    # IcmpHelperLibrary Setters                                                                                        #
+    #                                                                                                                  #
+    #                                                                                                                  #
+    #                                                                                                                  #
+    #                                                                                                                  #
+    # ################################################################################################################ #
+    def setRttEstimator(self, rttEstimator):
+        self.__rttEstimator = rttEstimator
+
+    def setProbePacer(self, probePacer):
+        self.__probePacer = probePacer
+
+    def setProbeMetrics(self, probeMetrics):
+        # Applies to the helper's own counts and the sessions it opens from now on; open sessions keep theirs.
+        self.__probeMetrics = probeMetrics
+
+    def getAsyncSession(self):
+        # An AsyncIcmpSession is tied to one event loop, so a new one is opened when called from a different loop
+        # (for example a second asyncio.run()).
+        loop = asyncio.get_running_loop()
+        if self.__asyncSession is not None and self.__asyncSession.getLoop() is not loop:
+            self.__asyncSession.close()
+            self.__asyncSession = None
+        if self.__asyncSession is None:
+            self.__asyncSession = IcmpHelperLibrary.AsyncIcmpSession(self.__transport, self.__probeMetrics)
+        self.__asyncSession.open()
+        return self.__asyncSession
+
+    # ################################################################################################################ #
+    # IcmpHelperLibrary Private Functions                                                                              #
+    #                                                                                                                  #
+    #                                                                                                                  #
+    #                                                                                                                  #
+    #                                                                                                                  #
+    # ################################################################################################################ #
+    def __getProbeTimeout(self, destinationIpAddress, ttl, timeout):
+        # Adaptive timeout from the RttEstimator when there is one, otherwise the caller's fixed timeout.
+        if self.__rttEstimator is None:
+            return timeout
+        return self.__rttEstimator.getTimeout(destinationIpAddress, ttl)
+
+    def __addRttSample(self, destinationIpAddress, ttl, icmpType, rtt, address):
+        # Record an answered probe with the RttEstimator, and with the ProbePacer, which paces later probes to the
+        # same hop against the router that answered.
+        if self.__rttEstimator is not None:
+            self.__rttEstimator.addSample(destinationIpAddress, ttl, rtt, icmpType == 0)
+        if self.__probePacer is not None:
+            self.__probePacer.addHopAddress(destinationIpAddress, ttl, address)
+
+    def __addTimeout(self, destinationIpAddress, ttl, packetSequenceNumber):
+        if self.__probeMetrics is not None:
+            self.__probeMetrics.addTimeout(destinationIpAddress, ttl, packetSequenceNumber)
+
+    def __addMismatchedReply(self, icmpReply):
+        if self.__probeMetrics is not None:
+            self.__probeMetrics.addMismatchedReply(icmpReply)
+
+    def __buildProbes(self, echoRequestTemplate, probes, sendTime):
+        # Stamp the template's burst buffers into a (packetBytes, destination, TTL) entry for each (sequence number,
+        # destination, TTL) in probes, all carrying sendTime, timed from sendTime into the ProbeMetrics if there is
+        # one.
+        packets = [(echoRequestTemplate.stampBurstBuffer(index, packetSequenceNumber, sendTime), destinationIpAddress,
+                    ttl) for index, (packetSequenceNumber, destinationIpAddress, ttl) in enumerate(probes)]
+        if self.__probeMetrics is not None and len(packets) > 0:
+            self.__probeMetrics.addTiming("build", time.perf_counter_ns() - sendTime, len(packets))
+        return packets
+
+    def __sendProbes(self, session, echoRequestTemplate, probes):
+        # Send probes, a list of (sequence number, destination, TTL), and return their send times in the order
+        # given. Without a ProbePacer they go out as one burst. With one each probe waits for its tokens, and the
+        # probes that fall due together go out as one burst. Each burst's send time is taken before it is stamped,
+        # so the timeSent its replies echo is the time they are matched against.
+        if self.__probePacer is None:
+            sendTime = time.perf_counter_ns()
+            session.sendBurst(self.__buildProbes(echoRequestTemplate, probes, sendTime))
+            return [sendTime] * len(probes)
+
+        startTime = time.perf_counter()
+        schedule = sorted((self.__probePacer.reserve(destinationIpAddress, ttl), index)
+                          for index, (packetSequenceNumber, destinationIpAddress, ttl) in enumerate(probes))
+        sendTimes = [0] * len(probes)
+        position = 0
+        while position < len(schedule):
+            time.sleep(max(0.0, startTime + schedule[position][0] - time.perf_counter()))
+            timeWaited = time.perf_counter() - startTime
+            due = []
+            while position < len(schedule) and schedule[position][0] <= timeWaited:
+                due.append(schedule[position][1])
+                position += 1
+            sendTime = time.perf_counter_ns()
+            session.sendBurst(self.__buildProbes(echoRequestTemplate, [probes[index] for index in due], sendTime))
+            for index in due:
+                sendTimes[index] = sendTime
+        return sendTimes
+
+    def __buildHopResult(self, ttl, probeResults, destinationIpAddress):
+        # Summarise one TTL's probes. Address, type and code come from the last reply, as in the console output.
+        answered = [probeResult for probeResult in probeResults if probeResult.rtt is not None]
+        latencyHistogram = IcmpHelperLibrary.LatencyHistogram()
+        if len(answered) == 0:
+            return IcmpHelperLibrary.HopResult(ttl, None, None, None, None, None, None, len(probeResults), 0, False,
+                                               tuple(probeResults), latencyHistogram)
+        for probeResult in answered:
+            latencyHistogram.addRtt(probeResult.rtt)
+        isDestination = any(probeResult.icmpType == 0 or
+                            (probeResult.icmpType == 3 and probeResult.address == destinationIpAddress)
+                            for probeResult in answered)
+        return IcmpHelperLibrary.HopResult(ttl, answered[-1].address, answered[-1].icmpType, answered[-1].icmpCode,
+                                           latencyHistogram.getMinRtt(), latencyHistogram.getMaxRtt(),
+                                           latencyHistogram.getAvgRtt(), len(probeResults), len(answered),
+                                           isDestination, tuple(probeResults), latencyHistogram)
+
+    def __isLastHop(self, hopResult, silentHops, traceLimits):
+        # silentHops counts the consecutive unanswered hops up to and including hopResult.
+        return hopResult.isDestination or hopResult.ttl >= traceLimits.maxTtl or \
+            (traceLimits.stopOnUnreachable and hopResult.icmpType == 3) or \
+            (traceLimits.gapLimit > 0 and silentHops >= traceLimits.gapLimit)
+
+    def __buildProbeResult(self, ttl, icmpReply, sendTime):
+        return IcmpHelperLibrary.ProbeResult(ttl, icmpReply.packetSequenceNumber, icmpReply.address,
+                                             icmpReply.icmpType, icmpReply.icmpCode,
+                                             (icmpReply.timeReceived - sendTime) / 1e6, icmpReply.isValidResponse)
+
+    def __sendProbeAndWait(self, session, echoRequestTemplate, packetSequenceNumber, destinationIpAddress, ttl,
+                           timeout):
+        # Send one probe and block until its reply arrives or its timeout passes. Anything else read from the
+        # socket in the meantime (other probes' late replies, other processes' traffic) is skipped.
+        probeTimeout = self.__getProbeTimeout(destinationIpAddress, ttl, timeout)
+        if self.__probePacer is not None:
+            self.__probePacer.acquire(destinationIpAddress, ttl)
+        # Timed before the send: a dispatcher thread may receive the reply before sendTo returns. All times are
+        # time.perf_counter_ns(), the clock replies are stamped with.
+        sendTime = time.perf_counter_ns()
+        packetBytes = echoRequestTemplate.stamp(packetSequenceNumber, sendTime)
+        if self.__probeMetrics is not None:
+            self.__probeMetrics.addTiming("build", time.perf_counter_ns() - sendTime)
+        session.sendTo(packetBytes, destinationIpAddress, ttl)
+        deadline = sendTime + int(probeTimeout * 1e9)
+        while True:
+            timeLeft = (deadline - time.perf_counter_ns()) / 1e9
+            if timeLeft <= 0:
+                session.expireProbe(packetSequenceNumber)
+                self.__addTimeout(destinationIpAddress, ttl, packetSequenceNumber)
+                return IcmpHelperLibrary.ProbeResult(ttl, packetSequenceNumber, None, None, None, None, False)
+            icmpReply = session.waitForReply(timeLeft)
+            if icmpReply is None:
+                continue
+            # A reply that does not echo this probe's send time, or quotes another destination, answers an earlier
+            # probe that used the same sequence number.
+            if icmpReply.packetIdentifier == echoRequestTemplate.getPacketIdentifier() and \
+                    icmpReply.packetSequenceNumber == packetSequenceNumber and icmpReply.matchesSendTime(sendTime) \
+                    and icmpReply.probeDestination == destinationIpAddress:
+                self.__addRttSample(destinationIpAddress, ttl, icmpReply.icmpType,
+                                    (icmpReply.timeReceived - sendTime) / 1e9, icmpReply.address)
+                return self.__buildProbeResult(ttl, icmpReply, sendTime)
+            self.__addMismatchedReply(icmpReply)
+
+    def __sendIcmpEchoRequest(self, destinationIpAddress, count, timeout):
+        print("sendIcmpEchoRequest Started...") if self.__DEBUG_IcmpHelperLibrary else 0
+        session = self.getSession()
+        echoRequestTemplate = IcmpHelperLibrary.IcmpEchoRequestTemplate(session.getPacketIdentifier())
+
+        latencyHistogram = IcmpHelperLibrary.LatencyHistogram()
+        for i in range(count):
+            probeResult = self.__sendProbeAndWait(session, echoRequestTemplate, session.allocateSequenceNumbers(),
+                                                  destinationIpAddress, 30, timeout)
+            if probeResult.rtt is not None and probeResult.isValid:
+                latencyHistogram.addRtt(probeResult.rtt)
+            yield probeResult
+
+        probesAnswered = latencyHistogram.getCount()
+        yield IcmpHelperLibrary.PingStatistics(destinationIpAddress, count, probesAnswered,
+                                               latencyHistogram.getMinRtt(), latencyHistogram.getMaxRtt(),
+                                               latencyHistogram.getAvgRtt(), (count - probesAnswered) / count * 100,
+                                               latencyHistogram)
+
+    def __sendIcmpTraceRoute(self, destinationIpAddress, timeout, traceLimits):
+        print("sendIcmpTraceRoute Started...") if self.__DEBUG_IcmpHelperLibrary else 0
+        session = self.getSession()
+        echoRequestTemplate = IcmpHelperLibrary.IcmpEchoRequestTemplate(session.getPacketIdentifier())
+
+        silentHops = 0
+        for ttl in range(1, traceLimits.maxTtl + 1):
+            probeResults = []
+            for i in range(traceLimits.probesPerHop):
+                probeResult = self.__sendProbeAndWait(session, echoRequestTemplate, session.allocateSequenceNumbers(),
+                                                      destinationIpAddress, ttl, timeout)
+                probeResults.append(probeResult)
+                yield probeResult
+            hopResult = self.__buildHopResult(ttl, probeResults, destinationIpAddress)
+            yield hopResult
+            silentHops = silentHops + 1 if hopResult.probesAnswered == 0 else 0
+            if self.__isLastHop(hopResult, silentHops, traceLimits):
+                return
+
+    def __sendIcmpTraceRoutePipelined(self, destinationIpAddress, windowSize, timeout, traceLimits):
+        print("sendIcmpTraceRoutePipelined Started...") if self.__DEBUG_IcmpHelperLibrary else 0
+
+        lastTtl = 256                                 # Lowest TTL whose reply ends the trace, 256 until one does
+        outstanding = {}                              # Unanswered sequence number -> (TTL, send time, deadline) in ns
+        hopProbes = {}                                # TTL -> ProbeResults of its probes so far
+        nextTtl = 1                                   # Hops are yielded in TTL order once all their probes are in
+        sendTtl = 1                                   # Next TTL to probe
+        silentHops = 0
+
+        session = self.getSession()
+        packetIdentifier = session.getPacketIdentifier()
+        echoRequestTemplate = IcmpHelperLibrary.IcmpEchoRequestTemplate(packetIdentifier)
+
+        try:
+            while nextTtl <= traceLimits.maxTtl:
+                # Keep the probes of windowSize TTLs in flight: a TTL is probed as soon as the hop windowSize below
+                # it is yielded, and nothing is sent past a hop that ends the trace once it has answered. The probes
+                # of every TTL opened together go out as one burst unless paced. Sequence numbers are unique for the
+                # whole trace, so each reply can be matched back to its TTL no matter which order the replies arrive
+                # in.
+                probes = []
+                probeTimeouts = []
+                while sendTtl < min(nextTtl + windowSize, lastTtl + 1, traceLimits.maxTtl + 1):
+                    probeTimeout = int(self.__getProbeTimeout(destinationIpAddress, sendTtl, timeout) * 1e9)
+                    for i in range(traceLimits.probesPerHop):
+                        probes.append((session.allocateSequenceNumbers(), destinationIpAddress, sendTtl))
+                        probeTimeouts.append(probeTimeout)
+                    hopProbes[sendTtl] = []
+                    sendTtl += 1
+                if len(probes) > 0:
+                    sendTimes = self.__sendProbes(session, echoRequestTemplate, probes)
+                    for (packetSequenceNumber, probeDestination, ttl), sendTime, probeTimeout in \
+                            zip(probes, sendTimes, probeTimeouts):
+                        outstanding[packetSequenceNumber] = (ttl, sendTime, sendTime + probeTimeout)
+
+                # Yield probe results as replies arrive or deadlines pass; one wakeup handles every queued reply.
+                # Replies are read before probes are expired: a paced burst can take longer to send than its first
+                # probes' timeouts, and their replies are already queued by then. A reply received after its probe's
+                # deadline is left to expire.
+                timeLeft = (min(deadline for ttl, sendTime, deadline in outstanding.values()) -
+                            time.perf_counter_ns()) / 1e9
+                for icmpReply in session.waitForReplies(timeLeft):
+                    if icmpReply.packetIdentifier != packetIdentifier or \
+                            icmpReply.packetSequenceNumber not in outstanding or \
+                            not icmpReply.matchesSendTime(outstanding[icmpReply.packetSequenceNumber][1]) or \
+                            icmpReply.timeReceived > outstanding[icmpReply.packetSequenceNumber][2] or \
+                            icmpReply.probeDestination != destinationIpAddress:
+                        self.__addMismatchedReply(icmpReply)
+                        continue  # A reply to another process, a duplicate, a late one, or to an earlier trace
+                    ttl, sendTime, deadline = outstanding.pop(icmpReply.packetSequenceNumber)
+                    self.__addRttSample(destinationIpAddress, ttl, icmpReply.icmpType,
+                                        (icmpReply.timeReceived - sendTime) / 1e9, icmpReply.address)
+                    probeResult = self.__buildProbeResult(ttl, icmpReply, sendTime)
+                    hopProbes[ttl].append(probeResult)
+                    if icmpReply.icmpType == 0 or (icmpReply.icmpType == 3 and
+                                                   (traceLimits.stopOnUnreachable or
+                                                    icmpReply.address == destinationIpAddress)):
+                        lastTtl = min(lastTtl, ttl)
+                    yield probeResult
+
+                timeNow = time.perf_counter_ns()
+                for expiredSequenceNumber in [sequenceNumber for sequenceNumber, probe in outstanding.items()
+                                              if probe[2] <= timeNow]:
+                    ttl, sendTime, deadline = outstanding.pop(expiredSequenceNumber)
+                    session.expireProbe(expiredSequenceNumber)
+                    self.__addTimeout(destinationIpAddress, ttl, expiredSequenceNumber)
+                    probeResult = IcmpHelperLibrary.ProbeResult(ttl, expiredSequenceNumber, None, None, None, None,
+                                                                False)
+                    hopProbes[ttl].append(probeResult)
+                    yield probeResult
+
+                # Yield each hop as soon as it and every hop before it are complete, until the hop that ends the
+                # trace.
+                while nextTtl < sendTtl and len(hopProbes[nextTtl]) == traceLimits.probesPerHop:
+                    hopResult = self.__buildHopResult(nextTtl, hopProbes.pop(nextTtl), destinationIpAddress)
+                    yield hopResult
+                    silentHops = silentHops + 1 if hopResult.probesAnswered == 0 else 0
+                    if self.__isLastHop(hopResult, silentHops, traceLimits):
+                        return
+                    if nextTtl == lastTtl:
+                        lastTtl = 256                 # One probe's reply looked final but the hop's last one did not
+                    nextTtl += 1
+        finally:
+            # Probes still unanswered when the trace ends (past the target, or the consumer stopped early) must not
+            # keep a dispatcher routing replies to this session.
+            for packetSequenceNumber in outstanding:
+                session.expireProbe(packetSequenceNumber)
+
+    def __probeHops(self, session, echoRequestTemplate, destinationIpAddress, ttls, timeout, probesPerHop,
+                    hopProbes):
+        # Send probesPerHop probes to every TTL in ttls as one burst and yield a ProbeResult as each is answered or
+        # times out, appending it to hopProbes[ttl] as well. Sequence numbers come from the session's running
+        # counter, so a late reply to an earlier burst or trace can never match.
+        packetIdentifier = echoRequestTemplate.getPacketIdentifier()
+        outstanding = {}                              # Unanswered sequence number -> (TTL, send time, deadline) in ns
+        probes = []
+        probeTimeouts = []
+        for ttl in ttls:
+            probeTimeout = int(self.__getProbeTimeout(destinationIpAddress, ttl, timeout) * 1e9)
+            for i in range(probesPerHop):
+                probes.append((session.allocateSequenceNumbers(), destinationIpAddress, ttl))
+                probeTimeouts.append(probeTimeout)
+            hopProbes[ttl] = []
+        sendTimes = self.__sendProbes(session, echoRequestTemplate, probes)
+        for (packetSequenceNumber, probeDestination, ttl), sendTime, probeTimeout in zip(probes, sendTimes,
+                                                                                        probeTimeouts):
+            outstanding[packetSequenceNumber] = (ttl, sendTime, sendTime + probeTimeout)
+
+        try:
+            # Replies are read before probes are expired, as in __sendIcmpTraceRoutePipelined.
+            while len(outstanding) > 0:
+                timeLeft = (min(deadline for ttl, sendTime, deadline in outstanding.values()) -
+                            time.perf_counter_ns()) / 1e9
+                for icmpReply in session.waitForReplies(timeLeft):
+                    if icmpReply.packetIdentifier != packetIdentifier or \
+                            icmpReply.packetSequenceNumber not in outstanding or \
+                            not icmpReply.matchesSendTime(outstanding[icmpReply.packetSequenceNumber][1]) or \
+                            icmpReply.timeReceived > outstanding[icmpReply.packetSequenceNumber][2] or \
+                            icmpReply.probeDestination != destinationIpAddress:
+                        self.__addMismatchedReply(icmpReply)
+                        continue  # A reply to another process, a duplicate, a late one, or to an earlier burst
+                    ttl, sendTime, deadline = outstanding.pop(icmpReply.packetSequenceNumber)
+                    self.__addRttSample(destinationIpAddress, ttl, icmpReply.icmpType,
+                                        (icmpReply.timeReceived - sendTime) / 1e9, icmpReply.address)
+                    probeResult = self.__buildProbeResult(ttl, icmpReply, sendTime)
+                    hopProbes[ttl].append(probeResult)
+                    yield probeResult
+
+                timeNow = time.perf_counter_ns()
+                for expiredSequenceNumber in [sequenceNumber for sequenceNumber, probe in outstanding.items()
+                                              if probe[2] <= timeNow]:
+                    ttl, sendTime, deadline = outstanding.pop(expiredSequenceNumber)
+                    session.expireProbe(expiredSequenceNumber)
+                    self.__addTimeout(destinationIpAddress, ttl, expiredSequenceNumber)
+                    probeResult = IcmpHelperLibrary.ProbeResult(ttl, expiredSequenceNumber, None, None, None, None,
+                                                                False)
+                    hopProbes[ttl].append(probeResult)
+                    yield probeResult
+        finally:
+            # Probes left when the consumer stops early must not keep a dispatcher routing replies to this session.
+            for packetSequenceNumber in outstanding:
+                session.expireProbe(packetSequenceNumber)
+
+    def __sendIcmpTraceRouteDoubletree(self, destinationIpAddress, stopSet, startTtl, windowSize, timeout,
+                                       traceLimits):
+        # Doubletree: probe forward from startTtl, windowSize TTLs per burst, until a hop ends the trace, then
+        # backward from startTtl - 1, again windowSize TTLs per burst, until a hop answers from an (address, TTL)
+        # the stop set already knows, and take the TTLs below the window from the stop set. The assembled path is
+        # then cut at its first hop that ends the trace under traceLimits, as the other modes would, so a silent
+        # gap starting below startTtl counts in full. Yields a ProbeResult as each probe is answered or times out,
+        # then the HopResults in TTL order once the trace is
+        # complete; cached hops are the ones measured by the trace that first found them.
+        print("sendIcmpTraceRouteDoubletree Started...") if self.__DEBUG_IcmpHelperLibrary else 0
+        session = self.getSession()
+        echoRequestTemplate = IcmpHelperLibrary.IcmpEchoRequestTemplate(session.getPacketIdentifier())
+        startTtl = min(max(startTtl, 1), traceLimits.maxTtl)
+        hopProbes = {}                                # TTL -> ProbeResults of its probes
+        hops = {}
+
+        lastTtl = None                                # Always found: __isLastHop holds at maxTtl
+        silentHops = 0
+        for windowStart in range(startTtl, traceLimits.maxTtl + 1, windowSize):
+            ttls = range(windowStart, min(windowStart + windowSize, traceLimits.maxTtl + 1))
+            for probeResult in self.__probeHops(session, echoRequestTemplate, destinationIpAddress, ttls, timeout,
+                                                traceLimits.probesPerHop, hopProbes):
+                yield probeResult
+            for ttl in ttls:
+                hops[ttl] = self.__buildHopResult(ttl, hopProbes[ttl], destinationIpAddress)
+                silentHops = silentHops + 1 if hops[ttl].probesAnswered == 0 else 0
+                if lastTtl is None and self.__isLastHop(hops[ttl], silentHops, traceLimits):
+                    lastTtl = ttl
+            if lastTtl is not None:
+                break
+
+        windowEnd = startTtl                          # The backward window covers [windowEnd - windowSize, windowEnd)
+        while windowEnd > 1:
+            ttls = range(max(windowEnd - windowSize, 1), windowEnd)
+            for probeResult in self.__probeHops(session, echoRequestTemplate, destinationIpAddress, ttls, timeout,
+                                                traceLimits.probesPerHop, hopProbes):
+                yield probeResult
+            prefix = None
+            for ttl in reversed(ttls):
+                hopResult = self.__buildHopResult(ttl, hopProbes[ttl], destinationIpAddress)
+                hops[ttl] = hopResult
+                if hopResult.isDestination or (traceLimits.stopOnUnreachable and hopResult.icmpType == 3):
+                    continue                          # The trace ends closer than startTtl; the rescan below cuts it
+                if prefix is None and hopResult.address is not None:
+                    # The measured hops of the window are kept; the stop set only fills the TTLs below it.
+                    prefix = stopSet.getPrefix(hopResult.address, ttl, ttls.start)
+            if prefix is not None:
+                for cachedHopResult in prefix:
+                    hops[cachedHopResult.ttl] = cachedHopResult
+                break
+            windowEnd = ttls.start
+
+        trace = []
+        silentHops = 0
+        for ttl in range(1, lastTtl + 1):
+            trace.append(hops[ttl])
+            silentHops = silentHops + 1 if hops[ttl].probesAnswered == 0 else 0
+            if self.__isLastHop(hops[ttl], silentHops, traceLimits):
+                break
+        stopSet.addTrace(trace)
+        for hopResult in trace:
+            yield hopResult
+
+    # ################################################################################################################ #
+    # IcmpHelperLibrary Public Functions                                                                               #
+    #                                                                                                                  #
+    #                                                                                                                  #
+    #                                                                                                                  #
+    #                                                                                                                  #
+    # ################################################################################################################ #
+    def sendPingResults(self, targetHost, count=4, timeout=30):
+        # Generator form of sendPing: yields a ProbeResult as each echo request is answered or times out, then
+        # one PingStatistics.
+        print("sendPingResults Started...") if self.__DEBUG_IcmpHelperLibrary else 0
+        destinationIpAddress = self.__resolverCache.resolve(targetHost.strip())    # Resolve once for the whole ping
+        for result in self.__sendIcmpEchoRequest(destinationIpAddress, count, timeout):
+            yield result
+
+    def traceRouteResults(self, targetHost, pipelined=False, windowSize=8, timeout=30, stopSet=None, startTtl=10,
+                          traceLimits=None):
+        # Generator form of traceRoute: yields a ProbeResult as each probe is answered or times out and a
+        # HopResult as each TTL completes, ending with the hop that ends the trace under traceLimits (the
+        # TraceLimits defaults when None: up to TTL 30, 4 probes per hop, 5 silent hops). With pipelined=True the
+        # probes of windowSize TTLs are in flight together (see traceRoutePipelined); probe results then arrive
+        # in reply order, hop results are still in TTL order. With a StopSet the trace runs Doubletree from
+        # startTtl, reusing the path prefixes earlier traces found; its hop results come once the trace is done.
+        print("traceRouteResults Started...") if self.__DEBUG_IcmpHelperLibrary else 0
+        destinationIpAddress = self.__resolverCache.resolve(targetHost.strip())    # Resolve once for the whole trace
+        if traceLimits is None:
+            traceLimits = IcmpHelperLibrary.TraceLimits()
+        if stopSet is not None:
+            results = self.__sendIcmpTraceRouteDoubletree(destinationIpAddress, stopSet, startTtl, windowSize, timeout,
+                                                          traceLimits)
+        elif pipelined:
+            results = self.__sendIcmpTraceRoutePipelined(destinationIpAddress, windowSize, timeout, traceLimits)
+        else:
+            results = self.__sendIcmpTraceRoute(destinationIpAddress, timeout, traceLimits)
+        for result in results:
+            yield result
+
+    def sendPing(self, targetHost):
+        print("ping Started...") if self.__DEBUG_IcmpHelperLibrary else 0
+        self.printPingResults(targetHost, self.sendPingResults(targetHost))
+
+    def traceRoute(self, targetHost, traceLimits=None):
+        print("traceRoute Started...") if self.__DEBUG_IcmpHelperLibrary else 0
+        self.printTraceRouteResults(targetHost, self.traceRouteResults(targetHost, traceLimits=traceLimits))
+
+    def traceRoutePipelined(self, targetHost, windowSize=8, timeout=30, traceLimits=None):
+        # Keeps the probes for windowSize TTLs in flight and matches replies as they arrive, probing the next TTL
+        # as each hop completes and nothing past a hop that ends the trace once it answers. A silent hop costs one
+        # timeout while the hops after it are already being probed, instead of a timeout per silent probe.
+        print("traceRoutePipelined Started...") if self.__DEBUG_IcmpHelperLibrary else 0
+        self.printTraceRouteResults(targetHost, self.traceRouteResults(targetHost, True, windowSize, timeout,
+                                                                       traceLimits=traceLimits))
+
+    def printPathSnapshot(self, pathSnapshot):
+        # mtr-style table of one monitored path.
+        print("-------------------------------------------------------------------------------------------------------------------------")
+        if pathSnapshot.destinationIpAddress is None:
+            print("Monitoring (" + pathSnapshot.targetHost + ") could not resolve host")
+            return
+        print("Monitoring (%s) %s    Rounds=%d" % (pathSnapshot.targetHost, pathSnapshot.destinationIpAddress,
+                                                 pathSnapshot.rounds))
+        print("-------------------------------------------------------------------------------------------------------------------------")
+        print("  %-4s %-15s %6s %6s %8s %8s %8s %8s %8s %8s %8s %8s" % ("TTL", "Address", "Loss%", "Sent", "Last", "Avg",
+                                                                       "Best", "Worst", "StDev", "Jitter", "P50",
+                                                                       "P99"))
+        for hopSnapshot in pathSnapshot.hops:
+            if hopSnapshot.probesReceived == 0:
+                print("  %-4d %-15s %6.1f %6d" % (hopSnapshot.ttl, "*", hopSnapshot.packetLoss, hopSnapshot.probesSent))
+                continue
+            print("  %-4d %-15s %6.1f %6d %8.1f %8.1f %8.1f %8.1f %8.1f %8.1f %8.1f %8.1f" % (
+                hopSnapshot.ttl,
+                hopSnapshot.address,
+                hopSnapshot.packetLoss,
+                hopSnapshot.probesSent,
+                hopSnapshot.lastRtt,
+                hopSnapshot.avgRtt,
+                hopSnapshot.minRtt,
+                hopSnapshot.maxRtt,
+                hopSnapshot.stdDevRtt,
+                hopSnapshot.jitter,
+                hopSnapshot.latency.p50Rtt,
+                hopSnapshot.latency.p99Rtt
+            )
+            )
+
+    def printPingResults(self, targetHost, pingResults):
+        # Console consumer of sendPingResults.
+        print("-----------------------------------------------------------------")
+        print("Pinging (" + targetHost + ") " + self.__resolverCache.resolve(targetHost.strip()))
+        print("-----------------------------------------------------------------")
+        for result in pingResults:
+            if isinstance(result, IcmpHelperLibrary.ProbeResult):
+                if result.rtt is None:
+                    print("  *        *        *        *        *    Request timed out.")
+                    continue
+                if not result.isValid:
+                    print("ECHO REPLY IS INVALID")
+                print("  TTL={:<4} RTT={:<8.3f} ms Type={:<2} Code={:<2} Address={:<15}".format(
+                    result.ttl,
+                    result.rtt,
+                    result.icmpType,
+                    result.icmpCode,
+                    result.address
+                ))
+            elif isinstance(result, IcmpHelperLibrary.PingStatistics):
+                print("-----------------------------------------------------------------")
+                print("Ping Statistics")
+                print("-----------------------------------------------------------------")
+                if result.probesAnswered == 0:
+                    print("  MinRTT=*    MaxRTT=*    AvgRTT=*    PacketLoss=%d" % result.packetLoss)
+                else:
+                    latency = result.latencyHistogram.getSummary()
+                    print("  MinRTT=%.3f ms    MaxRTT=%.3f ms    AvgRTT=%.3f ms    PacketLoss=%d" %
+                          (
+                              result.minRtt,
+                              result.maxRtt,
+                              result.avgRtt,
+                              result.packetLoss
+                          )
+                          )
+                    print("  P50=%.3f ms    P90=%.3f ms    P99=%.3f ms    P99.9=%.3f ms" %
+                          (latency.p50Rtt, latency.p90Rtt, latency.p99Rtt, latency.p999Rtt))
+                print("-----------------------------------------------------------------")
+
+    def printTraceRouteResults(self, targetHost, traceResults):
+        # Console consumer of traceRouteResults: one line per hop.
+        print("-------------------------------------------------------------------------------------------------------------------------")
+        print("Traceroute to (" + targetHost + ") " + self.__resolverCache.resolve(targetHost.strip()))
+        print("-------------------------------------------------------------------------------------------------------------------------")
+        for result in traceResults:
+            if isinstance(result, IcmpHelperLibrary.HopResult):
+                self.printTraceRouteHop(result)
+        print("-------------------------------------------------------------------------------------------------------------------------")
+        print("Traceroute complete.")
+        print("-------------------------------------------------------------------------------------------------------------------------")
+
+    def printTraceRouteHop(self, hopResult):
+        # Print one HopResult's summary line.
+        if hopResult.probesAnswered == 0:
+            print("  TTL=%d        *        *        *        *        *    Request timed out." % hopResult.ttl)
+            return
+        print("  TTL=%d    MinRTT=%.3f ms    MaxRTT=%.3f ms    AvgRTT=%.3f ms    P50=%.3f ms    P99=%.3f ms    Type=%d    Code=%d    %s" %
+              (
+                  hopResult.ttl,
+                  hopResult.minRtt,
+                  hopResult.maxRtt,
+                  hopResult.avgRtt,
+                  hopResult.latencyHistogram.getPercentile(50),
+                  hopResult.latencyHistogram.getPercentile(99),
+                  hopResult.icmpType,
+                  hopResult.icmpCode,
+                  hopResult.address
+              )
+              )
+
+    def close(self):
+        # Closes the session socket if this helper opened it. A caller-provided session stays open for its owner.
+        if self.__ownsSession and self.__session is not None:
+            self.__session.close()
+            self.__session = None
+        if self.__asyncSession is not None:
+            self.__asyncSession.close()
+            self.__asyncSession = None
+
+    async def sendPingAsync(self, targetHost, count=4, timeout=30):
+        # Asyncio counterpart of sendPing. Sends count echo requests one after another and returns their
+        # ProbeResults; many pings can run concurrently on one event loop and share one socket.
+        print("sendPingAsync Started...") if self.__DEBUG_IcmpHelperLibrary else 0
+        asyncSession = self.getAsyncSession()
+        destinationIpAddress = await self.__resolverCache.resolveAsync(targetHost.strip())
+        probeResults = []
+        for i in range(count):
+            probeResults.append(await self.__sendLimitedProbe(asyncSession, destinationIpAddress, 30, timeout, ()))
+        return probeResults
+
+    async def traceRouteAsync(self, targetHost, windowSize=32, timeout=30, inFlightLimits=(), traceLimits=None):
+        # Asyncio counterpart of traceRoutePipelined. Probes windowSize TTLs at a time, traceLimits.probesPerHop
+        # probes per TTL, all in flight together. Returns a list of HopResults, ending at the hop that ends the
+        # trace. Every probe holds each asyncio.Semaphore in inFlightLimits while it is outstanding.
+        print("traceRouteAsync Started...") if self.__DEBUG_IcmpHelperLibrary else 0
+        if traceLimits is None:
+            traceLimits = IcmpHelperLibrary.TraceLimits()
+        asyncSession = self.getAsyncSession()
+        destinationIpAddress = await self.__resolverCache.resolveAsync(targetHost.strip())
+        hops = []
+        silentHops = 0
+        for windowStart in range(1, traceLimits.maxTtl + 1, windowSize):
+            windowEnd = min(windowStart + windowSize, traceLimits.maxTtl + 1)
+            probeResults = await asyncio.gather(*[self.__sendLimitedProbe(asyncSession, destinationIpAddress, ttl,
+                                                                          timeout, inFlightLimits)
+                                                  for ttl in range(windowStart, windowEnd)
+                                                  for i in range(traceLimits.probesPerHop)])
+            for ttl in range(windowStart, windowEnd):
+                hopResult = self.__buildHopResult(ttl, [probeResult for probeResult in probeResults
+                                                        if probeResult.ttl == ttl], destinationIpAddress)
+                hops.append(hopResult)
+                silentHops = silentHops + 1 if hopResult.probesAnswered == 0 else 0
+                if self.__isLastHop(hopResult, silentHops, traceLimits):
+                    return hops
+        return hops
+
+    async def traceRouteBatchAsync(self, targetHosts, maxInFlight=1024, maxPerDestination=32, maxTraces=0,
+                                   windowSize=32, timeout=30, traceLimits=None):
+        # Traces every host in targetHosts (any iterable, consumed lazily) and yields (targetHost, hops) as each
+        # trace finishes, in completion order. hops is the list of HopResults, or None when the host could not be
+        # resolved.
+        #   maxInFlight       - probes outstanding across all traces
+        #   maxPerDestination - probes outstanding to any one destination
+        #   maxTraces         - traces running at once, 0 to derive it from the two limits above
+        print("traceRouteBatchAsync Started...") if self.__DEBUG_IcmpHelperLibrary else 0
+        if maxTraces <= 0:
+            maxTraces = max(1, maxInFlight // maxPerDestination) * 2   # Keep a second trace queued per slot
+        globalLimit = asyncio.Semaphore(maxInFlight)
+        destinationLimits = {}                    # Target host -> [semaphore, number of traces using it]
+        runningTraces = {}                        # Task -> target host
+        targetIterator = iter(targetHosts)
+        targetsLeft = True
+
+        try:
+            while targetsLeft or len(runningTraces) > 0:
+                # Top up the running traces from the iterator, so a 50k line target file is never held in memory.
+                while targetsLeft and len(runningTraces) < maxTraces:
+                    try:
+                        targetHost = next(targetIterator)
+                    except StopIteration:
+                        targetsLeft = False
+                        break
+                    if targetHost not in destinationLimits:
+                        destinationLimits[targetHost] = [asyncio.Semaphore(maxPerDestination), 0]
+                    destinationLimits[targetHost][1] += 1
+                    limits = (destinationLimits[targetHost][0], globalLimit)
+                    runningTraces[asyncio.ensure_future(self.traceRouteAsync(targetHost, windowSize, timeout,
+                                                                             limits, traceLimits))] = targetHost
+                if len(runningTraces) == 0:
+                    break
+
+                finishedTraces, pendingTraces = await asyncio.wait(runningTraces, return_when=asyncio.FIRST_COMPLETED)
+                for finishedTrace in finishedTraces:
+                    targetHost = runningTraces.pop(finishedTrace)
+                    destinationLimits[targetHost][1] -= 1
+                    if destinationLimits[targetHost][1] == 0:
+                        del destinationLimits[targetHost]
+                    if finishedTrace.exception() is not None:
+                        if not isinstance(finishedTrace.exception(), gaierror):
+                            raise finishedTrace.exception()
+                        yield targetHost, None
+                    else:
+                        yield targetHost, finishedTrace.result()
+        finally:
+            # A consumer that stops early must not leave traces probing in the background.
+            for runningTrace in runningTraces:
+                runningTrace.cancel()
+
+    def traceRouteBatch(self, targetHosts, maxInFlight=1024, maxPerDestination=32, maxTraces=0, windowSize=32,
+                        timeout=30, traceLimits=None):
+        # Synchronous generator over traceRouteBatchAsync for callers without an event loop of their own.
+        print("traceRouteBatch Started...") if self.__DEBUG_IcmpHelperLibrary else 0
+        loop = asyncio.new_event_loop()
+        batch = self.traceRouteBatchAsync(targetHosts, maxInFlight, maxPerDestination, maxTraces, windowSize,
+                                          timeout, traceLimits)
+        try:
+            while True:
+                try:
+                    yield loop.run_until_complete(batch.__anext__())
+                except StopAsyncIteration:
+                    break
+        finally:
+            loop.run_until_complete(batch.aclose())
+            if self.__asyncSession is not None and self.__asyncSession.getLoop() is loop:
+                self.__asyncSession.close()
+                self.__asyncSession = None
+            loop.close()
+
+    def traceRouteThreaded(self, targetHosts, maxWorkers=8, pipelined=False, windowSize=8, timeout=30,
+                           dispatcher=None, stopSet=None, startTtl=10, traceLimits=None):
+        # Traces every host in targetHosts on a pool of maxWorkers threads and yields (targetHost, hops) as each
+        # trace finishes, in completion order; hops is the list of HopResults, or None when the host could not be
+        # resolved. Each trace runs on its own helper and IcmpSession, so results never mix between threads; the
+        # resolver cache, RTT estimator and probe pacer are shared. targetHosts is consumed lazily, keeping at most
+        # two traces per worker queued. With an IcmpReceiveDispatcher every trace shares its one socket instead of
+        # opening its own. With a StopSet every trace runs Doubletree from startTtl and they all share its
+        # topology, so hops near the source are probed once per campaign rather than once per target. A helper must
+        # not itself be used from several threads at once - use this runner or one helper per thread.
+        print("traceRouteThreaded Started...") if self.__DEBUG_IcmpHelperLibrary else 0
+        targetHosts = iter(targetHosts)
+        pending = {}
+        with concurrent.futures.ThreadPoolExecutor(maxWorkers) as executor:
+            try:
+                while True:
+                    for targetHost in targetHosts:
+                        future = executor.submit(self.__traceRouteInThread, targetHost, pipelined, windowSize, timeout,
+                                                 dispatcher, stopSet, startTtl, traceLimits)
+                        pending[future] = targetHost
+                        if len(pending) >= 2 * maxWorkers:
+                            break
+                    if len(pending) == 0:
+                        return
+                    done, notDone = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        yield pending.pop(future), future.result()
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def sendStatelessProbes(self, targetHosts, ttls=range(1, 33), probesPerHop=1, burstSize=64):
+        # Fire-and-forget half of stateless probing: sends probesPerHop (at most 256) echo requests for every TTL
+        # in ttls to every host in targetHosts, consumed lazily, and returns the number of probes sent. No record
+        # of any probe is kept. The TTL travels in the high byte of the sequence number and the send time in the
+        # payload, so receiveStatelessResults can rebuild each result from its reply alone. Probes are stamped
+        # just before their burst goes out, and a ProbePacer, if set, spreads each burst out. Use a plain
+        # IcmpSession: a DispatchedIcmpSession registers every probe it sends.
+        print("sendStatelessProbes Started...") if self.__DEBUG_IcmpHelperLibrary else 0
+        session = self.getSession()
+        echoRequestTemplate = IcmpHelperLibrary.IcmpEchoRequestTemplate(session.getPacketIdentifier())
+        probes = []
+        probesSent = 0
+        for targetHost in targetHosts:
+            try:
+                destinationIpAddress = self.__resolverCache.resolve(targetHost.strip())
+            except gaierror:
+                continue
+            for ttl in ttls:
+                for i in range(probesPerHop):
+                    probes.append(((ttl << 8) | i, destinationIpAddress, ttl))
+                    if len(probes) >= burstSize:
+                        self.__sendProbes(session, echoRequestTemplate, probes)
+                        probesSent += len(probes)
+                        probes = []
+        if len(probes) > 0:
+            self.__sendProbes(session, echoRequestTemplate, probes)
+            probesSent += len(probes)
+        return probesSent
+
+    def receiveStatelessResults(self, packetIdentifier=None, idleTimeout=2):
+        # Receiving half of stateless probing, which may run in another thread or process than the sender: yields
+        # (destinationIpAddress, ProbeResult) for every reply to a probe with packetIdentifier (by default this
+        # helper's session's) until no reply has arrived for idleTimeout seconds. The TTL comes from the sequence
+        # number, the destination from the reply or its quote, and the RTT from the echoed or quoted send time
+        # (IcmpReply.getPayloadRtt), so memory stays constant however many probes are outstanding. Probes that
+        # were never answered are not reported. Replies to a large burst arrive faster than they are parsed, so
+        # give the helper an IcmpSession with a receiveBufferSize of a few megabytes.
+        print("receiveStatelessResults Started...") if self.__DEBUG_IcmpHelperLibrary else 0
+        session = self.getSession()
+        if packetIdentifier is None:
+            packetIdentifier = session.getPacketIdentifier()
+        while True:
+            icmpReplies = session.waitForReplies(idleTimeout)
+            if len(icmpReplies) == 0:
+                return
+            for icmpReply in icmpReplies:
+                if icmpReply.packetIdentifier != packetIdentifier:
+                    self.__addMismatchedReply(icmpReply)
+                    continue
+                ttl = icmpReply.packetSequenceNumber >> 8
+                rtt = icmpReply.getPayloadRtt()
+                if rtt is not None:
+                    self.__addRttSample(icmpReply.probeDestination, ttl, icmpReply.icmpType, rtt / 1e3,
+                                        icmpReply.address)
+                yield icmpReply.probeDestination, IcmpHelperLibrary.ProbeResult(
+                    ttl, icmpReply.packetSequenceNumber, icmpReply.address, icmpReply.icmpType, icmpReply.icmpCode,
+                    rtt, icmpReply.isValidResponse)
+
+    def monitorPaths(self, targetHosts, interval=1.0, timeout=1.0, snapshotInterval=10.0, rounds=0, maxTtl=30,
+                     historySize=100):
+        # Continuous mtr-style monitoring of every host in targetHosts. Each round sends one probe to every hop of
+        # every path in a single burst, waits up to timeout seconds for the replies, and starts interval seconds
+        # after the previous round started. Yields a list of PathSnapshots, one per target host in order, every
+        # snapshotInterval seconds and after the last of rounds rounds (0 runs until the consumer stops). All
+        # state is a PathMonitor per host with a HopStatistics per TTL, so memory stays bounded however long it
+        # runs. Every probe of a round needs its own sequence number: len(targetHosts) * maxTtl must be below 65536.
+        print("monitorPaths Started...") if self.__DEBUG_IcmpHelperLibrary else 0
+        pathMonitors = []
+        for targetHost in targetHosts:
+            try:
+                destinationIpAddress = self.__resolverCache.resolve(targetHost.strip())
+            except gaierror:
+                destinationIpAddress = None
+            pathMonitors.append(IcmpHelperLibrary.PathMonitor(targetHost, destinationIpAddress, maxTtl, historySize))
+        if len(pathMonitors) * maxTtl >= 0x10000:
+            raise ValueError("%d paths of %d hops need more than 65536 sequence numbers per round" %
+                             (len(pathMonitors), maxTtl))
+
+        session = self.getSession()
+        packetIdentifier = session.getPacketIdentifier()
+        echoRequestTemplate = IcmpHelperLibrary.IcmpEchoRequestTemplate(packetIdentifier)
+        roundsDone = 0
+        nextSnapshotTime = time.perf_counter() + snapshotInterval
+        while rounds == 0 or roundsDone < rounds:
+            roundStartTime = time.perf_counter()
+            outstanding = {}                          # Sequence number -> (PathMonitor, TTL, send time), this round
+            destinationTtls = {}                      # PathMonitor -> lowest TTL that reached the destination
+            probes = []
+            pathMonitorOfProbe = []                   # The PathMonitor of each probe in probes
+            for pathMonitor in pathMonitors:
+                if pathMonitor.getDestinationIpAddress() is None:
+                    continue
+                for ttl in range(1, pathMonitor.getHopCount() + 1):
+                    probes.append((session.allocateSequenceNumbers(), pathMonitor.getDestinationIpAddress(), ttl))
+                    pathMonitorOfProbe.append(pathMonitor)
+            sendTimes = self.__sendProbes(session, echoRequestTemplate, probes)
+            for (packetSequenceNumber, probeDestination, ttl), sendTime, pathMonitor in zip(probes, sendTimes,
+                                                                                           pathMonitorOfProbe):
+                outstanding[packetSequenceNumber] = (pathMonitor, ttl, sendTime)
+
+            # Every probe gets timeout seconds from the last send of the round.
+            deadline = max(sendTimes, default=time.perf_counter_ns()) + int(timeout * 1e9)
+            while len(outstanding) > 0:
+                # Drains the replies already queued even once the deadline has passed, since a paced round can take
+                # longer to send than its timeout.
+                timeLeft = (deadline - time.perf_counter_ns()) / 1e9
+                icmpReplies = session.waitForReplies(timeLeft)
+                if len(icmpReplies) == 0 and timeLeft <= 0:
+                    break
+                for icmpReply in icmpReplies:
+                    if icmpReply.packetIdentifier != packetIdentifier or \
+                            icmpReply.packetSequenceNumber not in outstanding or \
+                            not icmpReply.matchesSendTime(outstanding[icmpReply.packetSequenceNumber][2]) or \
+                            icmpReply.timeReceived > deadline or \
+                            icmpReply.probeDestination != \
+                            outstanding[icmpReply.packetSequenceNumber][0].getDestinationIpAddress():
+                        self.__addMismatchedReply(icmpReply)
+                        continue  # A reply to another process, a duplicate, a late one, or one from an earlier round
+                    pathMonitor, ttl, sendTime = outstanding.pop(icmpReply.packetSequenceNumber)
+                    rtt = icmpReply.getPayloadRtt()
+                    if rtt is None:
+                        rtt = (icmpReply.timeReceived - sendTime) / 1e6
+                    pathMonitor.getHopStatistics(ttl).addRtt(rtt, icmpReply.address)
+                    if self.__probePacer is not None:
+                        self.__probePacer.addHopAddress(icmpReply.probeDestination, ttl, icmpReply.address)
+                    if icmpReply.icmpType == 0 or (icmpReply.icmpType == 3 and
+                                                   icmpReply.address == pathMonitor.getDestinationIpAddress()):
+                        destinationTtls[pathMonitor] = min(ttl, destinationTtls.get(pathMonitor, ttl))
+            for packetSequenceNumber, (pathMonitor, ttl, sendTime) in outstanding.items():
+                pathMonitor.getHopStatistics(ttl).addLoss()
+                session.expireProbe(packetSequenceNumber)
+                self.__addTimeout(pathMonitor.getDestinationIpAddress(), ttl, packetSequenceNumber)
+            for pathMonitor in pathMonitors:
+                pathMonitor.finishRound(destinationTtls.get(pathMonitor))
+            roundsDone += 1
+
+            timeNow = time.perf_counter()
+            if timeNow >= nextSnapshotTime or roundsDone == rounds:
+                yield [pathMonitor.getSnapshot() for pathMonitor in pathMonitors]
+                nextSnapshotTime = timeNow + snapshotInterval
+            if rounds == 0 or roundsDone < rounds:
+                time.sleep(max(0.0, roundStartTime + interval - time.perf_counter()))
+
+    def readTargetHosts(self, fileName):
+        # Stream target hosts from a file with one host per line ("-" reads standard input). Blank lines and
+        # lines starting with # are skipped.
+        targetFile = sys.stdin if fileName == "-" else open(fileName)
+        try:
+            for line in targetFile:
+                targetHost = line.strip()
+                if len(targetHost) > 0 and not targetHost.startswith("#"):
+                    yield targetHost
+        finally:
+            if targetFile is not sys.stdin:
+                targetFile.close()
+
+    # ################################################################################################################ #
+    # IcmpHelperLibrary Private Functions (threads)                                                                    #
+    #                                                                                                                  #
+    #                                                                                                                  #
+    #                                                                                                                  #
+    #                                                                                                                  #
+    # ################################################################################################################ #
+    def __traceRouteInThread(self, targetHost, pipelined, windowSize, timeout, dispatcher, stopSet, startTtl,
+                             traceLimits):
+        session = dispatcher.openSession() if dispatcher is not None else None
+        try:
+            with IcmpHelperLibrary(session, self.__resolverCache, self.__rttEstimator, self.__probePacer,
+                                   self.__transport, self.__probeMetrics) as icmpHelper:
+                return [result for result in icmpHelper.traceRouteResults(targetHost, pipelined, windowSize, timeout,
+                                                                          stopSet, startTtl, traceLimits)
+                        if isinstance(result, IcmpHelperLibrary.HopResult)]
+        except gaierror:
+            return None
+        finally:
+            if session is not None:
+                session.close()
+
+    # ################################################################################################################ #
+    # IcmpHelperLibrary Private Functions (asyncio)                                                                    #
+    #                                                                                                                  #
+    #                                                                                                                  #
+    #                                                                                                                  #
+    #                                                                                                                  #
+    # ################################################################################################################ #
+    async def __sendLimitedProbe(self, asyncSession, destinationIpAddress, ttl, timeout, inFlightLimits):
+        for inFlightLimit in inFlightLimits:
+            await inFlightLimit.acquire()
+        try:
+            # Paced once it holds its in-flight slots, so tokens are never reserved for probes still queued on them.
+            if self.__probePacer is not None:
+                await asyncio.sleep(self.__probePacer.reserve(destinationIpAddress, ttl))
+            probeResult = await asyncSession.sendProbe(destinationIpAddress, ttl,
+                                                       self.__getProbeTimeout(destinationIpAddress, ttl, timeout))
+        finally:
+            for inFlightLimit in inFlightLimits:
+                inFlightLimit.release()
+        if probeResult.rtt is not None:
+            self.__addRttSample(destinationIpAddress, ttl, probeResult.icmpType, probeResult.rtt / 1000,
+                                probeResult.address)
+        return probeResult
+
+
+# #################################################################################################################### #
+# main()                                                                                                               #
+#                                                                                                                      #
+#                                                                                                                      #
+#                                                                                                                      #
+#                                                                                                                      #
+# #################################################################################################################### #
+def writeMetrics(probeMetrics, fileName, metricsFormat):
+    # Write probeMetrics to fileName as Prometheus text or JSON; nothing is written without metrics.
+    if probeMetrics is None:
+        return
+    with open(fileName, "w") as metricsFile:
+        metricsFile.write(probeMetrics.exportJson() if metricsFormat == "json" else probeMetrics.exportPrometheus())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ICMP ping and traceroute")
+    parser.add_argument("--batch", metavar="FILE",
+                        help="trace every host listed in FILE, one per line (- for standard input)")
+    parser.add_argument("--simulate", type=int, default=0, metavar="COUNT",
+                        help="trace COUNT targets of an in-process simulated network instead of the real one, "
+                             "which needs no root (with --batch, trace FILE's hosts through it instead)")
+    parser.add_argument("--quiet", action="store_true", help="in batch mode, print only the summary")
+    parser.add_argument("--output", metavar="DIRECTORY",
+                        help="with --batch, also append every hop and probe to the result store in DIRECTORY")
+    parser.add_argument("--max-in-flight", type=int, default=1024, help="probes outstanding across all traces")
+    parser.add_argument("--max-per-destination", type=int, default=32, help="probes outstanding per destination")
+    parser.add_argument("--monitor", metavar="FILE",
+                        help="monitor the paths to every host listed in FILE, one per line (- for standard input)")
+    parser.add_argument("--interval", type=float, default=1.0, help="with --monitor, seconds between rounds")
+    parser.add_argument("--rounds", type=int, default=0, help="with --monitor, rounds to run (0 runs until stopped)")
+    parser.add_argument("--snapshot-interval", type=float, default=10.0,
+                        help="with --monitor, seconds between printed snapshots")
+    parser.add_argument("--threads", type=int, default=0,
+                        help="trace the batch on a pool of THREADS threads, one socket each, instead of asyncio")
+    parser.add_argument("--doubletree", action="store_true",
+                        help="with --batch, trace Doubletree-style from --start-ttl and reuse path prefixes already "
+                             "discovered (runs on --threads threads, 8 if not given)")
+    parser.add_argument("--start-ttl", type=int, default=10, help="with --doubletree, TTL the traces start from")
+    parser.add_argument("--shared-socket", action="store_true",
+                        help="with --threads, send and receive every trace through one dispatched socket")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds to wait for each probe")
+    parser.add_argument("--max-ttl", type=int, default=30, help="highest TTL a trace probes")
+    parser.add_argument("--probes", type=int, default=4, help="probes sent to each hop of a trace")
+    parser.add_argument("--gap-limit", type=int, default=5,
+                        help="end a trace after this many consecutive silent hops (0 for no limit)")
+    parser.add_argument("--ignore-unreachable", action="store_true",
+                        help="keep tracing past Destination Unreachable from hops other than the target")
+    parser.add_argument("--adaptive-timeout", action="store_true",
+                        help="derive each probe's timeout from measured RTTs instead of --timeout")
+    parser.add_argument("--min-timeout", type=float, default=0.2, help="adaptive timeout floor in seconds")
+    parser.add_argument("--max-timeout", type=float, default=30, help="adaptive timeout ceiling in seconds")
+    parser.add_argument("--pace", type=float, default=0, metavar="PPS",
+                        help="send at most PPS probes per second overall (0 for no limit)")
+    parser.add_argument("--pace-destination", type=float, default=0, metavar="PPS",
+                        help="send at most PPS probes per second to any one destination (0 for no limit)")
+    parser.add_argument("--pace-hop", type=float, default=0, metavar="PPS",
+                        help="send at most PPS probes per second towards any one router, or TTL while its router "
+                             "is unknown (0 for no limit)")
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="with --batch or --monitor, count and time every probe and write the metrics to FILE "
+                             "when done")
+    parser.add_argument("--metrics-format", choices=["prometheus", "json"], default="prometheus",
+                        help="format of the --metrics file")
+    arguments = parser.parse_args()
+
+    simulatedNetwork = None
+    simulatedTargets = []
+    if arguments.simulate > 0:
+        simulatedNetwork = IcmpHelperLibrary.SimulatedNetwork()
+        simulatedTargets = simulatedNetwork.addTree(arguments.simulate)
+
+    probeMetrics = IcmpHelperLibrary.ProbeMetrics() if arguments.metrics is not None else None
+    icmpHelperPing = IcmpHelperLibrary(transport=simulatedNetwork, probeMetrics=probeMetrics)
+    traceLimits = IcmpHelperLibrary.TraceLimits(arguments.max_ttl, arguments.probes, arguments.gap_limit,
+                                                not arguments.ignore_unreachable)
+    if arguments.adaptive_timeout:
+        icmpHelperPing.setRttEstimator(IcmpHelperLibrary.RttEstimator(arguments.min_timeout, arguments.max_timeout))
+    if arguments.pace > 0 or arguments.pace_destination > 0 or arguments.pace_hop > 0:
+        icmpHelperPing.setProbePacer(IcmpHelperLibrary.ProbePacer(arguments.pace, arguments.pace_destination,
+                                                                  arguments.pace_hop))
+
+    if arguments.monitor is not None:
+        # Monitor mode reprints every path's table each snapshot. A probe never waits past the next round.
+        targetHosts = list(icmpHelperPing.readTargetHosts(arguments.monitor))
+        for pathSnapshots in icmpHelperPing.monitorPaths(targetHosts, arguments.interval,
+                                                         min(arguments.timeout, arguments.interval),
+                                                         arguments.snapshot_interval, arguments.rounds):
+            for pathSnapshot in pathSnapshots:
+                icmpHelperPing.printPathSnapshot(pathSnapshot)
+        writeMetrics(probeMetrics, arguments.metrics, arguments.metrics_format)
+        return
+
+    if arguments.batch is not None or simulatedNetwork is not None:
+        # Batch mode prints each trace as soon as it completes, followed by the overall throughput.
+        traceCount = 0
+        probesSent = 0
+        probesAnswered = 0
+        batchStartTime = time.time()
+        if arguments.batch is not None:
+            targetHosts = icmpHelperPing.readTargetHosts(arguments.batch)
+        else:
+            targetHosts = simulatedTargets
+        stopSet = IcmpHelperLibrary.StopSet() if arguments.doubletree else None
+        if arguments.threads > 0 or stopSet is not None:
+            dispatcher = None
+            if arguments.shared_socket:
+                # The process-wide dispatcher is only shared when no option needs a dispatcher of its own.
+                dispatcher = IcmpHelperLibrary.IcmpReceiveDispatcher(transport=simulatedNetwork,
+                                                                     probeMetrics=probeMetrics) \
+                    if simulatedNetwork is not None or probeMetrics is not None else \
+                    IcmpHelperLibrary.IcmpReceiveDispatcher.getShared()
+            traces = icmpHelperPing.traceRouteThreaded(targetHosts, arguments.threads or 8, True,
+                                                       timeout=arguments.timeout, dispatcher=dispatcher,
+                                                       stopSet=stopSet, startTtl=arguments.start_ttl,
+                                                       traceLimits=traceLimits)
+        else:
+            traces = icmpHelperPing.traceRouteBatch(targetHosts, arguments.max_in_flight,
+                                                    arguments.max_per_destination, timeout=arguments.timeout,
+                                                    traceLimits=traceLimits)
+        resultWriter = IcmpHelperLibrary.ResultWriter(arguments.output) if arguments.output is not None else None
+        for targetHost, hops in traces:
+            traceCount += 1
+            if hops is None:
+                if not arguments.quiet:
+                    print("-------------------------------------------------------------------------------------------------------------------------")
+                    print("Traceroute to (" + targetHost + ") could not resolve host")
+                continue
+            if resultWriter is not None:
+                resultWriter.writeTrace(icmpHelperPing.getResolverCache().resolve(targetHost.strip()), hops)
+            for hopResult in hops:
+                probesSent += hopResult.probesSent
+                probesAnswered += hopResult.probesAnswered
+            if arguments.quiet:
+                continue
+            print("-------------------------------------------------------------------------------------------------------------------------")
+            print("Traceroute to (" + targetHost + ")")
+            print("-------------------------------------------------------------------------------------------------------------------------")
+            for hopResult in hops:
+                icmpHelperPing.printTraceRouteHop(hopResult)
+        if resultWriter is not None:
+            resultWriter.close()
+        batchTime = time.time() - batchStartTime
+        print("-------------------------------------------------------------------------------------------------------------------------")
+        print("Traced %d targets in %.1f s (%.1f traces/s)" % (traceCount, batchTime, traceCount / max(batchTime, 1e-9)))
+        print("%d of the %d probes in the traces answered (%.1f answered probes/s)" %
+              (probesAnswered, probesSent, probesAnswered / max(batchTime, 1e-9)))
+        if icmpHelperPing.getProbePacer() is not None:
+            pacerStatistics = icmpHelperPing.getProbePacer().getStatistics()
+            print("Pacer delayed %d of %d probes, %.1f s in total (global %.1f s, destination %.1f s, hop %.1f s), "
+                  "%.3f s at most" % (pacerStatistics.probesDelayed, pacerStatistics.probesPaced,
+                                      pacerStatistics.totalWait, pacerStatistics.globalWait,
+                                      pacerStatistics.destinationWait, pacerStatistics.hopWait,
+                                      pacerStatistics.maxWait))
+        if stopSet is not None:
+            print("Reused %d cached hops from a stop set of %d" % (stopSet.getReusedHopCount(), stopSet.getHopCount()))
+        print("-------------------------------------------------------------------------------------------------------------------------")
+        writeMetrics(probeMetrics, arguments.metrics, arguments.metrics_format)
+        return
 
     # Choose one of the following by uncommenting out the line
     # icmpHelperPing.sendPing("209.233.126.254")
@@ -771,7 +5031,7 @@ def main():
     # icmpHelperPing.traceRoute("81.2.69.192")
     # icmpHelperPing.traceRoute("122.56.99.243")
     # icmpHelperPing.traceRoute("200.10.227.250")
-    icmpHelperPing.traceRoute("62.1.205.50")
+    icmpHelperPing.traceRoute("62.1.205.50", traceLimits)
 
 
 if __name__ == "__main__":
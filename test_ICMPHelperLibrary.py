@@ -0,0 +1,830 @@
+# Unit tests for ICMPHelperLibrary.py. Like the benchmarks they never open a raw socket, so they pass without root
+# or a network:
+#
+#   python3 -m pytest -q
+#   python3 -m unittest test_ICMPHelperLibrary
+
+# #################################################################################################################### #
+# Imports                                                                                                              #
+#                                                                                                                      #
+#                                                                                                                      #
+#                                                                                                                      #
+#                                                                                                                      #
+# #################################################################################################################### #
+import collections
+import json
+import queue
+import random
+import socket
+import struct
+import tempfile
+import time
+import unittest
+
+from ICMPBenchmark import legacyChecksum
+from ICMPHelperLibrary import IcmpHelperLibrary
+
+
+ECHO_REQUEST_DATA = IcmpHelperLibrary.IcmpPacket.ECHO_REQUEST_DATA_ENCODED
+
+
+def buildIpHeader(totalLength, sourceAddress, options=b''):
+    # IPv4 header for a received ICMP packet; options must be a multiple of 4 bytes long.
+    return struct.pack("!BBHHHBBH4s4s", 0x45 + len(options) // 4, 0, totalLength, 0, 0, 64, 1, 0,
+                       bytes(map(int, sourceAddress.split("."))), bytes([127, 0, 0, 1])) + options
+
+
+def runKernelFilter(program, packetBytes):
+    # Interprets the classic BPF instructions IcmpSession.buildKernelFilter emits, the way the kernel runs them on
+    # a received packet. Returns the number of bytes to pass, 0 to drop.
+    accumulator = indexRegister = programCounter = 0
+    while True:
+        code, jumpTrue, jumpFalse, k = struct.unpack_from("HBBI", program, programCounter * 8)
+        programCounter += 1
+        try:
+            if code == 0xb1:                                       # ldx 4*([k]&0xf)
+                indexRegister = (packetBytes[k] & 0x0f) * 4
+            elif code == 0x50:                                     # ldb [x+k]
+                accumulator = packetBytes[indexRegister + k]
+            elif code == 0x48:                                     # ldh [x+k]
+                accumulator = struct.unpack_from("!H", packetBytes, indexRegister + k)[0]
+        except (IndexError, struct.error):
+            return 0                                               # Loads past the end drop the packet
+        if code == 0x54:                                           # and #k
+            accumulator &= k
+        elif code == 0x64:                                         # lsh #k
+            accumulator <<= k
+        elif code == 0x0c:                                         # add x
+            accumulator += indexRegister
+        elif code == 0x07:                                         # tax
+            indexRegister = accumulator
+        elif code == 0x15:                                         # jeq #k
+            programCounter += jumpTrue if accumulator == k else jumpFalse
+        elif code == 0x35:                                         # jge #k
+            programCounter += jumpTrue if accumulator >= k else jumpFalse
+        elif code == 0x06:                                         # ret #k
+            return k
+
+
+class RecordingDispatcher:
+    # Stands in for an IcmpReceiveDispatcher: records what a DispatchedIcmpSession registers and sends, and answers
+    # nothing.
+    def __init__(self):
+        self.waiters = {}
+        self.sent = []
+
+    def register(self, probeKey, replies):
+        self.waiters[probeKey] = replies
+
+    def unregister(self, probeKey):
+        self.waiters.pop(probeKey, None)
+
+    def sendTo(self, packetBytes, destinationIpAddress, ttl):
+        self.sent.append((bytes(packetBytes), destinationIpAddress, ttl))
+
+    def sendBurst(self, probes):
+        for packetBytes, destinationIpAddress, ttl in probes:
+            self.sendTo(packetBytes, destinationIpAddress, ttl)
+
+
+# #################################################################################################################### #
+# IcmpChecksum                                                                                                         #
+#                                                                                                                      #
+#                                                                                                                      #
+#                                                                                                                      #
+#                                                                                                                      #
+# #################################################################################################################### #
+class IcmpChecksumTest(unittest.TestCase):
+    def testCalculateMatchesLegacyLoop(self):
+        echoRequest = struct.pack("!BBHHH", 8, 0, 0, 0x1234, 1) + struct.pack("d", 0.0) + ECHO_REQUEST_DATA
+        for packetAsByteData in [echoRequest, echoRequest[:-1], random.Random(0).randbytes(1500), bytes(64),
+                                 b'\xff' * 64, b'\x01']:
+            self.assertEqual(legacyChecksum(packetAsByteData),
+                             IcmpHelperLibrary.IcmpChecksum.calculate(packetAsByteData))
+
+    def testUpdateMatchesRecalculation(self):
+        packet = bytearray(struct.pack("!BBHHH", 8, 0, 0, 0x1234, 1) + ECHO_REQUEST_DATA)
+        checksum = IcmpHelperLibrary.IcmpChecksum.calculate(packet)
+        struct.pack_into("!H", packet, 6, 0xbeef)
+        self.assertEqual(IcmpHelperLibrary.IcmpChecksum.update(checksum, 1, 0xbeef),
+                         IcmpHelperLibrary.IcmpChecksum.calculate(packet))
+
+    def testRestampedPacketVerifies(self):
+        icmpPacket = IcmpHelperLibrary.IcmpPacket()
+        icmpPacket.buildPacket_echoRequest(0x1234, 0)
+        for packetSequenceNumber in [1, 0x8000, 0xffff]:
+            icmpPacket.updatePacketSequenceNumber(packetSequenceNumber)
+            icmpPacket.updateDateTimeSent()
+            self.assertEqual(IcmpHelperLibrary.IcmpChecksum.calculate(icmpPacket.getPacketBytes()), 0)
+            self.assertEqual(struct.unpack_from("!H", icmpPacket.getPacketBytes(), 6)[0], packetSequenceNumber)
+
+    def testStampedTemplateVerifies(self):
+        echoRequestTemplate = IcmpHelperLibrary.IcmpEchoRequestTemplate(0x1234)
+        for packetSequenceNumber in [0, 1, 0xffff]:
+            packetBytes = echoRequestTemplate.stamp(packetSequenceNumber)
+            self.assertEqual(IcmpHelperLibrary.IcmpChecksum.calculate(packetBytes), 0)
+            self.assertEqual(struct.unpack_from("!HH", packetBytes, 4), (0x1234, packetSequenceNumber))
+            self.assertEqual(packetBytes[16:], ECHO_REQUEST_DATA)
+
+    def testSendTimeRoundTrips(self):
+        echoRequestTemplate = IcmpHelperLibrary.IcmpEchoRequestTemplate(0x1234)
+        for sendTime in [0, 1, 0xffff, 0x123456789abcdef0, time.perf_counter_ns()]:
+            packetBytes = echoRequestTemplate.stamp(5, sendTime)
+            self.assertEqual(IcmpHelperLibrary.IcmpChecksum.calculate(packetBytes), 0)
+            self.assertEqual(struct.unpack_from("!Q", packetBytes, 8)[0], sendTime)
+
+        # IcmpPacket stamps the same format, and IcmpPacket_EchoReply reads it back.
+        icmpPacket = IcmpHelperLibrary.IcmpPacket()
+        timeBefore = time.perf_counter_ns()
+        icmpPacket.buildPacket_echoRequest(0x1234, 0)
+        packetBytes = icmpPacket.getPacketBytes()
+        echoReply = IcmpHelperLibrary.IcmpPacket_EchoReply(buildIpHeader(20 + len(packetBytes), "127.0.0.1") +
+                                                           packetBytes)
+        self.assertGreaterEqual(echoReply.getDateTimeSent(), timeBefore)
+        self.assertLessEqual(echoReply.getDateTimeSent(), time.perf_counter_ns())
+
+    def testBurstBuffersAreIndependent(self):
+        echoRequestTemplate = IcmpHelperLibrary.IcmpEchoRequestTemplate(0x1234)
+        burst = [echoRequestTemplate.stampBurstBuffer(burstIndex, 100 + burstIndex) for burstIndex in range(3)]
+        echoRequestTemplate.stamp(7)
+        for burstIndex, packetBytes in enumerate(burst):
+            self.assertEqual(IcmpHelperLibrary.IcmpChecksum.calculate(packetBytes), 0)
+            self.assertEqual(struct.unpack_from("!HH", packetBytes, 4), (0x1234, 100 + burstIndex))
+
+        # The next burst restamps the same pooled buffers.
+        self.assertIs(echoRequestTemplate.stampBurstBuffer(1, 200), burst[1])
+        self.assertEqual(struct.unpack_from("!H", burst[1], 6)[0], 200)
+
+
+# #################################################################################################################### #
+# IcmpReply                                                                                                            #
+#                                                                                                                      #
+#                                                                                                                      #
+#                                                                                                                      #
+#                                                                                                                      #
+# #################################################################################################################### #
+class IcmpReplyTest(unittest.TestCase):
+    def testEchoReplyAfterIpOptions(self):
+        icmpPacket = struct.pack("!BBHHHQ", 0, 0, 0, 0x1234, 7, 1000) + ECHO_REQUEST_DATA
+        options = bytes([7, 7, 4, 0, 0, 0, 0, 1])                  # Record route with no room, then end of list
+        packetBytes = buildIpHeader(28 + len(options) + len(icmpPacket), "10.0.0.9", options) + icmpPacket
+
+        icmpReply = IcmpHelperLibrary.IcmpReply.parse(bytearray(packetBytes), len(packetBytes), "10.0.0.9", 3000,
+                                                      ECHO_REQUEST_DATA)
+        self.assertEqual((icmpReply.icmpType, icmpReply.icmpCode), (0, 0))
+        self.assertEqual((icmpReply.packetIdentifier, icmpReply.packetSequenceNumber), (0x1234, 7))
+        self.assertEqual((icmpReply.address, icmpReply.probeDestination), ("10.0.0.9", "10.0.0.9"))
+        self.assertEqual((icmpReply.timeSent, icmpReply.timeReceived), (1000, 3000))
+        self.assertEqual(icmpReply.getPayloadRtt(), 0.002)
+        self.assertTrue(icmpReply.isValidResponse)
+
+        # Changed data makes the reply invalid.
+        packetBytes = packetBytes[:-1] + b'?'
+        icmpReply = IcmpHelperLibrary.IcmpReply.parse(packetBytes, len(packetBytes), "10.0.0.9", 3000,
+                                                      ECHO_REQUEST_DATA)
+        self.assertFalse(icmpReply.isValidResponse)
+
+    def testTimeExceededQuotingProbe(self):
+        echoRequestTemplate = IcmpHelperLibrary.IcmpEchoRequestTemplate(0x4321)
+        probe = bytes(echoRequestTemplate.stamp(42))
+        quotedIpHeader = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20 + len(probe), 0, 0, 1, 1, 0,
+                                     bytes([127, 0, 0, 1]), bytes([198, 19, 0, 1]))
+        icmpPacket = struct.pack("!BBHI", 11, 0, 0, 0) + quotedIpHeader + probe
+        options = bytes([1, 1, 1, 0])                              # Two no-ops and an end of list
+        packetBytes = buildIpHeader(20 + len(options) + len(icmpPacket), "198.18.0.2", options) + icmpPacket
+
+        icmpReply = IcmpHelperLibrary.IcmpReply.parse(memoryview(packetBytes), len(packetBytes), "198.18.0.2", 5)
+        self.assertEqual((icmpReply.icmpType, icmpReply.icmpCode), (11, 0))
+        self.assertEqual((icmpReply.packetIdentifier, icmpReply.packetSequenceNumber), (0x4321, 42))
+        self.assertEqual((icmpReply.address, icmpReply.probeDestination), ("198.18.0.2", "198.19.0.1"))
+        self.assertEqual(icmpReply.timeSent, struct.unpack_from("!Q", probe, 8)[0])
+
+        # A router that quotes only the first 8 bytes of the probe still identifies it, but not its send time.
+        shortLength = len(packetBytes) - len(probe) + 8
+        icmpReply = IcmpHelperLibrary.IcmpReply.parse(packetBytes, shortLength, "198.18.0.2", 5)
+        self.assertEqual(icmpReply.packetSequenceNumber, 42)
+        self.assertIsNone(icmpReply.timeSent)
+        self.assertIsNone(icmpReply.getPayloadRtt())
+        self.assertIsNone(IcmpHelperLibrary.IcmpReply.parse(packetBytes, shortLength - 1, "198.18.0.2", 5))
+
+    def testMatchesSendTime(self):
+        icmpReply = IcmpHelperLibrary.IcmpReply("10.0.0.9", 0, 0, 0x1234, 7, 3000, timeSent=1000)
+        self.assertTrue(icmpReply.matchesSendTime(1000))
+        self.assertFalse(icmpReply.matchesSendTime(999))              # Echoes an earlier probe's send time
+        icmpReply.timeSent = None
+        self.assertTrue(icmpReply.matchesSendTime(2000))
+        self.assertFalse(icmpReply.matchesSendTime(3001))             # Received before the probe was sent
+
+    def testIgnoresOtherPackets(self):
+        echoRequest = struct.pack("!BBHHHQ", 8, 0, 0, 0x1234, 7, 1000) + ECHO_REQUEST_DATA
+        packetBytes = buildIpHeader(20 + len(echoRequest), "127.0.0.1") + echoRequest
+        self.assertIsNone(IcmpHelperLibrary.IcmpReply.parse(packetBytes, len(packetBytes), "127.0.0.1", 0))
+        self.assertIsNone(IcmpHelperLibrary.IcmpReply.parse(packetBytes, 27, "127.0.0.1", 0))
+
+
+# #################################################################################################################### #
+# IcmpBatchIo                                                                                                          #
+#                                                                                                                      #
+#                                                                                                                      #
+#                                                                                                                      #
+#                                                                                                                      #
+# #################################################################################################################### #
+@unittest.skipUnless(IcmpHelperLibrary.IcmpBatchIo.isAvailable(), "recvmmsg is not available")
+class IcmpBatchIoTest(unittest.TestCase):
+    SO_TIMESTAMP = 29                       # From <asm-generic/socket.h>: a timeval, not the timespec we ask for
+    SO_TIMESTAMPNS = 35
+
+    def receiveEchoReplies(self, timestampOption=None, count=70):
+        # A UDP socket stands in for the raw one: each datagram carries what a raw socket would read, IP header
+        # included.
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as receiver, \
+                socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sender:
+            receiver.bind(("127.0.0.1", 0))
+            if timestampOption is not None:
+                receiver.setsockopt(socket.SOL_SOCKET, timestampOption, 1)
+            for packetSequenceNumber in range(count):
+                echoReply = struct.pack("!BBHHHQ", 0, 0, 0, 0x1234, packetSequenceNumber, 0) + ECHO_REQUEST_DATA
+                sender.sendto(buildIpHeader(20 + len(echoReply), "127.0.0.1") + echoReply, receiver.getsockname())
+            sender.sendto(b'\x45', receiver.getsockname())        # Too short to parse, skipped
+            return IcmpHelperLibrary.IcmpBatchIo(maxReceiveBatch=16).receiveReplies(receiver.fileno(),
+                                                                                     ECHO_REQUEST_DATA)
+
+    def testReceiveRepliesDrainsQueue(self):
+        icmpReplies = self.receiveEchoReplies()
+        self.assertEqual([icmpReply.packetSequenceNumber for icmpReply in icmpReplies], list(range(70)))
+        self.assertEqual({icmpReply.address for icmpReply in icmpReplies}, {"127.0.0.1"})
+        self.assertTrue(all(icmpReply.isValidResponse for icmpReply in icmpReplies))
+        self.assertFalse(any(icmpReply.isKernelTimestamp for icmpReply in icmpReplies))
+
+    def testKernelTimestampsOnlyFromTimestampNs(self):
+        timeBefore = time.perf_counter_ns()
+        icmpReplies = self.receiveEchoReplies(self.SO_TIMESTAMPNS, 3)
+        self.assertTrue(all(icmpReply.isKernelTimestamp for icmpReply in icmpReplies))
+        for icmpReply in icmpReplies:
+            self.assertLess(abs(icmpReply.timeReceived - timeBefore), 1000000000)
+
+        # SCM_TIMESTAMP fills the control buffer just as well, but is not a timespec.
+        icmpReplies = self.receiveEchoReplies(self.SO_TIMESTAMP, 3)
+        self.assertEqual(len(icmpReplies), 3)
+        self.assertFalse(any(icmpReply.isKernelTimestamp for icmpReply in icmpReplies))
+
+
+# #################################################################################################################### #
+# IcmpSession kernel filter                                                                                            #
+#                                                                                                                      #
+#                                                                                                                      #
+#                                                                                                                      #
+#                                                                                                                      #
+# #################################################################################################################### #
+class KernelFilterTest(unittest.TestCase):
+    def buildQuotingError(self, icmpType, packetIdentifier, quotedLength=None, options=b''):
+        probe = bytes(IcmpHelperLibrary.IcmpEchoRequestTemplate(packetIdentifier).stamp(9))
+        quotedIpHeader = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20 + len(probe), 0, 0, 1, 1, 0,
+                                     bytes([127, 0, 0, 1]), bytes([198, 19, 0, 1]))
+        icmpPacket = (struct.pack("!BBHI", icmpType, 0, 0, 0) + quotedIpHeader + probe)[:quotedLength]
+        return buildIpHeader(20 + len(options) + len(icmpPacket), "198.18.0.2", options) + icmpPacket
+
+    def testPassesOnlyRepliesToOurIdentifiers(self):
+        program = IcmpHelperLibrary.IcmpSession.buildKernelFilter([0x1234, 0x4321])
+        for packetIdentifier, expected in [(0x1234, True), (0x4321, True), (0x1235, False)]:
+            echoReply = struct.pack("!BBHHHQ", 0, 0, 0, packetIdentifier, 7, 0) + ECHO_REQUEST_DATA
+            packetBytes = buildIpHeader(20 + len(echoReply), "10.0.0.9", bytes([1, 1, 1, 0])) + echoReply
+            self.assertEqual(runKernelFilter(program, packetBytes) > 0, expected)
+            for icmpType in [11, 3]:
+                packetBytes = self.buildQuotingError(icmpType, packetIdentifier, options=bytes(4))
+                self.assertEqual(runKernelFilter(program, packetBytes) > 0, expected)
+
+    def testDropsOtherMessages(self):
+        program = IcmpHelperLibrary.IcmpSession.buildKernelFilter([0x1234])
+        echoRequest = struct.pack("!BBHHHQ", 8, 0, 0, 0x1234, 7, 0) + ECHO_REQUEST_DATA
+        self.assertEqual(runKernelFilter(program, buildIpHeader(20 + len(echoRequest), "127.0.0.1") + echoRequest), 0)
+        self.assertEqual(runKernelFilter(program, self.buildQuotingError(5, 0x1234)), 0)        # Redirect
+        self.assertEqual(runKernelFilter(program, self.buildQuotingError(11, 0x1234, 8 + 20 + 5)), 0)
+        self.assertGreater(runKernelFilter(program, self.buildQuotingError(11, 0x1234, 8 + 20 + 8)), 0)
+
+    def testEmptyIdentifierListPassesAnyIdentifier(self):
+        program = IcmpHelperLibrary.IcmpSession.buildKernelFilter([])
+        self.assertGreater(runKernelFilter(program, self.buildQuotingError(11, 0xbeef)), 0)
+        self.assertEqual(runKernelFilter(program, self.buildQuotingError(4, 0xbeef)), 0)
+
+
+# #################################################################################################################### #
+# IcmpReceiveDispatcher                                                                                                #
+#                                                                                                                      #
+#                                                                                                                      #
+#                                                                                                                      #
+#                                                                                                                      #
+# #################################################################################################################### #
+class IcmpReceiveDispatcherTest(unittest.TestCase):
+    def testClosedDispatcherRefusesUse(self):
+        dispatcher = IcmpHelperLibrary.IcmpReceiveDispatcher()
+        dispatcher.close()
+        with self.assertRaises(ValueError):
+            dispatcher.register((1, 2), queue.SimpleQueue())
+        with self.assertRaises(ValueError):
+            dispatcher.sendTo(bytes(64), "127.0.0.1", 1)
+        with self.assertRaises(ValueError):
+            dispatcher.openSession()
+
+    def testClosingSharedDispatcherReplacesIt(self):
+        dispatcher = IcmpHelperLibrary.IcmpReceiveDispatcher.getShared()
+        self.assertIs(IcmpHelperLibrary.IcmpReceiveDispatcher.getShared(), dispatcher)
+        dispatcher.close()
+        sharedDispatcher = IcmpHelperLibrary.IcmpReceiveDispatcher.getShared()
+        self.assertIsNot(sharedDispatcher, dispatcher)
+        sharedDispatcher.close()
+
+    def testTimedOutProbesAreUnregistered(self):
+        dispatcher = RecordingDispatcher()
+        session = IcmpHelperLibrary.DispatchedIcmpSession(dispatcher)
+        with IcmpHelperLibrary(session) as icmpHelperPing:
+            probeResults = list(icmpHelperPing.sendPingResults("127.0.0.1", count=2, timeout=0.01))[:2]
+        self.assertEqual([probeResult.sequenceNumber for probeResult in probeResults], [0, 1])
+        self.assertEqual([probeResult.rtt for probeResult in probeResults], [None, None])
+        self.assertEqual(len(dispatcher.sent), 2)
+        self.assertEqual(dispatcher.waiters, {})
+
+        # The session's counter carries on where the ping stopped.
+        self.assertEqual(session.allocateSequenceNumbers(), 2)
+
+
+# #################################################################################################################### #
+# RttEstimator                                                                                                         #
+#                                                                                                                      #
+#                                                                                                                      #
+#                                                                                                                      #
+#                                                                                                                      #
+# #################################################################################################################### #
+class RttEstimatorTest(unittest.TestCase):
+    def testFirstSampleThenSmoothing(self):
+        rttEstimator = IcmpHelperLibrary.RttEstimator(minimumTimeout=0, maximumTimeout=30, initialTimeout=1.0)
+        self.assertEqual(rttEstimator.getTimeout("10.0.0.1", 3), 1.0)
+
+        rttEstimator.addSample("10.0.0.1", 3, 0.1)
+        self.assertAlmostEqual(rttEstimator.getSmoothedRtt("10.0.0.1", 3), 0.1)
+        self.assertAlmostEqual(rttEstimator.getTimeout("10.0.0.1", 3), 0.1 + 4 * 0.05)
+
+        rttEstimator.addSample("10.0.0.1", 3, 0.3)
+        self.assertAlmostEqual(rttEstimator.getSmoothedRtt("10.0.0.1", 3), 0.875 * 0.1 + 0.125 * 0.3)
+        self.assertAlmostEqual(rttEstimator.getTimeout("10.0.0.1", 3),
+                               0.875 * 0.1 + 0.125 * 0.3 + 4 * (0.75 * 0.05 + 0.25 * 0.2))
+
+    def testFallbackAndClamping(self):
+        rttEstimator = IcmpHelperLibrary.RttEstimator(minimumTimeout=0.2, maximumTimeout=2)
+        rttEstimator.addSample("10.0.0.1", 5, 0.01, isDestination=True)
+        self.assertEqual(rttEstimator.getTimeout("10.0.0.1", 5), 0.2)      # 0.03 s, raised to the floor
+        rttEstimator.addSample("10.0.0.2", 1, 4.0)
+        self.assertEqual(rttEstimator.getTimeout("10.0.0.2", 1), 2)        # 12 s, capped at the ceiling
+
+        # An unmeasured hop uses the destination's estimate, an unknown destination the overall one.
+        self.assertEqual(rttEstimator.getTimeout("10.0.0.1", 2), rttEstimator.getTimeout("10.0.0.1", 5))
+        self.assertIsNone(rttEstimator.getSmoothedRtt("10.0.0.2"))
+        self.assertEqual(rttEstimator.getTimeout("10.0.0.3", 1), 2)
+
+    def testForgetsLeastRecentlyUsedDestinations(self):
+        rttEstimator = IcmpHelperLibrary.RttEstimator(maxDestinations=2)
+        rttEstimator.addSample("10.0.0.1", 1, 0.1)
+        rttEstimator.addSample("10.0.0.2", 1, 0.1)
+        rttEstimator.addSample("10.0.0.1", 1, 0.1)
+        rttEstimator.addSample("10.0.0.3", 1, 0.1)
+        self.assertIsNotNone(rttEstimator.getSmoothedRtt("10.0.0.1", 1))
+        self.assertIsNone(rttEstimator.getSmoothedRtt("10.0.0.2", 1))
+        self.assertIsNotNone(rttEstimator.getSmoothedRtt("10.0.0.3", 1))
+
+
+
+# #################################################################################################################### #
+# LatencyHistogram                                                                                                     #
+#                                                                                                                      #
+#                                                                                                                      #
+#                                                                                                                      #
+#                                                                                                                      #
+# #################################################################################################################### #
+# ProbePacer                                                                                                           #
+#                                                                                                                      #
+#                                                                                                                      #
+#                                                                                                                      #
+#                                                                                                                      #
+# #################################################################################################################### #
+class ProbePacerTest(unittest.TestCase):
+    def testReserveSpreadsProbesAtTheRate(self):
+        probePacer = IcmpHelperLibrary.ProbePacer(globalRate=100, globalBurst=2)
+        waits = [probePacer.reserve("10.0.0.1", 1) for i in range(4)]
+        self.assertEqual(waits[:2], [0.0, 0.0])                    # The burst goes out at once
+        self.assertAlmostEqual(waits[2], 0.01, delta=0.002)
+        self.assertAlmostEqual(waits[3], 0.02, delta=0.002)
+
+        probePacerStatistics = probePacer.getStatistics()
+        self.assertEqual(probePacerStatistics.probesPaced, 4)
+        self.assertEqual(probePacerStatistics.probesDelayed, 2)
+        self.assertAlmostEqual(probePacerStatistics.totalWait, 0.03, delta=0.004)
+        self.assertAlmostEqual(probePacerStatistics.maxWait, 0.02, delta=0.002)
+        self.assertEqual(probePacerStatistics.globalWait, probePacerStatistics.totalWait)
+        self.assertEqual(probePacerStatistics.destinationWait, 0.0)
+
+    def testAcquireSleepsUntilDue(self):
+        probePacer = IcmpHelperLibrary.ProbePacer(destinationRate=50, destinationBurst=1)
+        self.assertEqual(probePacer.acquire("10.0.0.1", 1), 0.0)
+        startTime = time.perf_counter()
+        wait = probePacer.acquire("10.0.0.1", 2)
+        self.assertGreaterEqual(time.perf_counter() - startTime, wait)
+        self.assertAlmostEqual(wait, 0.02, delta=0.002)
+
+    def testDestinationBucketsAreSeparate(self):
+        probePacer = IcmpHelperLibrary.ProbePacer(destinationRate=10, destinationBurst=1)
+        self.assertEqual(probePacer.reserve("10.0.0.1", 1), 0.0)
+        self.assertEqual(probePacer.reserve("10.0.0.2", 1), 0.0)
+        self.assertGreater(probePacer.reserve("10.0.0.1", 2), 0.0)
+        self.assertGreater(probePacer.getStatistics().destinationWait, 0.0)
+
+    def testHopBucketFollowsTheAnsweringRouter(self):
+        probePacer = IcmpHelperLibrary.ProbePacer(hopRate=10, hopBurst=1)
+        self.assertIsNone(probePacer.getExpectedHop("10.0.0.1", 3))
+        self.assertEqual(probePacer.reserve("10.0.0.1", 3), 0.0)
+        self.assertEqual(probePacer.reserve("10.0.0.2", 4), 0.0)   # Unknown hops are bucketed by TTL
+
+        # Two paths through the same router share its bucket once it has answered both.
+        probePacer.addHopAddress("10.0.0.1", 5, "192.0.2.1")
+        probePacer.addHopAddress("10.0.0.2", 6, "192.0.2.1")
+        self.assertEqual(probePacer.getExpectedHop("10.0.0.1", 5), "192.0.2.1")
+        self.assertEqual(probePacer.reserve("10.0.0.1", 5), 0.0)
+        self.assertGreater(probePacer.reserve("10.0.0.2", 6), 0.0)
+        self.assertGreater(probePacer.getStatistics().hopWait, 0.0)
+
+    def testRejectsBadLimits(self):
+        with self.assertRaises(ValueError):
+            IcmpHelperLibrary.ProbePacer(globalRate=-1)
+        with self.assertRaises(ValueError):
+            IcmpHelperLibrary.ProbePacer(hopBurst=0)
+
+    def testPacedTraceSpreadsItsBursts(self):
+        # Every probe of a pipelined trace is reserved before its burst goes out, so at 100 probes per second with
+        # no burst allowance the four probes take at least 30 ms to send, and they all still time out cleanly.
+        dispatcher = RecordingDispatcher()
+        probePacer = IcmpHelperLibrary.ProbePacer(globalRate=100, globalBurst=1)
+        with IcmpHelperLibrary(IcmpHelperLibrary.DispatchedIcmpSession(dispatcher),
+                               probePacer=probePacer) as icmpHelperPing:
+            startTime = time.perf_counter()
+            results = list(icmpHelperPing.traceRouteResults(
+                "127.0.0.1", pipelined=True, timeout=0.01,
+                traceLimits=IcmpHelperLibrary.TraceLimits(maxTtl=2, probesPerHop=2)))
+            traceTime = time.perf_counter() - startTime
+        self.assertGreaterEqual(traceTime, 0.03)
+        self.assertEqual([ttl for packetBytes, destinationIpAddress, ttl in dispatcher.sent], [1, 1, 2, 2])
+        self.assertEqual(len({packetBytes[6:8] for packetBytes, destinationIpAddress, ttl in dispatcher.sent}), 4)
+        self.assertEqual(probePacer.getStatistics().probesDelayed, 3)
+        self.assertEqual([result.ttl for result in results if isinstance(result, IcmpHelperLibrary.HopResult)], [1, 2])
+        self.assertEqual(dispatcher.waiters, {})
+
+
+# #################################################################################################################### #
+# ProbeMetrics                                                                                                         #
+#                                                                                                                      #
+#                                                                                                                      #
+#                                                                                                                      #
+#                                                                                                                      #
+# #################################################################################################################### #
+class ProbeMetricsTest(unittest.TestCase):
+    def testTimingBuckets(self):
+        probeMetrics = IcmpHelperLibrary.ProbeMetrics()
+        probeMetrics.addTiming("send", 500)                        # Under 1 us
+        probeMetrics.addTiming("send", 3000)                       # Up to 4 us
+        probeMetrics.addTiming("send", 40 * 10 ** 9)               # Past the last bound
+        probeMetrics.addTiming("build", 8000, 4)                   # Four builds of 2 us each
+        buckets = probeMetrics.getSnapshot()["timings"]["send"]["buckets"]
+        self.assertEqual(buckets[0], [1e-6, 1])
+        self.assertEqual(buckets[2], [4e-6, 2])
+        self.assertEqual(buckets[-2][1], 2)
+        self.assertEqual(buckets[-1], [None, 3])
+        self.assertEqual(probeMetrics.getTimingSummary("send"), IcmpHelperLibrary.TimingSummary(3, 40.0000035,
+                                                                                               40.0000035 / 3, 40.0))
+        self.assertEqual(probeMetrics.getTimingSummary("build"), IcmpHelperLibrary.TimingSummary(4, 8e-6, 2e-6, 2e-6))
+        self.assertEqual(probeMetrics.getTimingSummary("select").count, 0)
+        with self.assertRaises(KeyError):
+            probeMetrics.getTimingSummary("parse")
+
+        probeMetrics.reset()
+        self.assertEqual(probeMetrics.getTimingSummary("send").count, 0)
+
+    def testExport(self):
+        probeMetrics = IcmpHelperLibrary.ProbeMetrics()
+        probeMetrics.addProbesSent([(bytes(8), "10.0.0.1", 1)] * 3)
+        probeMetrics.addTimeout("10.0.0.1", 1, 0)
+        probeMetrics.addTiming("receive", 1500)
+        self.assertEqual(json.loads(probeMetrics.exportJson()), json.loads(json.dumps(probeMetrics.getSnapshot())))
+
+        lines = probeMetrics.exportPrometheus("test").splitlines()
+        self.assertIn("# TYPE test_probes_sent_total counter", lines)
+        self.assertIn("test_probes_sent_total 3", lines)
+        self.assertIn("test_probe_timeouts_total 1", lines)
+        self.assertIn("# TYPE test_reply_receive_seconds histogram", lines)
+        self.assertIn('test_reply_receive_seconds_bucket{le="2e-06"} 1', lines)
+        self.assertIn('test_reply_receive_seconds_bucket{le="+Inf"} 1', lines)
+        self.assertIn("test_reply_receive_seconds_count 1", lines)
+        for line in lines:
+            self.assertTrue(line.startswith("# HELP test_") or line.startswith("# TYPE test_") or
+                            line.startswith("test_"), line)
+
+
+# #################################################################################################################### #
+class LatencyHistogramTest(unittest.TestCase):
+    def assertWithinPrecision(self, value, expected):
+        # Percentiles are bucketed to within 0.8% of the exact value.
+        self.assertLessEqual(abs(value - expected), expected * 0.008)
+
+    def testPercentiles(self):
+        latencyHistogram = IcmpHelperLibrary.LatencyHistogram()
+        self.assertIsNone(latencyHistogram.getPercentile(50))
+        for rtt in range(1, 1001):
+            latencyHistogram.addRtt(rtt / 10)                      # 0.1 ms to 100 ms
+        self.assertEqual(latencyHistogram.getCount(), 1000)
+        self.assertEqual(latencyHistogram.getMinRtt(), 0.1)
+        self.assertEqual(latencyHistogram.getMaxRtt(), 100.0)
+        self.assertAlmostEqual(latencyHistogram.getAvgRtt(), 50.05)
+        self.assertWithinPrecision(latencyHistogram.getPercentile(50), 50.0)
+        self.assertWithinPrecision(latencyHistogram.getPercentile(90), 90.0)
+        self.assertWithinPrecision(latencyHistogram.getPercentile(99), 99.0)
+        self.assertEqual(latencyHistogram.getPercentile(100), 100.0)
+        self.assertEqual(latencyHistogram.getSummary().count, 1000)
+
+    def testMerge(self):
+        fastHistogram = IcmpHelperLibrary.LatencyHistogram()
+        slowHistogram = IcmpHelperLibrary.LatencyHistogram()
+        totalHistogram = IcmpHelperLibrary.LatencyHistogram()
+        for rtt in range(1, 101):
+            fastHistogram.addRtt(rtt * 0.01)
+            slowHistogram.addRtt(rtt * 10.0)
+            totalHistogram.addRtt(rtt * 0.01)
+            totalHistogram.addRtt(rtt * 10.0)
+        fastHistogram.merge(slowHistogram)
+        fastHistogram.merge(IcmpHelperLibrary.LatencyHistogram())
+        self.assertEqual(fastHistogram.getSummary(), totalHistogram.getSummary())
+        self.assertEqual(fastHistogram.getMinRtt(), 0.01)
+        self.assertEqual(fastHistogram.getMaxRtt(), 1000.0)
+
+    def testMergeRejectsOtherLayouts(self):
+        with self.assertRaises(ValueError):
+            IcmpHelperLibrary.LatencyHistogram().merge(IcmpHelperLibrary.LatencyHistogram(subBucketBits=10))
+
+
+
+# #################################################################################################################### #
+# ResultWriter and ResultReader                                                                                        #
+#                                                                                                                      #
+#                                                                                                                      #
+#                                                                                                                      #
+#                                                                                                                      #
+# #################################################################################################################### #
+class ResultStoreTest(unittest.TestCase):
+    def testRoundTrip(self):
+        probes = (IcmpHelperLibrary.ProbeResult(1, 5, "198.18.0.2", 11, 0, 0.25, True),
+                  IcmpHelperLibrary.ProbeResult(1, 6, None, None, None, None, False))
+        latencyHistogram = IcmpHelperLibrary.LatencyHistogram()
+        latencyHistogram.addRtt(0.25)
+        hops = [IcmpHelperLibrary.HopResult(1, "198.18.0.2", 11, 0, 0.25, 0.25, 0.25, 2, 1, False, probes,
+                                            latencyHistogram),
+                IcmpHelperLibrary.HopResult(2, None, None, None, None, None, None, 0, 0, False, (),
+                                            IcmpHelperLibrary.LatencyHistogram())]
+
+        with tempfile.TemporaryDirectory() as directory:
+            with IcmpHelperLibrary.ResultWriter(directory, bufferSize=1) as resultWriter:
+                resultWriter.writeTrace("198.19.0.1", hops, 1700000000.0)
+            with IcmpHelperLibrary.ResultWriter(directory) as resultWriter:
+                resultWriter.writeProbe("198.19.0.1", probes[0], 1700000001.0)    # Reopening appends
+
+            with IcmpHelperLibrary.ResultReader(directory) as resultReader:
+                self.assertEqual((resultReader.getProbeCount(), resultReader.getHopCount()), (3, 2))
+                probeRecords = list(resultReader.iterProbes())
+                hopRecords = list(resultReader.iterHops())
+
+        self.assertEqual(probeRecords[0], IcmpHelperLibrary.ProbeRecord(1700000000.0, "198.19.0.1", *probes[0]))
+        self.assertEqual(probeRecords[1], IcmpHelperLibrary.ProbeRecord(1700000000.0, "198.19.0.1", *probes[1]))
+        self.assertEqual(probeRecords[2].time, 1700000001.0)
+        self.assertEqual(hopRecords, [IcmpHelperLibrary.HopRecord(1700000000.0, "198.19.0.1", *hopResult[:10])
+                                      for hopResult in hops])
+
+
+
+# #################################################################################################################### #
+# StopSet                                                                                                              #
+#                                                                                                                      #
+#                                                                                                                      #
+#                                                                                                                      #
+#                                                                                                                      #
+# #################################################################################################################### #
+class StopSetTest(unittest.TestCase):
+    @staticmethod
+    def buildHop(ttl, address, isDestination=False):
+        probesAnswered = 0 if address is None else 1
+        return IcmpHelperLibrary.HopResult(ttl, address, None, None, None, None, None, 1, probesAnswered,
+                                           isDestination, (), IcmpHelperLibrary.LatencyHistogram())
+
+    def testPrefixIncludesSilentHops(self):
+        stopSet = IcmpHelperLibrary.StopSet()
+        stopSet.addTrace([self.buildHop(1, "10.0.0.1"), self.buildHop(2, None), self.buildHop(3, "10.0.0.3"),
+                          self.buildHop(4, "10.0.0.4"), self.buildHop(5, "10.9.9.9", True)])
+        self.assertEqual([hopResult.ttl for hopResult in stopSet.getPrefix("10.0.0.4", 4)], [1, 2, 3])
+        self.assertEqual([hopResult.ttl for hopResult in stopSet.getPrefix("10.0.0.4", 4, 3)], [1, 2])
+        self.assertEqual(stopSet.getReusedHopCount(), 5)
+        self.assertIsNone(stopSet.getPrefix("10.0.0.4", 5))            # Known address, unknown TTL
+        self.assertIsNone(stopSet.getPrefix("10.9.9.9", 5))            # The destination is never stored
+
+    def testEvictedParentInvalidatesPrefix(self):
+        stopSet = IcmpHelperLibrary.StopSet(maxEntries=2)
+        stopSet.addTrace([self.buildHop(1, "10.0.0.1"), self.buildHop(2, "10.0.0.2"), self.buildHop(3, "10.0.0.3")])
+        self.assertEqual(stopSet.getHopCount(), 2)
+        self.assertIsNone(stopSet.getPrefix("10.0.0.3", 3))
+
+
+# #################################################################################################################### #
+class SimulatedTraceTest(unittest.TestCase):
+    routerAddresses = ["198.18.0.%d" % hop for hop in range(2, 7)]
+
+    def setUp(self):
+        # Two destinations behind the same five routers, the third of which never answers.
+        self.simulatedNetwork = IcmpHelperLibrary.SimulatedNetwork(seed=0)
+        for address in self.routerAddresses + ["198.19.0.1", "198.19.0.2"]:
+            self.simulatedNetwork.addRouter(address, latency=0.1)
+        self.simulatedNetwork.addRouter(self.routerAddresses[2], latency=0.1, isSilent=True)
+        self.simulatedNetwork.addPath("198.19.0.1", self.routerAddresses)
+        self.simulatedNetwork.addPath("198.19.0.2", self.routerAddresses)
+        self.icmpHelper = IcmpHelperLibrary(transport=self.simulatedNetwork)
+
+    def tearDown(self):
+        self.simulatedNetwork.close()
+
+    def traceHops(self, destinationIpAddress, traceLimits=IcmpHelperLibrary.TraceLimits(probesPerHop=2),
+                  **arguments):
+        return [result for result in self.icmpHelper.traceRouteResults(destinationIpAddress, timeout=0.2,
+                                                                       traceLimits=traceLimits, **arguments)
+                if isinstance(result, IcmpHelperLibrary.HopResult)]
+
+    def assertPath(self, hops, destinationIpAddress):
+        self.assertEqual([hopResult.ttl for hopResult in hops], list(range(1, 7)))
+        self.assertEqual([hopResult.address for hopResult in hops],
+                         self.routerAddresses[:2] + [None] + self.routerAddresses[3:] + [destinationIpAddress])
+        self.assertEqual([hopResult.icmpType for hopResult in hops], [11, 11, None, 11, 11, 0])
+        self.assertTrue(hops[-1].isDestination)
+        for hopResult in hops:
+            self.assertEqual(hopResult.latencyHistogram.getCount(), hopResult.probesAnswered)
+            if hopResult.address is not None:
+                self.assertLessEqual(hopResult.minRtt, hopResult.latencyHistogram.getPercentile(50))
+                self.assertLessEqual(hopResult.latencyHistogram.getPercentile(99), hopResult.maxRtt)
+
+    def testSequential(self):
+        hops = self.traceHops("198.19.0.1")
+        self.assertPath(hops, "198.19.0.1")
+        self.assertEqual([hopResult.probesSent for hopResult in hops], [2] * 6)
+        self.assertEqual(hops[2].probesAnswered, 0)
+
+    def testPipelined(self):
+        self.assertPath(self.traceHops("198.19.0.1", pipelined=True, windowSize=8), "198.19.0.1")
+
+    def testDoubletree(self):
+        stopSet = IcmpHelperLibrary.StopSet()
+        firstHops = self.traceHops("198.19.0.1", stopSet=stopSet, startTtl=5, windowSize=2)
+        self.assertPath(firstHops, "198.19.0.1")
+        self.assertEqual(stopSet.getReusedHopCount(), 0)
+
+        # The second trace probes forward over TTLs 5 and 6, then back over TTLs 3 and 4 in one window, where it
+        # meets the first one's path at TTL 4 and reuses the two hops below the window.
+        probesReceived = self.simulatedNetwork.getProbesReceived()
+        secondHops = self.traceHops("198.19.0.2", stopSet=stopSet, startTtl=5, windowSize=2)
+        self.assertPath(secondHops, "198.19.0.2")
+        self.assertEqual(stopSet.getReusedHopCount(), 2)
+        self.assertEqual(secondHops[:2], firstHops[:2])
+        self.assertEqual(self.simulatedNetwork.getProbesReceived() - probesReceived, 4 * 2)
+
+    def testPing(self):
+        results = list(self.icmpHelper.sendPingResults("198.19.0.1", 3, 1))
+        pingStatistics = results[-1]
+        self.assertEqual((pingStatistics.probesSent, pingStatistics.probesAnswered), (3, 3))
+        self.assertEqual(pingStatistics.latencyHistogram.getCount(), 3)
+        self.assertTrue(all(probeResult.isValid for probeResult in results[:-1]))
+
+    def testLateRepliesDoNotCrossTraces(self):
+        # The destination answers after 300 ms, past the 200 ms timeout. Every trace from the helper draws on its
+        # session's one sequence counter, so a late Echo Reply to one trace never answers a probe of the next.
+        self.simulatedNetwork.addRouter("198.19.0.3", latency=150)
+        self.simulatedNetwork.addPath("198.19.0.3", self.routerAddresses[:2])
+        traceLimits = IcmpHelperLibrary.TraceLimits(maxTtl=3, probesPerHop=1, gapLimit=0)
+        for pipelined in [False, False, True, True]:
+            hops = [result for result in self.icmpHelper.traceRouteResults("198.19.0.3", pipelined=pipelined,
+                                                                          timeout=0.2, traceLimits=traceLimits)
+                    if isinstance(result, IcmpHelperLibrary.HopResult)]
+            self.assertEqual([hopResult.address for hopResult in hops], self.routerAddresses[:2] + [None])
+            self.assertFalse(any(hopResult.isDestination for hopResult in hops))
+        self.assertEqual(self.simulatedNetwork.getRepliesSent(), 4 * 3)
+
+    def testTraceLimits(self):
+        self.simulatedNetwork.addPath("198.19.0.3", self.routerAddresses[:2], "none")
+        self.simulatedNetwork.addPath("198.19.0.4", self.routerAddresses[:2], "unreachable")
+        for pipelined in [False, True]:
+            # A silent destination ends the trace after gapLimit silent hops rather than at maxTtl.
+            hops = self.traceHops("198.19.0.3", pipelined=pipelined, traceLimits=IcmpHelperLibrary.TraceLimits(
+                maxTtl=10, probesPerHop=1, gapLimit=2))
+            self.assertEqual([hopResult.probesAnswered for hopResult in hops], [1, 1, 0, 0])
+
+            # Destination Unreachable from the last router ends the trace unless told to carry on to maxTtl.
+            hops = self.traceHops("198.19.0.4", pipelined=pipelined, traceLimits=IcmpHelperLibrary.TraceLimits(
+                maxTtl=10, probesPerHop=1))
+            self.assertEqual([hopResult.icmpType for hopResult in hops], [11, 11, 3])
+            hops = self.traceHops("198.19.0.4", pipelined=pipelined, traceLimits=IcmpHelperLibrary.TraceLimits(
+                maxTtl=5, probesPerHop=1, stopOnUnreachable=False))
+            self.assertEqual([hopResult.icmpType for hopResult in hops], [11, 11, 3, 3, 3])
+            self.assertFalse(hops[-1].isDestination)
+
+    def testDispatchedTraceUnregistersTimedOutProbes(self):
+        dispatcher = IcmpHelperLibrary.IcmpReceiveDispatcher(transport=self.simulatedNetwork)
+        try:
+            for pipelined in [False, True]:
+                with IcmpHelperLibrary(dispatcher.openSession()) as icmpHelperPing:
+                    hops = [result for result in icmpHelperPing.traceRouteResults(
+                        "198.19.0.1", pipelined=pipelined, timeout=0.2,
+                        traceLimits=IcmpHelperLibrary.TraceLimits(probesPerHop=2))
+                        if isinstance(result, IcmpHelperLibrary.HopResult)]
+                self.assertPath(hops, "198.19.0.1")
+                self.assertEqual(dispatcher.getWaitingCount(), 0)   # The silent hop's probes were let go
+            session = dispatcher.openSession()
+        finally:
+            dispatcher.close()
+
+        # A session whose dispatcher has closed fails loudly instead of waiting out every probe.
+        with self.assertRaises(ValueError):
+            list(IcmpHelperLibrary(session).traceRouteResults("198.19.0.1", timeout=0.2))
+        with self.assertRaises(ValueError):
+            dispatcher.openSession()
+
+    def assertTreePaths(self, results, targets):
+        self.assertEqual(sorted(targetHost for targetHost, hops in results), sorted(targets))
+        for targetHost, hops in results:
+            routerAddresses, reply = self.simulatedNetwork.getPath(targetHost)
+            answeredHops = [hopResult.address for hopResult in hops[:len(routerAddresses)]]
+            self.assertEqual(answeredHops, [None if self.simulatedNetwork.getRouter(address).isSilent else address
+                                            for address in routerAddresses][:len(hops)])
+            if reply == "echo":
+                self.assertEqual((hops[-1].ttl, hops[-1].address), (len(routerAddresses) + 1, targetHost))
+                self.assertTrue(hops[-1].isDestination)
+            elif reply == "unreachable":
+                self.assertEqual((hops[-1].ttl, hops[-1].icmpType), (len(routerAddresses) + 1, 3))
+            else:
+                self.assertEqual([hopResult.probesAnswered for hopResult in hops[-5:]], [0] * 5)
+
+    def testBatchOverTree(self):
+        targets = self.simulatedNetwork.addTree(40, fanout=4, latency=0.1, jitter=0, rateLimit=0)
+        traceLimits = IcmpHelperLibrary.TraceLimits(probesPerHop=1)
+        self.assertTreePaths(list(self.icmpHelper.traceRouteBatch(targets, maxInFlight=256, maxPerDestination=8,
+                                                                  windowSize=8, timeout=0.2,
+                                                                  traceLimits=traceLimits)), targets)
+
+    def testThreadedOverTree(self):
+        targets = self.simulatedNetwork.addTree(40, fanout=4, latency=0.1, jitter=0, rateLimit=0)
+        dispatcher = IcmpHelperLibrary.IcmpReceiveDispatcher(transport=self.simulatedNetwork)
+        try:
+            results = list(self.icmpHelper.traceRouteThreaded(targets, maxWorkers=8, pipelined=True, timeout=0.2,
+                                                              dispatcher=dispatcher,
+                                                              traceLimits=IcmpHelperLibrary.TraceLimits(
+                                                                  probesPerHop=1)))
+            self.assertEqual(dispatcher.getWaitingCount(), 0)
+        finally:
+            dispatcher.close()
+        self.assertTreePaths(results, targets)
+
+    def testProbeMetrics(self):
+        probeMetrics = IcmpHelperLibrary.ProbeMetrics()
+        probeEvents = []
+        probeMetrics.addHook(probeEvents.append)
+        with IcmpHelperLibrary(transport=self.simulatedNetwork, probeMetrics=probeMetrics) as icmpHelperPing:
+            hops = [result for result in icmpHelperPing.traceRouteResults(
+                "198.19.0.1", timeout=0.2, traceLimits=IcmpHelperLibrary.TraceLimits(probesPerHop=2))
+                if isinstance(result, IcmpHelperLibrary.HopResult)]
+        self.assertPath(hops, "198.19.0.1")
+
+        # Six hops of two probes, the silent third hop's two timing out.
+        self.assertEqual(probeMetrics.getProbesSent(), 12)
+        self.assertEqual(probeMetrics.getReplyCounts(), {(11, 0): 8, (0, 0): 2})
+        self.assertEqual(probeMetrics.getTimeouts(), 2)
+        self.assertEqual(probeMetrics.getMismatchedReplies(), 0)
+        self.assertEqual(probeMetrics.getTimingSummary("build").count, 12)
+        self.assertEqual(probeMetrics.getTimingSummary("receive").count, 10)
+        self.assertEqual(sorted(collections.Counter(probeEvent.kind for probeEvent in probeEvents).items()),
+                         [("reply", 10), ("sent", 12), ("timeout", 2)])
+        timeouts = [probeEvent for probeEvent in probeEvents if probeEvent.kind == "timeout"]
+        self.assertEqual({(probeEvent.destinationIpAddress, probeEvent.ttl) for probeEvent in timeouts},
+                         {("198.19.0.1", 3)})
+
+    def testBatchProbeMetrics(self):
+        targets = self.simulatedNetwork.addTree(40, fanout=4, latency=0.1, jitter=0, rateLimit=0)
+        probeMetrics = IcmpHelperLibrary.ProbeMetrics()
+        probesReceived = self.simulatedNetwork.getProbesReceived()
+        with IcmpHelperLibrary(transport=self.simulatedNetwork, probeMetrics=probeMetrics) as icmpHelperPing:
+            self.assertTreePaths(list(icmpHelperPing.traceRouteBatch(
+                targets, maxInFlight=256, maxPerDestination=8, windowSize=8, timeout=0.2,
+                traceLimits=IcmpHelperLibrary.TraceLimits(probesPerHop=1))), targets)
+        self.assertEqual(probeMetrics.getProbesSent(), self.simulatedNetwork.getProbesReceived() - probesReceived)
+        self.assertEqual(sum(probeMetrics.getReplyCounts().values()), self.simulatedNetwork.getRepliesSent())
+        self.assertGreater(probeMetrics.getTimeouts(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()